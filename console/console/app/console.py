@@ -54,6 +54,8 @@ application = webapp.WSGIApplication([
     ('/console/help.*'    , controller.Help),
     ('/console/statement' , controller.Statement),
     ('/console/banner'    , controller.Banner),
+    ('/console/output'    , controller.Output),
+    ('/console/gc'        , controller.GarbageCollector),
     ('/console.*'         , controller.Console),
 ], debug=debug)
 
@@ -21,11 +21,12 @@ import os
 import re
 import sys
 import cgi
-import sets
+import random
+import hashlib
+import datetime
 import string
 import logging
 import traceback
-import exceptions
 
 import pygments
 import pygments.lexers
@@ -34,6 +35,7 @@ import pygments.formatters
 import util
 import model
 import config
+import doclink
 
 from google.appengine.api        import users
 from google.appengine.api        import memcache
@@ -51,11 +53,46 @@ INITIAL_UNPICKLABLES = [
                'finally: del sys'])
 ]
 
-DOCUMENTED_EXCEPTIONS = sets.Set()
-for name in dir(exceptions):
-    e = getattr(exceptions, name)
-    if (type(e) is type) and issubclass(e, exceptions.BaseException):
-        DOCUMENTED_EXCEPTIONS.add(e)
+# Highlighted HTML is cached in memory, up to this many bytes.
+HIGHLIGHT_CACHE_BYTES = 2 * 1024 * 1024
+
+def encoded_size(html):
+    """Return the size of some HTML in bytes, as it is encoded in the response."""
+    if isinstance(html, unicode):
+        return len(html.encode('utf-8'))
+    return len(html)
+
+highlight_cache = util.LRUCache(HIGHLIGHT_CACHE_BYTES, sizeof=encoded_size)
+
+def highlight(text, lexer, formatter):
+    """Return pygments.highlight() of some text, from the cache if it has been highlighted
+    before with the same lexer and formatter.
+    """
+    if isinstance(text, unicode):
+        digest = hashlib.sha1(text.encode('utf-8')).digest()
+    else:
+        digest = hashlib.sha1(text).digest()
+    key = (id(lexer), id(formatter), digest)
+
+    html = highlight_cache.get(key)
+    if html is None:
+        html = pygments.highlight(text, lexer, formatter)
+        highlight_cache[key] = html
+    return html
+
+def highlight_examples(examples, formatter):
+    """Given a dict of lists of (lexer, code) pairs, return a dict of lists of the
+    highlighted HTML for each piece of code.
+    """
+    highlighted = {}
+    for name, pairs in examples.items():
+        highlighted[name] = [pygments.highlight(util.trim(code), lexer, formatter).strip()
+                             for lexer, code in pairs]
+    return highlighted
+
+def output_key(session_key, stream_id):
+    """Return the key of a statement's output stream."""
+    return '%s:%s' % (session_key, stream_id)
 
 def confirm_permission():
     """Raises an exception if the user does not have permission to execute a statement"""
@@ -165,6 +202,9 @@ class Statement(ConsoleHandler):
         code = self.request.get('code')
         output_templating = False
         out, err, exc_type = ('', '', None)
+        version = None
+        chunks = 0
+        truncated = None
 
         try:
             confirm_permission()
@@ -181,15 +221,39 @@ class Statement(ConsoleHandler):
             return
         else:
             # Access granted.
+            # The client sends back the session version from its previous statement, so
+            # that an out-of-date copy of the session in memcache is never used.  Without
+            # one, no cached copy can be trusted and the session is read from the datastore.
             session_key = self.request.get('session')
-            engine = model.AppEngineConsole.get(session_key)
-            result = engine.runsource(code)
+            version = None
+            if self.request.get('version'):
+                version = self.request.get_range('version', min_value=0)
+            engine = model.AppEngineConsole.get_cached(session_key, version)
+
+            # The browser names a stream for the output, which it fetches while the statement
+            # runs, and which also holds any output past the size limit.
+            stream_id = self.request.get('stream') or '%x' % random.getrandbits(64)
+            chunk_size = None
+            if config.stream_output and self.request.get('stream'):
+                chunk_size = config.output_chunk_size
+            stream = model.OutputStream(output_key(session_key, stream_id), chunk_size,
+                                        config.max_output_size)
+
+            result = engine.runsource(code, stream)
+            stream.close()
             out = engine.out
             err = engine.err
+            version = engine.version
+            chunks = stream.chunks
+            if stream.truncated:
+                truncated = {'stream': stream_id, 'size': stream.size, 'pages': stream.pages}
 
         self.response.headers['Content-Type'] = 'application/x-javascript'
-        response = self.buildResponse(code, out, err, exc_type, output_templating)
+        response = self.buildResponse(code, out, err, exc_type, output_templating, bool(truncated))
         response['result'] = result
+        response['version'] = version
+        response['chunks'] = chunks
+        response['truncated'] = truncated
         self.response.out.write(simplejson.dumps(response))
 
     def formatConsoleError(self, code, exc_type, exc_value):
@@ -199,14 +263,21 @@ class Statement(ConsoleHandler):
                 ''.join(traceback.format_list(stack)) +
                 ''.join(traceback.format_exception_only(exc_type, exc_value)))
 
-    def buildResponse(self, code, out='', err='', exc_type=None, templating=False):
-        """Given the output and error messages of a statement, prepare them for sending via JSON."""
+    def buildResponse(self, code, out='', err='', exc_type=None, templating=False, truncated=False):
+        """Given the output and error messages of a statement, prepare them for sending via JSON.
+        Truncated output is too big to be worth highlighting, so it is only escaped.
+        """
         highlighting = (self.request.get('highlight') != '0')
+        if truncated:
+            out = doclink.escape(out)
+            if highlighting:
+                out = '<pre>%s</pre>' % out
+
         if highlighting:
             logging.debug('Highlighting code')
-            code = pygments.highlight(code, self.lexer, self.inputFormatter)
+            code = highlight(code, self.lexer, self.inputFormatter)
 
-            if out:
+            if out and not truncated:
                 out = self.highlight(out)
             if err:
                 err = self.highlight(err, exc_type)
@@ -229,71 +300,46 @@ class Statement(ConsoleHandler):
         if exc_type:
             formatter = self.errorFormatter
 
-        output = pygments.highlight(plain, self.resultLexer, formatter).strip()
+        output = highlight(plain, self.resultLexer, formatter).strip()
 
         # Fancy linking to documented parts of Python.
         if not config.python_doc_linking:
             return output
 
-        # Otherwise, try to find stuff to link to.
-        name, link = None, None
+        return doclink.linker.link(plain, output, exc_type)
 
-        def doclink(path, name):
-            """Return an HTML link to the documentation"""
-            return '<a href="%s%s">%s</a>' % (config.python_doc, path, name)
-
-        if exc_type in DOCUMENTED_EXCEPTIONS:
-            name = exc_type.__name__
-            link = doclink('/library/exceptions.html#exceptions.%s' % name, name)
-
-        match = re.search(r"<(module '(.*?)') \(built-in\)>$", plain)
-        if match:
-            name, mod_name = match.groups()
-            name = name.replace("'", '&#39;')
-            link = doclink('/library/%s.html' % mod_name, name)
-
-        moduleRE = r"^<(module '(.*?)') from '%s/lib/python%d.%d/\2\.py[co]?'>$" % (sys.prefix, sys.version_info[0], sys.version_info[1])
-        match = re.search(moduleRE, plain)
-        if match:
-            name, mod_name = match.groups()
-            name = name.replace("'", '&#39;')
-            link = doclink('/library/%s.html' % mod_name, name)
-
-        match = re.search(r'^(None|False|True)$', plain)
-        if match:
-            name = match.groups()[0]
-            link = doclink('/library/stdtypes.html#truth-value-testing', name)
-
-        match = re.search(r"^<type '(int|float|long|complex)'>$", plain)
-        if match:
-            name = match.groups()[0]
-            link = doclink('/library/stdtypes.html#numeric-types-int-float-long-complex', name)
 
-        match = re.search(r"^<type '(str|unicode|list|tuple|buffer|xrange)'>$", plain)
-        if match:
-            name = match.groups()[0]
-            link = doclink('/library/stdtypes.html#sequence-types-str-unicode-list-tuple-buffer-xrange', name)
+class Output(ConsoleHandler):
+    """Return the output which a running statement has streamed so far.  The browser asks
+    for the chunks from "start" onward, and keeps asking until the statement finishes.
+    It can also ask for a "page" of the output which was cut off by the size limit.
+    """
+    CHUNKS_PER_REQUEST = 20
 
-        match = re.search(r"^<type '(set|frozenset)'>$", plain)
-        if match:
-            name = match.groups()[0]
-            link = doclink('/library/stdtypes.html#set-types-set-frozenset', name)
+    def get(self):
+        try:
+            confirm_permission()
+        except ConsoleError:
+            self.error(403)
+            return
 
-        if plain == "<type 'dict'>":
-            name = 'dict'
-            link = doclink('/library/stdtypes.html#mapping-types-dict', name)
+        key = output_key(self.request.get('session'), self.request.get('stream'))
+        self.response.headers['Content-Type'] = 'application/x-javascript'
 
-        if plain == "<type 'file'>":
-            name = 'file'
-            link = doclink('/library/stdtypes.html#file-objects', name)
+        if self.request.get('page'):
+            # A page of the output past the size limit, which is sent as plain text.
+            page = self.request.get_range('page', min_value=0)
+            self.response.out.write(simplejson.dumps({'page': page, 'text': model.read_page(key, page)}))
+            return
 
-        # Finally, do the replacing if needed.
-        if name and link:
-            logging.debug("Replacing output:\nold: %s\nnew: %s" % (name, link))
-            output = output.replace(name, link)
+        start = self.request.get_range('start', min_value=0)
+        chunks = model.read_chunks(key, start, self.CHUNKS_PER_REQUEST)
 
-        return output
+        if self.request.get('highlight') != '0':
+            chunks = [highlight(chunk, Statement.resultLexer, Statement.outputFormatter).strip()
+                      for chunk in chunks]
 
+        self.response.out.write(simplejson.dumps({'start': start, 'chunks': chunks}))
 
 class Banner(ConsoleHandler):
     def get(self):
@@ -373,7 +419,7 @@ class Console(Page):
     subpages = []
 
     def get(self):
-        # Set up the session. TODO: garbage collect old shell sessions
+        # Set up the session. Old sessions are deleted by the GarbageCollector.
         try:
             confirm_permission()
         except ConsoleError:
@@ -383,10 +429,10 @@ class Console(Page):
             # Access granted.
             session_key = self.request.get('session')
             if session_key:
-                engine = model.AppEngineConsole.get(session_key)
+                engine = model.AppEngineConsole.get_cached(session_key)
             else:
                 # Create a new session.
-                engine = model.AppEngineConsole()
+                engine = model.AppEngineConsole(incremental=config.incremental_sessions)
                 engine.unpicklables = [db.Text(line) for line in INITIAL_UNPICKLABLES]
                 session_key = engine.put()
 
@@ -440,46 +486,70 @@ class Help(Page):
     inputFormatter  = pygments.formatters.HtmlFormatter(cssclass='statement')
     outputFormatter = pygments.formatters.HtmlFormatter(cssclass='stdout')
 
-    examples = ["""
-        >>> print "hello, world"
-        Traceback (most recent call last):
-          File "<stdin>", line 1, in <module>
-            print "hello, world"
-        NotLoggedInError: Hello! Please log in to use this console
-        ""","""
-        >>> print "3 to the 33 is", 3 ** 33
-        3 to the 150 is 5559060566555523
-        >>> import sys, os, logging
-        >>> print "Maximum integer size:", sys.maxint
-        Maximum integer size: 9223372036854775807
-        >>> from google.appengine.api import memcache
-        >>> memcache.add(key="example", value=os.environ["REMOTE_ADDR"])
-        True
-        >>> memcache.get("example")
-        '58.8.57.254'
-        >>> logging.info("My IP address is %s" % _)
-        """
-    ]
+    # The examples for each sub-page, as (lexer, code) pairs.
+    examples = {
+        'usage': [(resultLexer, """
+            >>> print "hello, world"
+            Traceback (most recent call last):
+              File "<stdin>", line 1, in <module>
+                print "hello, world"
+            NotLoggedInError: Hello! Please log in to use this console
+            """), (resultLexer, """
+            >>> print "3 to the 33 is", 3 ** 33
+            3 to the 150 is 5559060566555523
+            >>> import sys, os, logging
+            >>> print "Maximum integer size:", sys.maxint
+            Maximum integer size: 9223372036854775807
+            >>> from google.appengine.api import memcache
+            >>> memcache.add(key="example", value=os.environ["REMOTE_ADDR"])
+            True
+            >>> memcache.get("example")
+            '58.8.57.254'
+            >>> logging.info("My IP address is %s" % _)
+            """)
+        ],
+        'integration': [(pythonLexer, """
+            def is_dev():
+                import os
+                return os.environ['SERVER_SOFTWARE'].startswith('Dev')
+            """), (resultLexer, """
+            >>> is_dev()
+            True
+            """)
+        ],
+    }
+
+    # The examples never change, so they are highlighted once, when the module is imported.
+    highlighted = highlight_examples(examples, outputFormatter)
 
     def get(self):
         self.values['project'] = 'http://www.proven-corporation.com/software/app-engine-console/'
 
-        if self.values['subpage'] == 'usage':
-            for exampleNum in range(len(self.examples)):
-                key = 'example%d' % (exampleNum + 1)
-                val = util.trim(self.examples[exampleNum])
-                val = pygments.highlight(val, self.resultLexer, self.outputFormatter).strip()
-                self.values[key] = val
-        elif self.values['subpage'] == 'integration':
-            self.values['example1'] = pygments.highlight(util.trim("""
-                def is_dev():
-                    import os
-                    return os.environ['SERVER_SOFTWARE'].startswith('Dev')
-            """), self.pythonLexer, self.outputFormatter).strip()
-            self.values['example2'] = pygments.highlight(util.trim("""
-                >>> is_dev()
-                True
-            """), self.resultLexer, self.outputFormatter).strip()
+        examples = self.highlighted.get(self.values['subpage'], [])
+        for exampleNum in range(len(examples)):
+            self.values['example%d' % (exampleNum + 1)] = examples[exampleNum]
+
+class GarbageCollector(webapp.RequestHandler):
+    """Delete old console sessions.  This is run by cron (see cron.yaml), and each run
+    carries on from where the previous one stopped.
+    """
+    CURSOR_KEY = 'console_gc_cursor'
+
+    def get(self):
+        cursor = self.request.get('cursor') or memcache.get(self.CURSOR_KEY)
+        max_age = datetime.timedelta(days=config.session_max_age_days)
+        report = model.collect_garbage(max_age, cursor,
+                                        never_used=config.collect_never_used_sessions)
+
+        if report['cursor']:
+            memcache.set(self.CURSOR_KEY, report['cursor'])
+        else:
+            memcache.delete(self.CURSOR_KEY)
+
+        logging.info('Garbage collected %(sessions)d sessions (%(entities)d entities, about '
+                     '%(bytes)d bytes)' % report)
+        self.response.headers['Content-Type'] = 'application/x-javascript'
+        self.response.out.write(simplejson.dumps(report))
 
 class Root(Page):
     def get(self):
@@ -489,7 +559,7 @@ class Root(Page):
             self.redirect('/console/')
         self.done = True
 
-__all__ = ['Console', 'Dashboard', 'Help', 'Statement', 'Banner', 'Root']
+__all__ = ['Console', 'Dashboard', 'Help', 'Statement', 'Output', 'Banner', 'GarbageCollector', 'Root']
 
 if __name__ == "__main__":
     logging.error('I should be running unit tests')
@@ -0,0 +1,135 @@
+# App Engine Console documentation linking
+#
+# Copyright 2008-2009 Proven Corporation Co., Ltd., Thailand
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Turn console output which mentions a documented type, module or value into a link
+to its documentation.
+"""
+
+import re
+import cgi
+import sys
+import sets
+import logging
+import exceptions
+
+import config
+
+DOCUMENTED_EXCEPTIONS = sets.Set()
+for name in dir(exceptions):
+    e = getattr(exceptions, name)
+    if (type(e) is type) and issubclass(e, exceptions.BaseException):
+        DOCUMENTED_EXCEPTIONS.add(e)
+
+def escape(text):
+    """Escape text the same way that the Pygments HTML formatter does."""
+    return cgi.escape(text, True).replace("'", '&#39;')
+
+
+class DocLinker(object):
+    """A table of rules for linking output to its documentation.
+
+    Each rule is a regular expression which is searched for in the plain output, and a
+    URL template.  The expression must have a group called "name", which is the text that
+    becomes the link.  The template is filled in from the expression's named groups and
+    from the python_doc and appengine_doc settings in config.  All of the rules are
+    compiled into a single expression, so the output is only scanned once.
+    """
+
+    def __init__(self):
+        self.rules = []
+        self.scanner = None
+
+    def add(self, pattern, url):
+        """Add a rule.  If more than one rule matches some output, the first one wins."""
+        index = len(self.rules)
+        names = re.compile(pattern).groupindex.keys()
+        if 'name' not in names:
+            raise ValueError('Documentation link pattern needs a "name" group: %s' % pattern)
+
+        # Give the groups names of their own, so that all rules can live in one expression.
+        renamed = re.sub(r'\(\?P([<=])(\w+)', r'(?P\1\2_%d' % index, pattern)
+        self.rules.append((renamed, names, url))
+        self.scanner = None
+
+    def compile(self):
+        alternatives = ['(?P<rule_%d>%s)' % (index, rule[0]) for index, rule in enumerate(self.rules)]
+        self.scanner = re.compile('|'.join(alternatives))
+
+    def link(self, plain, html, exc_type=None):
+        """Return the highlighted html of some plain output, with a link to the documentation
+        of what it mentions, if anything.
+        """
+        name, url = None, None
+        settings = {'python_doc': config.python_doc, 'appengine_doc': config.appengine_doc}
+
+        if exc_type in DOCUMENTED_EXCEPTIONS:
+            name = exc_type.__name__
+            url = '%s/library/exceptions.html#exceptions.%s' % (config.python_doc, name)
+
+        if self.scanner is None:
+            self.compile()
+
+        match = self.scanner.search(plain)
+        if match:
+            index = int(match.lastgroup[len('rule_'):])
+            pattern, names, template = self.rules[index]
+
+            values = dict(settings)
+            for group in names:
+                values[group] = match.group('%s_%d' % (group, index))
+            name, url = values['name'], template % values
+
+        if not name:
+            return html
+
+        name = escape(name)
+        link = '<a href="%s">%s</a>' % (url, name)
+        logging.debug("Replacing output:\nold: %s\nnew: %s" % (name, link))
+        return html.replace(name, link)
+
+linker = DocLinker()
+
+linker.add(r"<(?P<name>module '(?P<module>.*?)') \(built-in\)>$",
+           '%(python_doc)s/library/%(module)s.html')
+linker.add(r"^<(?P<name>module '(?P<module>.*?)') from '%s/lib/python%d\.%d/(?P=module)\.py[co]?'>$"
+               % (re.escape(sys.prefix), sys.version_info[0], sys.version_info[1]),
+           '%(python_doc)s/library/%(module)s.html')
+linker.add(r'^(?P<name>None|False|True)$',
+           '%(python_doc)s/library/stdtypes.html#truth-value-testing')
+linker.add(r"^<type '(?P<name>int|float|long|complex)'>$",
+           '%(python_doc)s/library/stdtypes.html#numeric-types-int-float-long-complex')
+linker.add(r"^<type '(?P<name>str|unicode|list|tuple|buffer|xrange)'>$",
+           '%(python_doc)s/library/stdtypes.html#sequence-types-str-unicode-list-tuple-buffer-xrange')
+linker.add(r"^<type '(?P<name>set|frozenset)'>$",
+           '%(python_doc)s/library/stdtypes.html#set-types-set-frozenset')
+linker.add(r"^<type '(?P<name>dict)'>$",
+           '%(python_doc)s/library/stdtypes.html#mapping-types-dict')
+linker.add(r"^<type '(?P<name>file)'>$",
+           '%(python_doc)s/library/stdtypes.html#file-objects')
+
+linker.add(r"^<class '(?P<name>google\.appengine\.api\.datastore_types\.Key)'>$",
+           '%(appengine_doc)s/datastore/keyclass.html')
+for cls in ('Model', 'Query', 'GqlQuery', 'Property'):
+    linker.add(r"^<class '(?P<name>google\.appengine\.ext\.db\.%s)'>$" % cls,
+               '%%(appengine_doc)s/datastore/%sclass.html' % cls.lower())
+linker.add(r"^<(?P<name>module 'google\.appengine\.api\.(?P<api>memcache|urlfetch|mail|users|images|xmpp)') from '.*'>$",
+           '%(appengine_doc)s/%(api)s/')
+
+for pattern, url in config.doc_links:
+    linker.add(pattern, url)
@@ -19,4 +19,5 @@
 
 """App Engine Console models package"""
 
-from console import AppEngineConsole
+from console import AppEngineConsole, collect_garbage
+from output import OutputStream, read_chunks, read_page
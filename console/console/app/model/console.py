@@ -21,17 +21,22 @@ import os
 import sys
 import new
 import code
+import time
 import types
+import opcode
 import logging
 import cPickle
 import StringIO
 import datetime
 import traceback
 
-from model.session import ShellSession
+import util
+
+from model.session import ShellSession, ShellGlobal, cache_key, dumps
 
 from google.appengine.ext import db
 from google.appengine.api import users
+from google.appengine.api import memcache
 
 # Types that can't be pickled.
 UNPICKLABLE_TYPES = (
@@ -41,52 +46,255 @@ UNPICKLABLE_TYPES = (
     types.FunctionType,
 )
 
+# Names which give code access to globals it does not mention by name.  A statement
+# using any of these gets every session global restored, not just the ones it references.
+# Reading sys.modules can reach the statement's module with '__main__' as a constant,
+# which never shows up among the names.
+INTROSPECTIVE_NAMES = frozenset([
+    '__main__', 'modules', 'globals', 'vars', 'dir', 'locals', 'eval', 'execfile', 'input',
+])
+
+# Types whose values can never change in place, so checking the identity (or failing that,
+# the hash and equality) of a global bound to one of them tells whether it has changed.
+IMMUTABLE_TYPES = (
+    types.NoneType,
+    bool,
+    int,
+    long,
+    float,
+    complex,
+    str,
+    unicode,
+)
+
+def is_immutable(obj):
+    """Return whether an object, and everything inside it, can never change in place."""
+    if isinstance(obj, IMMUTABLE_TYPES):
+        return True
+    if type(obj) in (tuple, frozenset):
+        for item in obj:
+            if not is_immutable(item):
+                return False
+        return True
+    return False
+
+def referenced_names(bytecode):
+    """Return the set of global names which a code object (including any functions or
+    classes defined in it) could look up, or None if it could look up any global at all,
+    for example by using globals() or an exec statement.
+    """
+    names = set(bytecode.co_names)
+    if names & INTROSPECTIVE_NAMES:
+        return None
+
+    codestring = bytecode.co_code
+    i = 0
+    while i < len(codestring):
+        op = ord(codestring[i])
+        if op == opcode.opmap.get('EXEC_STMT'):
+            return None
+        if op >= opcode.HAVE_ARGUMENT:
+            i += 3
+        else:
+            i += 1
+
+    for const in bytecode.co_consts:
+        if isinstance(const, types.CodeType):
+            inner = referenced_names(const)
+            if inner is None:
+                return None
+            names |= inner
+
+    return names
+
+
+# How many unpicklable statements (by source) and session snapshots to keep compiled in memory.
+COMPILED_CACHE_SIZE = 500
+SNAPSHOT_CACHE_SIZE = 50
+
+# Compiled unpicklable statements: source -> (code object, referenced_names() of the code).
+compiled_unpicklables = util.LRUCache(COMPILED_CACHE_SIZE)
+
+def compile_unpicklable(source):
+    """Return a (code, names) tuple for an unpicklable statement, compiling it only once."""
+    compiled = compiled_unpicklables.get(source)
+    if compiled is None:
+        bytecode = compile(source, '<string>', 'exec')
+        compiled = (bytecode, referenced_names(bytecode))
+        compiled_unpicklables[source] = compiled
+    return compiled
+
+
+class UnpicklableSnapshot(object):
+    """The state of a session's __main__ module after replaying its unpicklable statements.
+
+    Snapshots are cached in memory per session, so that a warm instance only replays the
+    unpicklable statements which were added since the snapshot was taken.  The same module
+    object is reused for every statement, because the functions and classes in the snapshot
+    look up their globals in that module's __dict__.  Like imported modules, the objects which
+    the unpicklable statements create are therefore shared by the statements which run on the
+    same instance.
+    """
+
+    def __init__(self):
+        self.module = new.module('__main__')
+        self.namespace = {}
+        self.version = 0        # How many unpicklables have been applied.
+        self.last_source = None # The last one applied, to check that it still matches.
+        self.names = set()      # Names used by the unpicklables' code; None if any name.
+
+    def matches(self, unpicklables):
+        """Return whether this snapshot is a prefix of a session's unpicklable statements."""
+        if self.version > len(unpicklables):
+            return False
+        return self.version == 0 or unpicklables[self.version - 1] == self.last_source
+
+    def restore(self, builtins, unpicklables):
+        """Reset the module to the snapshot and apply any new unpicklable statements, so
+        that it is ready to run a statement in.
+        """
+        namespace = self.module.__dict__
+        namespace.clear()
+        namespace.update(self.namespace)
+        namespace['__name__'] = '__main__'
+        namespace['__builtins__'] = builtins
+
+        if len(unpicklables) > self.version:
+            names = self.names
+            for source in unpicklables[self.version:]:
+                bytecode, bad_names = compile_unpicklable(source)
+                exec bytecode in namespace
+                if names is not None:
+                    if bad_names is None:
+                        names = None
+                    else:
+                        names = names | bad_names
+
+            self.namespace = dict(namespace)
+            self.version = len(unpicklables)
+            self.last_source = unpicklables[-1]
+            self.names = names
+
+# Session key -> UnpicklableSnapshot.
+snapshots = util.LRUCache(SNAPSHOT_CACHE_SIZE)
+
+
+class ChangeTracker(object):
+    """Finds the globals which a statement changed, without pickling the whole session.
+
+    Before the statement runs, the tracker remembers which object each global is bound to.
+    Afterwards, a global is unchanged if it is still bound to the same immutable object, or
+    has been rebound to an equal immutable value (the hashes are compared first).  Only
+    mutable values which the statement could reach are compared by their pickles, and the
+    values which were just unpickled from the session reuse their stored pickle instead of
+    being pickled twice.
+    """
+
+    def __init__(self, namespace, blobs, reachable):
+        """Take a snapshot of a namespace.
+
+        namespace: the statement module's __dict__, before the statement runs
+        blobs: the pickles of the globals which were restored from the session, by name
+        reachable: the names which the statement could use, or None for every name
+        """
+        self.before = dict(namespace)
+        self.pickles = {}
+        for name, val in self.before.items():
+            if reachable is not None and name not in reachable:
+                continue
+            if isinstance(val, UNPICKLABLE_TYPES) or is_immutable(val):
+                continue
+            if name in blobs:
+                self.pickles[name] = blobs[name]
+            else:
+                try:
+                    self.pickles[name] = dumps(val)
+                except Exception:
+                    # Without a pickle to compare, this value can only change by rebinding.
+                    pass
+
+    def same_value(self, old, new):
+        """Return whether two different objects are equal, immutable values."""
+        if type(old) is not type(new) or not (is_immutable(old) and is_immutable(new)):
+            return False
+        try:
+            return hash(old) == hash(new) and old == new
+        except TypeError:
+            return False
+
+    def changes(self, namespace):
+        """Compare a namespace to the snapshot.
+
+        Returns a (changed, removed) tuple. changed maps the names of new or changed globals
+        to their new pickle, or to None if it has not been computed.  removed is a list of the
+        names which are no longer in the namespace.
+        """
+        changed = {}
+        for name, val in namespace.items():
+            if name not in self.before:
+                changed[name] = None
+                continue
+
+            old = self.before[name]
+            if val is old:
+                if name in self.pickles:
+                    blob = dumps(val)
+                    if blob != self.pickles[name]:
+                        changed[name] = blob
+            elif not self.same_value(old, val):
+                changed[name] = None
+
+        removed = [name for name in self.before if name not in namespace]
+        return changed, removed
+
 
 class AppEngineConsole(ShellSession):
     """An interactive console session, derived from the Google shell session example."""
     pending_source = db.TextProperty()
-    last_used      = db.DateTimeProperty()
+    last_used      = db.DateTimeProperty(auto_now_add=True)
 
     def __init__(self, *args, **kw):
         ShellSession.__init__(self, *args, **kw)
         self.fresh()
 
-    def storedValue(self, obj):
-        """Returns a string representing the given object's value, which should allow the
-        code below to determine whether the object changes over time.
-        """
-        if isinstance(obj, UNPICKLABLE_TYPES):
-            return repr(obj)
-        else:
-            return cPickle.dumps(obj)
-
     def fresh(self):
         self.out = ''
         self.err = ''
         self.exc_type = None
 
+        # Seconds spent restoring the session ("snapshot"), running the statement ("exec"),
+        # and finding and saving the changed globals ("persist").
+        self.timings = {'snapshot': 0.0, 'exec': 0.0, 'persist': 0.0}
+
     def getPending(self):
         if self.pending_source is None:
             return ''
         return self.pending_source
     
     def setPending(self, pending):
+        # This is saved along with everything else at the end of runsource().
         self.pending_source = pending
-        self.put()
 
-    def runsource(self, source):
-        """Wrap the real source processor to record when the source was processed."""
+    def runsource(self, source, stream=None):
+        """Wrap the real source processor to record when the source was processed.
+        The session is written to the datastore once, after the statement has run.
+        """
         try:
             self.last_used = datetime.datetime.now()
-            return self.processSource(source)
+            return self.processSource(source, stream)
         finally:
-            self.put()
+            start = time.time()
+            self.persist()
+            self.timings['persist'] += time.time() - start
+            logging.debug('Statement timings: snapshot=%(snapshot).3fs exec=%(exec).3fs persist=%(persist).3fs' % self.timings)
 
-    def processSource(self, source):
+    def processSource(self, source, stream=None):
         """Runs some source code in the object's context.  The return value will be
         True if the code is valid but incomplete, or False if the code is
         complete (whether by error or not).  If the code is complete, the
         "output" attribute will have the text output of execution (stdout and stderr).
+        If a stream (such as an OutputStream) is given, the output is written to it, and
+        "output" only has whatever the stream did not send itself.
         """
         self.fresh()
 
@@ -113,54 +321,62 @@ class AppEngineConsole(ShellSession):
             return True     # Compilation still pending; awaiting lines of code.
 
         logging.debug('Compilation successful')
+        start = time.time()
 
-        # Create a dedicated module to be used as this statement's __main__.
-        statement_module = new.module('__main__')
-
-        # Use this request's __builtin__, since it changes on each request.
-        # This is needed for import statements, among other things.
-        import __builtin__
-        statement_module.__builtins__ = __builtin__
+        # Use the session's cached snapshot of the unpicklables if this instance has one.
+        if self.is_saved():
+            session_key = str(self.key())
+            snapshot = snapshots.get(session_key)
+            if snapshot is None or not snapshot.matches(self.unpicklables):
+                snapshot = UnpicklableSnapshot()
+                snapshots[session_key] = snapshot
+        else:
+            snapshot = UnpicklableSnapshot()
 
         # Swap in our custom module for __main__, then unpickle the session
         # globals, run the statement, and re-pickle the session globals, all
         # inside it.
         old_main = sys.modules.get('__main__')
         try:
+            # Re-evaluate any unpicklables which are not in the snapshot yet. Use this
+            # request's __builtin__, since it changes on each request.  This is needed for
+            # import statements, among other things.
+            import __builtin__
+            statement_module = snapshot.module
             sys.modules['__main__'] = statement_module
-            statement_module.__name__ = '__main__'
+            snapshot.restore(__builtin__, self.unpicklables)
 
-            # Re-evaluate the unpicklables.
-            for bad_statement in self.unpicklables:
-                exec bad_statement in statement_module.__dict__
+            # Functions and classes defined by the unpicklables may use any global
+            # that their code mentions, so those names must be restored too.
+            needed = referenced_names(bytecode)
+            if needed is not None:
+                if snapshot.names is None:
+                    needed = None
+                else:
+                    needed |= snapshot.names
 
-            # Re-initialize the globals.
-            for name, val in self.globals_dict().items():
+            # Re-initialize the globals, unpickling only those this statement could use.
+            blobs = self.global_blobs(needed)
+            for name, blob in blobs.items():
                 try:
-                    statement_module.__dict__[name] = val
+                    statement_module.__dict__[name] = cPickle.loads(blob)
                 except:
                     msg = 'Dropping %s since it could not be unpickled' % name
                     self.out += '%s\n' % msg
                     logging.warning('%s:\n%s' % (msg, traceback.format_exc()))
                     self.remove_global(name)
 
-            # Execute it.
-            buf = StringIO.StringIO()
-            old_globals = dict(statement_module.__dict__)
-
             # Later on, we compare new variable ("global") values to these values to see what's changed
-            # and should be saved in the store; however, since old_globals is merely a shallow copy,
-            # naively comparing for inequality between old/new values will not work: mutating a list
-            # or dict for example will change the underlying object in *both* dicts and so the != comparison
-            # will return false.  In other words:
-            # >>> a = {'foo': [1, 2]}; b = dict(a); print a['foo'] is b['foo']
-            # True
-            #
-            # The current solution is to remember the object's pickled representation and compare
-            # the before and after pickled strings.  Another idea is maybe de-optimizing this completely and
-            # just always re-store every global.
-            old_global_values = dict([(a, self.storedValue(b)) for a, b in old_globals.items()])
+            # and should be saved in the store.  See ChangeTracker for how that is kept cheap.
+            tracker = ChangeTracker(statement_module.__dict__, blobs, needed)
+            self.timings['snapshot'] = time.time() - start
 
+            # Execute it.
+            if stream is None:
+                buf = StringIO.StringIO()
+            else:
+                buf = stream
+            start = time.time()
             try:
                 old_stdout = sys.stdout
                 old_stderr = sys.stderr
@@ -171,42 +387,146 @@ class AppEngineConsole(ShellSession):
                 finally:
                     sys.stdout = old_stdout
                     sys.stderr = old_stderr
+                    self.timings['exec'] = time.time() - start
             except BaseException, e:
                 # Store the output and user's exception.
-                buf.seek(0)
-                self.out = buf.read()
+                self.out = buf.getvalue()
                 self.err = traceback.format_exc()
                 self.exc_type = type(e)
                 self.setPending('')
                 logging.info('Exception for: %s\nout:\n%s\nerr:\n%s' % (user, self.out.strip(), self.err.strip()))
                 return False    # Code execution completed (the hard way).
 
-            buf.seek(0)
-            self.out = buf.read()
+            self.out = buf.getvalue()
             logging.info('Execution for: %s: %s' % (user, self.out.strip()))
             self.setPending('')
 
-            # Extract the new globals that this statement added.
-            new_globals = {}
-            for name, val in statement_module.__dict__.items():
-                if name not in old_global_values or self.storedValue(val) != old_global_values[name]:
-                    new_globals[name] = val
+            # Extract the new globals that this statement added or changed.
+            start = time.time()
+            changed, removed = tracker.changes(statement_module.__dict__)
+
+            for name in removed:
+                self.remove_global(name)
 
-            if True in [isinstance(val, UNPICKLABLE_TYPES) for val in new_globals.values()]:
+            if True in [isinstance(statement_module.__dict__[name], UNPICKLABLE_TYPES) for name in changed]:
                 # This statement added an unpicklable global.  Store the statement and
                 # the names of all of the globals it added in the unpicklables.
-                self.add_unpicklable(source, new_globals.keys())
+                self.add_unpicklable(source, changed.keys())
                 logging.debug('Storing this statement as an unpicklable.')
             else:
                 # This statement didn't add any unpicklables.  Pickle and store the
                 # new globals back into the datastore.
-                for name, val in new_globals.items():
+                for name, blob in changed.items():
                     if not name.startswith('__'):
-                        self.set_global(name, val)
+                        self.set_global(name, statement_module.__dict__[name], blob)
+            self.timings['persist'] = time.time() - start
         finally:
             sys.modules['__main__'] = old_main
 
         return False    # Code execution completed.
 
+# The garbage collector deletes at most this many datastore entities per RPC.
+GC_BATCH_SIZE = 500
+
+def collect_garbage(max_age, cursor=None, limit=1000, never_used=False):
+    """Delete the sessions which have not been used for max_age (a datetime.timedelta),
+    along with their stored globals.
+
+    Old sessions are found with keys-only queries and deleted in batches of GC_BATCH_SIZE
+    entities, without reading them.  At most limit sessions are examined per call, so
+    that a call fits in a request; pass the returned cursor to the next call to carry on
+    from where this one stopped.  Sessions created before last_used was set on creation
+    have no last_used at all, however old or new they are, so they are only collected,
+    by a second query, when never_used is true.
+
+    Returns a dict with the number of 'sessions' and of datastore 'entities' deleted, an
+    estimate of the 'bytes' they took up, and the 'cursor' for the next call, which is None
+    once every old session has been collected.
+    """
+    cutoff = datetime.datetime.now() - max_age
+    # None sorts before every date, so the first query excludes it explicitly.
+    filters = [[('last_used >', None), ('last_used <', cutoff)]]
+    if never_used:
+        filters.append([('last_used =', None)])
+
+    phase, query_cursor = 0, None
+    if cursor:
+        phase, query_cursor = cursor.split(':', 1)
+        phase = int(phase)
+
+    report = {'sessions': 0, 'entities': 0, 'bytes': 0, 'cursor': None}
+    examined = 0
+    while phase < len(filters) and examined < limit:
+        count = min(GC_BATCH_SIZE, limit - examined)
+        query = AppEngineConsole.all(keys_only=True)
+        for condition in filters[phase]:
+            query.filter(*condition)
+        try:
+            if query_cursor:
+                query.with_cursor(query_cursor)
+            keys = query.fetch(count)
+        except (db.BadRequestError, db.BadValueError):
+            if not query_cursor:
+                raise
+            # The cursor has expired; the deleted sessions are gone, so just start over.
+            logging.info('Restarting garbage collection query %d' % phase)
+            query_cursor = None
+            continue
+
+        examined += len(keys)
+        report['sessions'] += len(keys)
+        entities, size = delete_sessions(keys)
+        report['entities'] += entities
+        report['bytes'] += size
+
+        if len(keys) < count:
+            phase, query_cursor = phase + 1, None
+        else:
+            query_cursor = query.cursor()
+
+    if phase < len(filters):
+        report['cursor'] = '%d:%s' % (phase, query_cursor or '')
+    return report
+
+def delete_sessions(keys):
+    """Delete the given sessions, their globals, and their copies in memcache.  Returns the
+    number of entities deleted and an estimate of the bytes they took up.
+
+    The sessions are read with one batch get, to add up their sizes, but their globals are
+    only ever handled by key.  The globals of all the sessions are found with one keys-only
+    query over the range of keys which the sessions span.  Session ids go up as sessions
+    are created, so old sessions mostly lie next to each other, and the few globals of
+    newer sessions within the range are skipped.
+    """
+    keys = sorted(keys)
+    if not keys:
+        return 0, 0
+    size = sum([session.stored_size() for session in db.get(keys) if session is not None])
+
+    doomed = set(keys)
+    globals = []
+    query = ShellGlobal.all(keys_only=True)
+    query.filter('__key__ >=', keys[0])
+    query.filter('__key__ <', db.Key.from_path(keys[-1].kind(), keys[-1].id() + 1))
+    while True:
+        found = query.fetch(GC_BATCH_SIZE)
+        globals.extend([key for key in found if key.parent() in doomed])
+        # There is no cursor once the last result has been fetched.
+        if len(found) < GC_BATCH_SIZE or not query.cursor():
+            break
+        query.with_cursor(query.cursor())
+
+    doomed = keys + globals
+    for start in range(0, len(doomed), GC_BATCH_SIZE):
+        db.delete(doomed[start:start + GC_BATCH_SIZE])
+
+    # Otherwise get_cached() could still find a session, and bring it back with its
+    # globals missing.
+    cached = [cache_key(key) for key in keys]
+    cached.extend([cache_key(key.parent(), key.name()) for key in globals])
+    memcache.delete_multi(cached)
+
+    return len(doomed), size
+
 if __name__ == "__main__":
     logging.error('I should be running unit tests')
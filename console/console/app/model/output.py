@@ -0,0 +1,165 @@
+# App Engine Console statement output
+#
+# Copyright 2008-2009 Proven Corporation Co., Ltd., Thailand
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Output of a running statement, which is sent to memcache a chunk at a time so that
+the browser can fetch it before the statement finishes.
+"""
+
+import logging
+
+from google.appengine.api import memcache
+
+# Chunks are only needed until the browser has fetched them.
+CHUNK_TIME = 600
+CHUNK_PREFIX = 'console_output:'
+
+# Output past the size limit is kept for longer, in case somebody asks to see it.
+PAGE_SIZE = 100 * 1024
+PAGE_TIME = 3600
+PAGE_PREFIX = 'console_overflow:'
+
+def chunk_key(key, number):
+    return '%s%s:%d' % (CHUNK_PREFIX, key, number)
+
+def page_key(key, number):
+    return '%s%s:%d' % (PAGE_PREFIX, key, number)
+
+def read_chunks(key, start, limit):
+    """Return the chunks of a stream from number start onward, at most limit of them.
+    Only chunks which have been sent, with none missing in between, are returned.
+    """
+    keys = [chunk_key(key, number) for number in range(start, start + limit)]
+    found = memcache.get_multi(keys)
+
+    chunks = []
+    for k in keys:
+        if k not in found:
+            break
+        chunks.append(found[k])
+    return chunks
+
+def read_page(key, number):
+    """Return a page of the output past a stream's size limit, or None if it has expired."""
+    return memcache.get(page_key(key, number))
+
+
+class OutputStream(object):
+    """A file-like object to collect a statement's stdout and stderr.  Once at least
+    chunk_size characters have been written, the complete lines are sent to memcache
+    as the next chunk, and forgotten.  Whatever has not been sent when the statement
+    finishes is returned by getvalue(), the same as for a StringIO.  With no chunk_size,
+    nothing is streamed.
+
+    Only the first limit characters are treated that way.  The rest of the output is
+    stored in memcache a page at a time, for the browser to fetch if it is wanted.
+    Call close() once the statement has finished, to store the last page.
+    """
+
+    def __init__(self, key, chunk_size=None, limit=None):
+        self.key = key
+        self.chunk_size = chunk_size
+        self.limit = limit
+        self.chunks = 0         # The number of chunks sent so far.
+        self.pages = 0          # The number of overflow pages stored so far.
+        self.size = 0           # The number of characters written altogether.
+        self.streaming = chunk_size is not None
+        self.softspace = 0
+        self.pending = []
+        self.pending_size = 0
+        self.overflow = []
+        self.overflow_size = 0
+
+    def truncated(self):
+        return self.limit is not None and self.size > self.limit
+    truncated = property(truncated)
+
+    def write(self, text):
+        if self.limit is not None and self.size + len(text) > self.limit:
+            room = max(self.limit - self.size, 0)
+            self.store_overflow(text[room:])
+            self.size += len(text)
+            text = text[:room]
+            if not text:
+                return
+        else:
+            self.size += len(text)
+
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.streaming and self.pending_size >= self.chunk_size:
+            self.send(complete_lines=True)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """Send everything written so far, so print-then-flush progress messages show
+        up straight away.
+        """
+        if self.streaming and self.pending_size:
+            self.send()
+
+    def send(self, complete_lines=False):
+        text = ''.join(self.pending)
+        rest = ''
+        if complete_lines:
+            end = text.rfind('\n') + 1
+            if end:
+                text, rest = text[:end], text[end:]
+
+        if memcache.set(chunk_key(self.key, self.chunks), text, CHUNK_TIME):
+            self.chunks += 1
+        else:
+            # The browser must get every chunk, in order.  So if one can not be sent, keep
+            # everything from here on to be returned with the statement's response instead.
+            logging.warning('Could not send output chunk %d of %s' % (self.chunks, self.key))
+            self.streaming = False
+            rest = text + rest
+
+        self.pending = [rest]
+        self.pending_size = len(rest)
+
+    def store_overflow(self, text):
+        self.overflow.append(text)
+        self.overflow_size += len(text)
+        if self.overflow_size >= PAGE_SIZE:
+            text = ''.join(self.overflow)
+            while len(text) >= PAGE_SIZE:
+                self.store_page(text[:PAGE_SIZE])
+                text = text[PAGE_SIZE:]
+            self.overflow = [text]
+            self.overflow_size = len(text)
+
+    def store_page(self, text):
+        if not memcache.set(page_key(self.key, self.pages), text, PAGE_TIME):
+            logging.warning('Could not store output page %d of %s' % (self.pages, self.key))
+        self.pages += 1
+
+    def close(self):
+        if self.overflow_size:
+            self.store_page(''.join(self.overflow))
+            self.overflow = []
+            self.overflow_size = 0
+
+    def getvalue(self):
+        return ''.join(self.pending)
+
+    def isatty(self):
+        return False
@@ -23,18 +23,72 @@ Interpreter state is stored in the datastore so that variables, function
 definitions, and other values in the global and local namespaces can be used
 across commands.
 
+Sessions created in incremental mode keep each picklable global in its own
+ShellGlobal child entity, so a statement only writes the globals it changed.
+
+Sessions are also written through to memcache, so that loading a session for
+a statement normally does not need a datastore read.
+
 TODO: unit tests!
 """
 
 import logging
-import pickle
+import cPickle as pickle
 import types
 
 from google.appengine.ext import db
+from google.appengine.api import memcache
 
 # The entity kind for shell sessions. Feel free to rename to suit your app.
 _SESSION_KIND = '_Console_Session'
 
+# Cached sessions and globals expire from memcache after this many seconds.
+_CACHE_TIME = 3600
+
+# Memcache key prefixes for cached sessions and the globals of incremental sessions.
+_SESSION_CACHE_PREFIX = 'console_session:'
+_GLOBAL_CACHE_PREFIX = 'console_global:'
+
+# Cached values must leave some room for memcache's own overhead.
+_MAX_CACHED_SIZE = memcache.MAX_VALUE_SIZE - 1024
+
+def cache_key(session_key, name=None):
+  """Returns the memcache key of a session, or of one of its globals.
+
+  Args:
+    session_key: the session's db.Key, or its string form
+    name: optional string, the name of the global
+
+  Returns:
+    string
+  """
+  if name is None:
+    return _SESSION_CACHE_PREFIX + str(session_key)
+  return '%s%s:%s' % (_GLOBAL_CACHE_PREFIX, session_key, name)
+
+
+def dumps(value):
+  """Pickles a global's value the way it is stored in a session.
+
+  Args:
+    value: any picklable value
+
+  Returns:
+    string, the pickled value
+  """
+  return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+class ShellGlobal(db.Model):
+  """A single pickled global of an incremental ShellSession.
+
+  The entity is a child of its session and its key name is the name of the
+  global. Keeping globals in their own entities means that a statement which
+  changes one global does not re-upload all of the others.
+  """
+  value = db.BlobProperty()
+
+
 class ShellSession(db.Model):
   """A shell session. Stores the session's globals.
 
@@ -55,15 +109,99 @@ class ShellSession(db.Model):
   added by unpicklable statements. When we pickle and store the globals after
   executing a statement, we skip the ones in unpicklable_names.
 
+  If the session is incremental, picklable globals are instead stored in
+  ShellGlobal child entities and only their names are kept in global_names,
+  with the size of each one's pickled value in the parallel global_sizes.
+  Changed globals are buffered in memory until persist() writes them together
+  with the session in a single batch put. Globals which are removed are simply
+  dropped from global_names; their stale child entities are ignored when
+  loading and are overwritten if the name is used again.
+
+  Every time the session is saved its version goes up by one, and the session
+  is written through to memcache together with its version. get_cached() only
+  reads the datastore if the session is not in memcache, if the cached copy is
+  older than the version the caller last saw, or if the caller has not seen
+  any version yet.
+
   Using Text instead of string is an optimization. We don't query on any of
   these properties, so they don't need to be indexed.
   """
   global_names = db.ListProperty(db.Text)
+  global_sizes = db.ListProperty(int, indexed=False)
   globals = db.ListProperty(db.Blob)
   unpicklable_names = db.ListProperty(db.Text)
   unpicklables = db.ListProperty(db.Text)
+  incremental = db.BooleanProperty(default=False)
+  version = db.IntegerProperty(default=0)
+
+  def __init__(self, *args, **kw):
+    db.Model.__init__(self, *args, **kw)
+    # Pickled globals which have not been written to the datastore yet, by name.
+    self._dirty_globals = {}
+
+  def _global_key(self, name):
+    """Returns the datastore key of the ShellGlobal entity for a name."""
+    return db.Key.from_path(ShellGlobal.kind(), name, parent=self.key())
+
+  def _global_cache_key(self, name):
+    """Returns the memcache key of the global with the given name."""
+    return cache_key(self.key(), name)
 
-  def set_global(self, name, value):
+  @classmethod
+  def get_cached(cls, key, version=None):
+    """Loads a session, from memcache if possible.
+
+    Args:
+      key: the session's db.Key, or its string form
+      version: optional integer, the lowest version of the session which
+        may be returned; older cached copies are ignored. If it is None, the
+        session is read from the datastore, since no cached copy is known to
+        be current.
+
+    Returns:
+      The session, or None if it does not exist.
+    """
+    if version is not None:
+      cached = memcache.get(cache_key(key))
+      if cached is not None:
+        cached_version, encoded = cached
+        if cached_version >= version:
+          return db.model_from_protobuf(encoded)
+
+    session = cls.get(key)
+    if session is not None:
+      session._cache([])
+    return session
+
+  def _cache(self, children):
+    """Writes the session and the given ShellGlobal entities to memcache.
+
+    Anything which cannot be cached is removed from memcache instead, so that
+    an older copy of it is never read back.
+    """
+    mapping = {}
+    stale = []
+
+    session_key = cache_key(self.key())
+    encoded = db.model_to_protobuf(self).Encode()
+    if len(encoded) <= _MAX_CACHED_SIZE:
+      mapping[session_key] = (self.version, encoded)
+    else:
+      stale.append(session_key)
+
+    for child in children:
+      global_key = self._global_cache_key(child.key().name())
+      if len(child.value) <= _MAX_CACHED_SIZE:
+        mapping[global_key] = child.value
+      else:
+        stale.append(global_key)
+
+    if mapping:
+      stale.extend(memcache.set_multi(mapping, time=_CACHE_TIME))
+    if stale:
+      memcache.delete_multi(stale)
+
+  def set_global(self, name, value, pickled=None):
     """Adds a global, or updates it if it already exists.
 
     Also removes the global from the list of unpicklable names.
@@ -71,10 +209,21 @@ class ShellSession(db.Model):
     Args:
       name: the name of the global to remove
       value: any picklable value
+      pickled: optional string, the value as already pickled by dumps()
     """
-    blob = db.Blob(pickle.dumps(value))
+    if pickled is None:
+      pickled = dumps(value)
+    blob = db.Blob(pickled)
 
-    if name in self.global_names:
+    if self.incremental:
+      self._pad_global_sizes()
+      if name not in self.global_names:
+        self.global_names.append(db.Text(name))
+        self.global_sizes.append(len(blob))
+      else:
+        self.global_sizes[self.global_names.index(name)] = len(blob)
+      self._dirty_globals[name] = blob
+    elif name in self.global_names:
       index = self.global_names.index(name)
       self.globals[index] = blob
     else:
@@ -92,13 +241,113 @@ class ShellSession(db.Model):
     if name in self.global_names:
       index = self.global_names.index(name)
       del self.global_names[index]
-      del self.globals[index]
+      if self.incremental:
+        self._pad_global_sizes()
+        del self.global_sizes[index]
+        self._dirty_globals.pop(name, None)
+      else:
+        del self.globals[index]
+
+  def _pad_global_sizes(self):
+    """Gives every global a size, for sessions saved before sizes were kept.
+
+    Their sizes are unknown, and counted as 0.
+    """
+    missing = len(self.global_names) - len(self.global_sizes)
+    if missing > 0:
+      self.global_sizes.extend([0] * missing)
+
+  def stored_size(self):
+    """Returns an estimate of the bytes the session takes up in the datastore.
+
+    This is the size of the encoded session entity, plus the sizes of the
+    pickled values of an incremental session's globals.
+    """
+    return len(db.model_to_protobuf(self).Encode()) + sum(self.global_sizes)
 
-  def globals_dict(self):
+  def global_blobs(self, names=None):
+    """Returns a dictionary of the pickled globals, keyed by name.
+
+    For incremental sessions, the globals which have not been changed in
+    memory are fetched from the datastore with one batch get.
+
+    Args:
+      names: optional collection of strings; if given, only the globals with
+        these names are returned.
+    """
+    if not self.incremental:
+      return dict((name, val)
+                  for name, val in zip(self.global_names, self.globals)
+                  if names is None or name in names)
+
+    blobs = {}
+    missing = []
+    for name in self.global_names:
+      if names is not None and name not in names:
+        continue
+      if name in self._dirty_globals:
+        blobs[name] = self._dirty_globals[name]
+      else:
+        missing.append(name)
+
+    if missing and self.is_saved():
+      cached = memcache.get_multi(
+          [self._global_cache_key(name) for name in missing])
+      uncached = []
+      for name in missing:
+        blob = cached.get(self._global_cache_key(name))
+        if blob is None:
+          uncached.append(name)
+        else:
+          blobs[name] = blob
+
+      if uncached:
+        stored = db.get([self._global_key(name) for name in uncached])
+        for name, entity in zip(uncached, stored):
+          if entity is not None:
+            blobs[name] = entity.value
+
+    return blobs
+
+  def globals_dict(self, names=None):
     """Returns a dictionary view of the globals.
+
+    Only the requested globals are unpickled; the rest stay as pickled blobs
+    and are not touched.
+
+    Args:
+      names: optional collection of strings; if given, only the globals with
+        these names are returned.
     """
     return dict((name, pickle.loads(val))
-                for name, val in zip(self.global_names, self.globals))
+                for name, val in self.global_blobs(names).items())
+
+  def persist(self):
+    """Writes the session, and any changed globals, to the datastore.
+
+    For incremental sessions, the session and all of its changed ShellGlobal
+    entities are written with a single batch put. (A session which has never
+    been saved needs one extra put first, to get a key for its children.)
+    Everything written is also written through to memcache.
+
+    Returns:
+      The key of the session.
+    """
+    self.version += 1
+    children = []
+    if not self.incremental or not self._dirty_globals:
+      self.put()
+    else:
+      if not self.is_saved():
+        self.put()
+
+      children = [ShellGlobal(parent=self, key_name=name, value=blob)
+                  for name, blob in self._dirty_globals.items()]
+      db.put([self] + children)
+      self._dirty_globals = {}
+
+    self._cache(children)
+    return self.key()
 
   def add_unpicklable(self, statement, names):
     """Adds a statement and list of names to the unpicklables.
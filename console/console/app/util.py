@@ -62,3 +62,82 @@ def trim(docstring):
         trimmed.pop(0)
     # Return a single string:
     return '\n'.join(trimmed)
+
+class LRUCache(object):
+    """A dictionary-like cache which discards its least recently used items once their
+    total size goes over max_size.  Every item has a size of 1 unless a sizeof function
+    is given (for example len, to keep a budget of bytes).
+    """
+
+    # Indexes into a link of the circular list which keeps the items in order of use.
+    PREV, NEXT, KEY, VALUE, SIZE = range(5)
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0]
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+    def _append(self, link):
+        last = self.root[self.PREV]
+        link[self.PREV], link[self.NEXT] = last, self.root
+        last[self.NEXT] = self.root[self.PREV] = link
+
+    def get(self, key, default=None):
+        """Return the value for key, marking it as the most recently used, or default."""
+        link = self.links.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[self.VALUE]
+
+    def __getitem__(self, key):
+        if key not in self.links:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return      # Too big to ever fit; don't flush everything else for it.
+
+        link = [None, None, key, value, size]
+        self._append(link)
+        self.links[key] = link
+        self.size += size
+
+        while self.size > self.max_size:
+            self.pop(self.root[self.NEXT][self.KEY])
+
+    def pop(self, key, default=None):
+        """Remove key and return its value, or default if it is not cached."""
+        link = self.links.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        self.size -= link[self.SIZE]
+        return link[self.VALUE]
+
+    def __delitem__(self, key):
+        if key not in self.links:
+            raise KeyError(key)
+        self.pop(key)
+
+    def clear(self):
+        self.links.clear()
+        self.root[:] = [self.root, self.root, None, None, 0]
+        self.size = 0
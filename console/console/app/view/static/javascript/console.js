@@ -22,12 +22,18 @@
 
 var promptType = 'ps1';
 
+/* The version of the session as of the last statement, sent back with the next one. */
+var sessionVersion = null;
+
 var hist = {
     'buffer'  : [],
     'position': -1,
     'pending' : ''
 };
 
+/* Milliseconds between fetches of the output of a running statement. */
+var OUTPUT_POLL_INTERVAL = 1000;
+
 /* Change this to false to use alert popups for Safari logging. */
 var SILENT_ALERTS = true;
 
@@ -108,14 +114,31 @@ var statementSubmit = function(event) {
             ? 1
             : 0;
 
+        // The output of a long-running statement is fetched from this stream while it runs.
+        var stream = {
+            'id'       : new Date().getTime() + '-' + uid(),
+            'session'  : $('#setting_session').val(),
+            'highlight': highlight,
+            'received' : 0,
+            'busy'     : false,
+            'retries'  : 0,
+            'next'     : null
+        };
+
         var values = {
             'session'  : $('#setting_session').val(),
             'highlight': highlight,
+            'stream'   : stream.id,
             'code'     : statement
         };
+        if(sessionVersion != null)
+            values['version'] = sessionVersion;
+
+        var streamTimer = setInterval(function() { fetchOutput(stream); }, OUTPUT_POLL_INTERVAL);
 
         var returnedStatement = function(response, textStatus) {
             // Handle the response returned from Python on the server.
+            clearInterval(streamTimer);
             switch(textStatus) {
                 case 'timeout':
                 case 'error':
@@ -126,23 +149,27 @@ var statementSubmit = function(event) {
                     break;
             }
 
+            // Any streamed output which has not been fetched yet comes before the rest of it.
+            if(stream.received < response.chunks) {
+                if(stream.retries++ < 5) {
+                    fetchOutput(stream, function() { returnedStatement(response, textStatus); });
+                    return;
+                }
+                console.error('Lost output chunks %d to %d', stream.received, response.chunks);
+            }
+
+            // Remember the session version, so the server never uses an older cached copy.
+            if(response.version != null)
+                sessionVersion = response.version;
+
             // Replace the old temporarary code with the server's version.
             statementContainer.html(response['in']);
             if(highlight)
                 statementContainer.addClass('pygments').removeClass('plain');
 
-            // Append the server output.  For non-highlighting mode, the response is manually appended inside
-            // the PRE tag to fix a rendering bug with IE.
-            var output;
-            if(highlight)
-                output = $('<div>').addClass('pygments').append(response.out);
-            else
-                output = $('<pre>' + response.out + '</pre>');
-
-            output.addClass('output');
-            $('#console_output').append(output);
-
-            scrollOutput();
+            appendOutput(response.out, highlight);
+            if(response.truncated)
+                appendTruncated(response.truncated, stream.session);
 
             if(response.result != null)
                 showPrompt(response.result);
@@ -157,6 +184,87 @@ var statementSubmit = function(event) {
     }
 };
 
+/* Append some output from the server to the console. */
+var appendOutput = function(out, highlight) {
+    // For non-highlighting mode, the response is manually appended inside the PRE tag to
+    // fix a rendering bug with IE.
+    var output;
+    if(highlight)
+        output = $('<div>').addClass('pygments').append(out);
+    else
+        output = $('<pre>' + out + '</pre>');
+
+    output.addClass('output');
+    $('#console_output').append(output);
+
+    scrollOutput();
+};
+
+/* Show that a statement's output was cut off, with a link to fetch the rest a page at a time. */
+var appendTruncated = function(truncated, session) {
+    var page = 0;
+    var message = $('<span>').text('Output truncated (' + truncated.size + ' characters altogether). ');
+    var more = $('<a href="#">Show more</a>');
+    var notice = $('<div>').addClass('truncated').append(message).append(more);
+
+    var gotPage = function(response) {
+        if(response.text == null) {
+            message.text('The rest of the output has expired.');
+            more.hide();
+            return;
+        }
+        notice.before($('<pre>').addClass('output').text(response.text));
+        page = response.page + 1;
+        if(page >= truncated.pages)
+            more.hide();
+    };
+
+    more.click(function(event) {
+        event.preventDefault();
+        var values = {'session': session, 'stream': truncated.stream, 'page': page};
+        $.get('/console/output', values, gotPage, 'json');
+    });
+
+    $('#console_output').append(notice);
+    scrollOutput();
+};
+
+/* Fetch and show the chunks of a statement's output which were streamed since the last fetch.
+ * Only one fetch for a stream runs at a time; "then" is called once it is done. */
+var fetchOutput = function(stream, then) {
+    if(then)
+        stream.next = then;
+    if(stream.busy)
+        return;
+    stream.busy = true;
+
+    var values = {
+        'session'  : stream.session,
+        'stream'   : stream.id,
+        'start'    : stream.received,
+        'highlight': stream.highlight
+    };
+
+    var gotOutput = function(response) {
+        if(response.start != stream.received)
+            return;
+        for(var i = 0; i < response.chunks.length; i++)
+            appendOutput(response.chunks[i], stream.highlight);
+        stream.received += response.chunks.length;
+    };
+
+    var done = function() {
+        stream.busy = false;
+        var next = stream.next;
+        stream.next = null;
+        if(next)
+            next();
+    };
+
+    $.ajax({'url': '/console/output', 'data': values, 'dataType': 'json',
+            'success': gotOutput, 'complete': done});
+};
+
 var statementKeyUp = function(event) {
     var orig = event.originalEvent;
     var key = event.charCode || event.keyCode || 0;
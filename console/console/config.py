@@ -33,7 +33,43 @@ python_doc_linking = True
 # copy, you can set this to use your own version instead.
 python_doc = 'http://docs.python.org'
 
+# The location of the App Engine Python documentation, used to link to it the same way.
+appengine_doc = 'http://code.google.com/appengine/docs/python'
+
+# Extra documentation links, as a list of (pattern, url) pairs.  The pattern is a regular
+# expression matched against a statement's output, with a group called "name" for the
+# text to link.  The url may use the pattern's named groups and the two settings above,
+# for example:
+#   doc_links = [(r"^<class '(?P<name>myapp\.models\.(?P<model>\w+))'>$",
+#                 'http://wiki.example.com/models/%(model)s')]
+doc_links = []
+
+# Set this to True to show the output of a long-running statement while it runs.  The
+# output is sent to the browser through memcache, in chunks of at least this many
+# characters (or whenever the statement flushes sys.stdout).
+stream_output = True
+output_chunk_size = 4096
+
+# A statement's output is cut off after this many characters, and is not highlighted.
+# The rest of it can still be shown a page at a time, for an hour or so.  Set this to
+# None for no limit.
+max_output_size = 256 * 1024
+
 # If your own app uses Django, this variable ensures that both the console and the
 # main app will use the same version. If None, no version forcing will be done,
 # otherwise, currently supported version are (0, 96), (1, 0), and (1, 1).
 django_version = (1, 1)
+
+# Set this to True to store each variable of a new console session in its own
+# datastore entity. Only the variables which a statement changes are written,
+# which is much faster for sessions holding large values. Existing sessions
+# keep the storage mode they were created with.
+incremental_sessions = True
+
+# Console sessions which have not been used for this many days are deleted by the
+# garbage collector, which runs from cron.yaml.
+session_max_age_days = 30
+
+# Sessions created by older versions of the console have no last-used time, so their
+# age is unknown. Set this to True to have the garbage collector delete all of them.
+collect_never_used_sessions = False
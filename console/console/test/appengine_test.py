@@ -27,6 +27,7 @@ import test_environment
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import datastore_file_stub
 from google.appengine.api import mail_stub
+from google.appengine.api.memcache import memcache_stub
 from google.appengine.api import urlfetch_stub
 from google.appengine.api import user_service_stub
 #from google3.apphosting.api import urlfetch_stub
@@ -55,8 +56,7 @@ class AppEngineTest(unittest.TestCase):
         apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
 
         # Use a fresh stub datastore.
-        stub = datastore_file_stub.DatastoreFileStub(APP_ID, '/dev/null', '/dev/null')
-        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', self.datastore_stub())
 
         # Use a fresh stub UserService.
         apiproxy_stub_map.apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
@@ -67,4 +67,11 @@ class AppEngineTest(unittest.TestCase):
         # Use a fresh mail stub.
         apiproxy_stub_map.apiproxy.RegisterStub('mail', mail_stub.MailServiceStub()) 
 
+        # Use a fresh memcache stub.
+        apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+
+    def datastore_stub(self):
+        """Return the datastore stub to test with.  Tests of another stub override this."""
+        return datastore_file_stub.DatastoreFileStub(APP_ID, '/dev/null', '/dev/null')
+
 initialSetup()
@@ -19,16 +19,22 @@
 # along with App Engine Console; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import os
 import sys
+import datetime
 import unittest
 import test_environment
 
 from appengine_test import AppEngineTest
 from console.app import model
 
+from google.appengine.ext import db
+from google.appengine.api import memcache
+
 class AppEngineConsoleTestCase(AppEngineTest):
     def setUp(self):
         AppEngineTest.setUp(self)
+        model.console.snapshots.clear()
         self.engine = model.AppEngineConsole()
 
     def assertOutput(self, str, msg=''):
@@ -88,9 +94,314 @@ class AppEngineConsoleTestCase(AppEngineTest):
         self.engine.runsource('print a.y')
         self.assertOutput('12')
 
+    def testGlobalsSurviveReloading(self):
+        self.engine.runsource('foo = [1, 2]')
+        self.engine.runsource('bar = "baz"')
+
+        self.engine = model.AppEngineConsole.get(self.engine.key())
+        self.engine.runsource('foo, bar')
+        self.assertOutput("([1, 2], 'baz')")
+
+    def testOnlyReferencedGlobalsAreUnpickled(self):
+        self.engine.runsource('foo = 1')
+        self.engine.runsource('bar = 2')
+        self.assertEqual(self.engine.globals_dict(['bar']), {'bar': 2})
+
+        self.engine.runsource("'foo' in dir()")
+        self.assertOutput('True')
+
+    def testFunctionsSeeGlobalsTheyReference(self):
+        self.engine.runsource('def f():')
+        self.engine.runsource(' return x * 2')
+        self.engine.runsource('')
+
+        self.engine.runsource('x = 21')
+        self.engine.runsource('f()')
+        self.assertOutput('42')
+
+    def testIntrospectionSeesAllGlobals(self):
+        self.engine.runsource('foo = 1')
+        self.engine.runsource("'foo' in globals()")
+        self.assertOutput('True')
+
+        self.engine.runsource("exec 'print foo'")
+        self.assertOutput('1')
+
+    def testMainModuleSeesAllGlobals(self):
+        self.engine.runsource('import sys')
+        self.engine.runsource('foo = 1')
+        self.engine.runsource("sys.modules['__main__'].__dict__.get('foo')")
+        self.assertOutput('1')
+
+    def testDeletedGlobalsAreForgotten(self):
+        self.engine.runsource('foo = 1')
+        self.engine.runsource('del foo')
+        self.engine.runsource('foo')
+        self.assertEqual(self.engine.exc_type, NameError)
+        self.assertEqual(list(self.engine.global_names), [])
+
+    def testStatementsAreTimed(self):
+        self.engine.runsource('foo = 1')
+        self.assertEqual(sorted(self.engine.timings.keys()), ['exec', 'persist', 'snapshot'])
+
+    def testRebindingAnEqualValueIsNotAChange(self):
+        before = {'foo': tuple(['a', 1]), 'bar': [1]}
+        tracker = model.console.ChangeTracker(before, {}, None)
+
+        after = {'foo': tuple(['a', 1]), 'bar': before['bar']}
+        self.assertEqual(tracker.changes(after), ({}, []))
+
+        after['bar'].append(2)
+        del after['foo']
+        changed, removed = tracker.changes(after)
+        self.assertEqual(changed.keys(), ['bar'])
+        self.assertEqual(removed, ['foo'])
+
+    def testUnpicklablesAreOnlyReplayedWhenNotCached(self):
+        self.engine.put()
+        self.engine.runsource('import os; os.environ["replays"] = str(int(os.environ.get("replays", 0)) + 1)')
+        try:
+            self.engine.runsource('1')  # Replays the import into a new snapshot.
+            self.engine.runsource('2')
+            self.engine.runsource('os.environ["replays"]')
+            self.assertOutput("'2'")
+
+            model.console.snapshots.clear()
+            self.engine.runsource('os.environ["replays"]')
+            self.assertOutput("'3'")
+        finally:
+            del os.environ['replays']
+
+    def testSessionsAreReadFromMemcache(self):
+        self.engine.runsource('foo = 23')
+        key = self.engine.key()
+
+        # Change the datastore copy behind memcache's back.
+        stored = model.AppEngineConsole.get(key)
+        stored.pending_source = 'changed'
+        stored.put()
+
+        cached = model.AppEngineConsole.get_cached(key, self.engine.version)
+        self.assertEqual(cached.pending_source, '')
+        self.assertEqual(cached.version, self.engine.version)
+
+        self.engine = cached
+        self.engine.runsource('foo')
+        self.assertOutput('23')
+
+    def testOutdatedCachedSessionsAreIgnored(self):
+        self.engine.runsource('foo = 23')
+        version = self.engine.version
+
+        stored = model.AppEngineConsole.get(self.engine.key())
+        stored.pending_source = 'changed'
+        stored.version = version + 1
+        stored.put()
+
+        fetched = model.AppEngineConsole.get_cached(self.engine.key(), version + 1)
+        self.assertEqual(fetched.pending_source, 'changed')
+
+    def testSessionsWithoutAVersionAreReadFromTheDatastore(self):
+        self.engine.runsource('foo = 23')
+
+        stored = model.AppEngineConsole.get(self.engine.key())
+        stored.pending_source = 'changed'
+        stored.put()
+
+        fetched = model.AppEngineConsole.get_cached(self.engine.key())
+        self.assertEqual(fetched.pending_source, 'changed')
+
+class IncrementalConsoleTestCase(AppEngineConsoleTestCase):
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        model.console.snapshots.clear()
+        self.engine = model.AppEngineConsole(incremental=True)
+
+    def testGlobalsAreStoredOutsideTheSession(self):
+        self.engine.runsource('foo = 23')
+        self.assertEqual(self.engine.global_names, ['foo'])
+        self.assertEqual(self.engine.globals, [])
+
+    def testOnlyChangedGlobalsAreWritten(self):
+        self.engine.runsource('foo = 23')
+        self.engine.runsource('bar = [1]')
+
+        written = []
+        real_put = db.put
+        def put(models):
+            written.append(models)
+            return real_put(models)
+
+        db.put = put
+        try:
+            self.engine.runsource('bar.append(2)')
+        finally:
+            db.put = real_put
+
+        self.assertEqual(len(written), 1)
+        names = [m.key().name() for m in written[0] if m.kind() == 'ShellGlobal']
+        self.assertEqual(names, ['bar'])
+
+    def testGlobalSizesAreKept(self):
+        self.engine.runsource('foo = 23')
+        self.engine.runsource('bar = "x" * 1000')
+        self.engine.runsource('del foo')
+        self.assertEqual(self.engine.global_names, ['bar'])
+        self.assertEqual(self.engine.global_sizes,
+                         [len(self.engine.global_blobs(['bar'])['bar'])])
+        self.failUnless(self.engine.stored_size() > 1000)
+
+class GarbageCollectionTestCase(AppEngineTest):
+    def makeSession(self, days_old, incremental=False):
+        engine = model.AppEngineConsole(incremental=incremental)
+        engine.runsource('foo = "x" * 100')
+        engine.last_used = datetime.datetime.now() - datetime.timedelta(days=days_old)
+        engine.put()
+        return engine
+
+    def testOldSessionsAreDeleted(self):
+        old = self.makeSession(10)
+        new = self.makeSession(1)
+        report = model.collect_garbage(datetime.timedelta(days=5))
+
+        self.assertEqual(report['sessions'], 1)
+        self.assertEqual(report['entities'], 1)
+        self.assertEqual(report['cursor'], None)
+        self.assertEqual(model.AppEngineConsole.get(old.key()), None)
+        self.assertNotEqual(model.AppEngineConsole.get(new.key()), None)
+
+    def testGlobalsAreDeletedWithTheirSession(self):
+        old = self.makeSession(10, incremental=True)
+        report = model.collect_garbage(datetime.timedelta(days=5))
+        self.assertEqual(report['entities'], 2)
+        self.assertEqual(db.Query(keys_only=True).ancestor(old.key()).fetch(10), [])
+
+    def testGlobalsAreFoundInBatches(self):
+        old = self.makeSession(10, incremental=True)
+        old.runsource('a, b, c, d, e = range(5)')
+        old.last_used = datetime.datetime.now() - datetime.timedelta(days=10)
+        old.put()
+
+        batch_size = model.console.GC_BATCH_SIZE
+        model.console.GC_BATCH_SIZE = 2
+        try:
+            report = model.collect_garbage(datetime.timedelta(days=5))
+        finally:
+            model.console.GC_BATCH_SIZE = batch_size
+        self.assertEqual(report['entities'], 7)
+        self.assertEqual(db.Query(keys_only=True).ancestor(old.key()).fetch(10), [])
+
+    def testReclaimedBytesAreEstimated(self):
+        sessions = [self.makeSession(10), self.makeSession(10, incremental=True)]
+        report = model.collect_garbage(datetime.timedelta(days=5))
+        self.assertEqual(report['bytes'], sum([s.stored_size() for s in sessions]))
+        self.failUnless(report['bytes'] > 200)
+
+    def testCollectedSessionsAreRemovedFromMemcache(self):
+        old = self.makeSession(10, incremental=True)
+        cached = [model.console.cache_key(old.key()), model.console.cache_key(old.key(), 'foo')]
+        self.assertEqual(len(memcache.get_multi(cached)), 2)
+
+        model.collect_garbage(datetime.timedelta(days=5))
+        self.assertEqual(memcache.get_multi(cached), {})
+        self.assertEqual(model.AppEngineConsole.get_cached(old.key(), old.version), None)
+
+    def testGlobalsOfNewerSessionsBetweenOldOnesAreKept(self):
+        first = self.makeSession(10, incremental=True)
+        new = self.makeSession(1, incremental=True)
+        last = self.makeSession(10, incremental=True)
+        self.failUnless(first.key() < new.key() < last.key())
+
+        report = model.collect_garbage(datetime.timedelta(days=5))
+        self.assertEqual(report['entities'], 4)
+        for old in (first, last):
+            self.assertEqual(db.Query(keys_only=True).ancestor(old.key()).fetch(10), [])
+        self.assertEqual(len(db.Query(keys_only=True).ancestor(new.key()).fetch(10)), 2)
+
+    def testNeverUsedSessionsAreOnlyDeletedOnRequest(self):
+        old = self.makeSession(10)
+        old.last_used = None
+        old.put()
+
+        report = model.collect_garbage(datetime.timedelta(days=5))
+        self.assertEqual(report['sessions'], 0)
+        self.assertNotEqual(model.AppEngineConsole.get(old.key()), None)
+
+        report = model.collect_garbage(datetime.timedelta(days=5), never_used=True)
+        self.assertEqual(report['sessions'], 1)
+        self.assertEqual(model.AppEngineConsole.get(old.key()), None)
+
+    def testCollectionResumesFromCursor(self):
+        for i in range(3):
+            self.makeSession(10)
+
+        report = model.collect_garbage(datetime.timedelta(days=5), limit=2)
+        self.assertEqual(report['sessions'], 2)
+        self.assertNotEqual(report['cursor'], None)
+
+        report = model.collect_garbage(datetime.timedelta(days=5), report['cursor'])
+        self.assertEqual(report['sessions'], 1)
+        self.assertEqual(report['cursor'], None)
+
+class OutputStreamTestCase(AppEngineTest):
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.engine = model.AppEngineConsole()
+        self.stream = model.OutputStream('test', 10)
+
+    def testLongOutputIsStreamedInChunks(self):
+        self.engine.runsource('for i in range(6): print "line %d" % i')
+        self.engine.runsource('', self.stream)
+        chunks = model.read_chunks('test', 0, 10)
+
+        self.assertEqual(self.stream.chunks, len(chunks))
+        self.assert_(len(chunks) > 1)
+        self.assertEqual(''.join(chunks) + self.engine.out,
+                         ''.join(['line %d\n' % i for i in range(6)]))
+        self.assert_(chunks[0].endswith('\n'))
+
+    def testShortOutputIsNotStreamed(self):
+        self.engine.runsource('print "hi"', self.stream)
+        self.assertEqual(self.stream.chunks, 0)
+        self.assertEqual(self.engine.out, 'hi\n')
+
+    def testFlushingSendsAChunk(self):
+        self.engine.runsource('import sys; print "hi"; sys.stdout.flush()', self.stream)
+        self.assertEqual(model.read_chunks('test', 0, 10), ['hi\n'])
+        self.assertEqual(self.engine.out, '')
+
+    def testChunksAreReadFromStart(self):
+        self.engine.runsource('for i in range(6): print "line %d" % i')
+        self.engine.runsource('', self.stream)
+        self.assertEqual(model.read_chunks('test', 1, 10), model.read_chunks('test', 0, 10)[1:])
+
+    def testOutputPastTheLimitIsStoredInPages(self):
+        stream = model.OutputStream('test', limit=5)
+        self.engine.runsource('print "x" * 10 + "y" * %d' % model.output.PAGE_SIZE, stream)
+        stream.close()
+
+        self.assert_(stream.truncated)
+        self.assertEqual(self.engine.out, 'xxxxx')
+        self.assertEqual(stream.size, 11 + model.output.PAGE_SIZE)
+        self.assertEqual(stream.pages, 2)
+        self.assertEqual(model.read_page('test', 0), 'xxxxx' + 'y' * (model.output.PAGE_SIZE - 5))
+        self.assertEqual(model.read_page('test', 1), 'yyyyy\n')
+        self.assertEqual(model.read_page('test', 2), None)
+
+    def testOutputWithinTheLimitIsNotTruncated(self):
+        stream = model.OutputStream('test', limit=5)
+        self.engine.runsource('print "1234"', stream)
+        stream.close()
+        self.failIf(stream.truncated)
+        self.assertEqual(stream.pages, 0)
+        self.assertEqual(self.engine.out, '1234\n')
+
 def suite():
     s = unittest.TestSuite()
     s.addTest( unittest.makeSuite(AppEngineConsoleTestCase, 'test') )
+    s.addTest( unittest.makeSuite(IncrementalConsoleTestCase, 'test') )
+    s.addTest( unittest.makeSuite(GarbageCollectionTestCase, 'test') )
+    s.addTest( unittest.makeSuite(OutputStreamTestCase, 'test') )
     return s
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+# controller.py - Unit tests for the controller module
+#
+# Copyright 2008-2009 Proven Corporation Co., Ltd., Thailand
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import unittest
+import test_environment
+
+from appengine_test import AppEngineTest
+from console.app.controller import console as controller
+from console.app import doclink
+
+import pygments
+
+class HighlightTestCase(AppEngineTest):
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        controller.highlight_cache.clear()
+        self.lexer = controller.Statement.lexer
+        self.formatter = controller.Statement.inputFormatter
+
+    def testHighlightingMatchesPygments(self):
+        html = controller.highlight('print 1', self.lexer, self.formatter)
+        self.assertEqual(html, pygments.highlight('print 1', self.lexer, self.formatter))
+
+    def testHighlightingIsCached(self):
+        html = controller.highlight('print 1', self.lexer, self.formatter)
+        self.assert_(controller.highlight('print 1', self.lexer, self.formatter) is html)
+        self.assertEqual(controller.highlight_cache.size, len(html.encode('utf-8')))
+
+        other = controller.highlight('print 1', self.lexer, controller.Statement.outputFormatter)
+        self.assertNotEqual(other, html)
+
+    def testCacheIsSizedInBytes(self):
+        html = controller.highlight(u"print u'\u0e01\u0e02'", self.lexer, self.formatter)
+        self.assert_(isinstance(html, unicode))
+        self.assertEqual(controller.highlight_cache.size, len(html) + 4)
+
+    def testHelpExamplesAreHighlighted(self):
+        self.assertEqual(len(controller.Help.highlighted['usage']), 2)
+        self.assertEqual(len(controller.Help.highlighted['integration']), 2)
+        for example in controller.Help.highlighted['usage']:
+            self.assert_(example.startswith('<div class="stdout">'))
+
+class DocLinkTestCase(AppEngineTest):
+    def testTypesAreLinked(self):
+        html = doclink.linker.link("<type 'dict'>", "&lt;type &#39;dict&#39;&gt;")
+        self.assertEqual(html, '&lt;type &#39;<a href="http://docs.python.org/library/stdtypes.html'
+                               '#mapping-types-dict">dict</a>&#39;&gt;')
+
+    def testModulesAreLinked(self):
+        html = doclink.linker.link("<module 'sys' (built-in)>", "&lt;module &#39;sys&#39; (built-in)&gt;")
+        self.assert_('<a href="http://docs.python.org/library/sys.html">module &#39;sys&#39;</a>' in html)
+
+    def testExceptionsAreLinked(self):
+        html = doclink.linker.link('NameError: oops', 'NameError: oops', NameError)
+        self.assert_(html.startswith('<a href="http://docs.python.org/library/exceptions.html'
+                                     '#exceptions.NameError">NameError</a>'))
+
+    def testUnknownOutputIsUnchanged(self):
+        self.assertEqual(doclink.linker.link('hello', 'hello'), 'hello')
+
+    def testRulesCanBeAdded(self):
+        linker = doclink.DocLinker()
+        linker.add(r"^(?P<name>Model(?P<number>\d))$", 'http://example.com/%(number)s')
+        linker.add(r"^(?P<name>Other)$", 'http://example.com/other')
+        self.assertEqual(linker.link('Model7', 'Model7'), '<a href="http://example.com/7">Model7</a>')
+        self.assertEqual(linker.link('Other', 'Other'), '<a href="http://example.com/other">Other</a>')
+        self.assertRaises(ValueError, linker.add, r'^nameless$', 'http://example.com/')
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTest( unittest.makeSuite(HighlightTestCase, 'test') )
+    s.addTest( unittest.makeSuite(DocLinkTestCase, 'test') )
+    return s
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,1226 @@
+#!/usr/bin/env python
+#
+# datastore.py - Unit tests for queries in the datastore stub
+#
+# Copyright 2008-2009 Proven Corporation Co., Ltd., Thailand
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import random
+import logging
+import datetime
+import tempfile
+import cPickle as pickle
+import threading
+import unittest
+import test_environment
+
+from appengine_test import AppEngineTest, APP_ID
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import datastore_admin
+from google.appengine.api import datastore_errors
+from google.appengine.api import datastore_file_stub
+from google.appengine.api import datastore_sqlite_stub
+from google.appengine.api import datastore_types
+from google.appengine.api import users
+from google.appengine.api.datastore_file_stub import DatastoreFileStub
+from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_pb
+
+ASCENDING = datastore.Query.ASCENDING
+DESCENDING = datastore.Query.DESCENDING
+
+def reference_compare(orders):
+    """Return the comparison function which the stub used to sort query results with,
+    before it sorted them by precomputed keys.  The stub's order must match it exactly.
+    """
+    def compare_properties(x, y):
+        if isinstance(x, datetime.datetime):
+            x = datastore_types.DatetimeToTimestamp(x)
+        if isinstance(y, datetime.datetime):
+            y = datastore_types.DatetimeToTimestamp(y)
+
+        x_type = DatastoreFileStub._PROPERTY_TYPE_TAGS.get(x.__class__)
+        y_type = DatastoreFileStub._PROPERTY_TYPE_TAGS.get(y.__class__)
+
+        if x_type == y_type:
+            try:
+                return cmp(x, y)
+            except TypeError:
+                return 0
+        else:
+            return cmp(x_type, y_type)
+
+    def compare_entities(a, b):
+        for prop, direction in orders:
+            reverse = (direction is DESCENDING)
+            a_val = datastore._GetPropertyValue(a, prop)
+            if isinstance(a_val, list):
+                a_val = sorted(a_val, compare_properties, reverse=reverse)[0]
+            b_val = datastore._GetPropertyValue(b, prop)
+            if isinstance(b_val, list):
+                b_val = sorted(b_val, compare_properties, reverse=reverse)[0]
+
+            result = compare_properties(a_val, b_val)
+            if direction is DESCENDING:
+                result = -result
+            if result:
+                return result
+
+        return cmp(a.key(), b.key())
+
+    return compare_entities
+
+def reference_passes_filter(entity, prop, op, filter_values):
+    """Return whether an entity passes a filter, the way the stub decided it before it
+    compared values directly: by eval()ing the reprs of the values, or of their type tags
+    if the types differ.  op is one of '<', '<=', '>', '>=' and '=='.
+    """
+    tags = DatastoreFileStub._PROPERTY_TYPE_TAGS
+    if prop not in datastore_types._SPECIAL_PROPERTIES:
+        if prop in entity.unindexed_properties():
+            return False
+        values = entity.get(prop, [])
+        if not isinstance(values, list):
+            values = [values]
+        if not [v for v in values if type(v) not in datastore_types._RAW_PROPERTY_TYPES]:
+            return False
+
+    entity_values = datastore._GetPropertyValue(entity, prop)
+    if not isinstance(entity_values, list):
+        entity_values = [entity_values]
+
+    for entity_value in entity_values:
+        for filter_value in filter_values:
+            entity_type = tags.get(entity_value.__class__)
+            filter_type = tags.get(filter_value.__class__)
+            if entity_type == filter_type:
+                comp = u'%r %s %r' % (entity_value, op, filter_value)
+            elif op != '==':
+                comp = '%r %s %r' % (entity_type, op, filter_type)
+            else:
+                continue
+            try:
+                ret = eval(comp)
+                if ret and ret != NotImplementedError:
+                    return True
+            except TypeError:
+                pass
+    return False
+
+class RandomEntitiesTest(AppEngineTest):
+    """Stores random entities of kind Thing, whose properties a, b and c hold values of
+    mixed types, some of them lists.
+    """
+
+    ENTITIES = 150
+
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.random = random.Random(14)
+        self.entities = []
+        for i in range(self.ENTITIES):
+            entity = datastore.Entity('Thing')
+            for prop in ('a', 'b', 'c'):
+                value = self.randomValue()
+                if value is not None:
+                    entity[prop] = value
+            datastore.Put(entity)
+            self.entities.append(entity)
+
+    def randomScalar(self):
+        choice = self.random.randint(0, 7)
+        if choice == 0:
+            return self.random.randint(-5, 5)
+        elif choice == 1:
+            return self.random.choice([-1.5, 0.0, 2.25, 3.0])
+        elif choice == 2:
+            return self.random.choice([u'', u'x', u'y', u'xy'])
+        elif choice == 3:
+            return self.random.choice([True, False])
+        elif choice == 4:
+            return datetime.datetime(2009, 1, self.random.randint(1, 5))
+        elif choice == 5:
+            return users.User('user%d@example.com' % self.random.randint(0, 2))
+        elif choice == 6:
+            return None
+        else:
+            return self.random.randint(0, 2)
+
+    def randomValue(self):
+        """Return a value for a property, or None to leave the property out."""
+        choice = self.random.randint(0, 9)
+        if choice == 0:
+            return None
+        elif choice < 3:
+            return [self.randomScalar() for i in range(self.random.randint(2, 4))]
+        return self.randomScalar()
+
+    def indexed(self, filters, orders=[], kind='Thing'):
+        query = datastore.Query(kind, filters)
+        query.Order(*orders)
+        keys = [e.key() for e in query.Run()]
+        if not orders:
+            keys.sort()
+        return keys
+
+    def scan(self, filters, orders=[], kind='Thing'):
+        """Run a query without the indexes, by filtering every entity of the kind."""
+        stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        stub._DatastoreFileStub__IndexedCandidates = lambda *args: None
+        try:
+            return self.indexed(filters, orders, kind)
+        finally:
+            del stub._DatastoreFileStub__IndexedCandidates
+
+
+class QueryOrderTestCase(RandomEntitiesTest):
+    """Random entities are stored and queried in random orders, and the results are
+    compared to a sort of the same entities with the reference comparison function.
+    """
+
+    QUERIES = 40
+
+    def randomOrders(self):
+        props = ['a', 'b', 'c']
+        self.random.shuffle(props)
+        return [(prop, self.random.choice([ASCENDING, DESCENDING]))
+                for prop in props[:self.random.randint(1, 3)]]
+
+    def expected(self, orders):
+        """Return the keys of every entity which has all of the order properties, in the
+        reference order.
+        """
+        candidates = [datastore.Get(e.key()) for e in self.entities]
+        candidates = [e for e in candidates if [p for p, d in orders if p not in e] == []]
+        candidates.sort(reference_compare(orders))
+        return [e.key() for e in candidates]
+
+    def query(self, orders, cursor=None):
+        query = datastore.Query('Thing', cursor=cursor)
+        query.Order(*orders)
+        return query
+
+    def testOrderWithoutLimit(self):
+        for i in range(self.QUERIES):
+            orders = self.randomOrders()
+            keys = [e.key() for e in self.query(orders).Run()]
+            self.assertEqual(keys, self.expected(orders), orders)
+
+    def testOrderWithLimitAndOffset(self):
+        for i in range(self.QUERIES):
+            orders = self.randomOrders()
+            limit = self.random.randint(1, 20)
+            offset = self.random.choice([0, 0, self.random.randint(1, 30)])
+            keys = [e.key() for e in self.query(orders).Get(limit, offset)]
+            self.assertEqual(keys, self.expected(orders)[offset:offset + limit],
+                             (orders, limit, offset))
+
+    def testOrderPastTheLimit(self):
+        # A cursor may carry on past the results which were picked out for the limit.
+        for i in range(self.QUERIES / 4):
+            orders = self.randomOrders()
+            limit = self.random.randint(1, 10)
+            results = self.query(orders)._Run(limit=limit, prefetch_count=limit, next_count=7)
+            keys = [e.key() for e in results]
+            self.assertEqual(keys, self.expected(orders), (orders, limit))
+
+    def testCompiledQueryPages(self):
+        orders = [('a', ASCENDING), ('b', DESCENDING)]
+        expected = self.expected(orders)
+        query = self.query(orders)
+
+        keys = [e.key() for e in query.Get(10)]
+        while len(keys) < len(expected):
+            query = self.query(orders, cursor=query.GetCompiledQuery())
+            page = [e.key() for e in query.Get(10)]
+            self.failUnless(page)
+            keys.extend(page)
+        self.assertEqual(keys, expected)
+
+    def testStringSubclasses(self):
+        # Values of the different string types share a type tag, and compare as strings.
+        values = [datastore_types.Email(u'b@example.com'), datastore_types.Link(u'http://a'),
+                  datastore_types.Category(u'c'), datastore_types.PhoneNumber(u'555'), u'b']
+        for i in range(10):
+            entity = datastore.Entity('Thing')
+            entity['a'] = values[i % len(values)]
+            datastore.Put(entity)
+            self.entities.append(entity)
+
+        for direction in (ASCENDING, DESCENDING):
+            orders = [('a', direction)]
+            keys = [e.key() for e in self.query(orders).Get(50, 3)]
+            self.assertEqual(keys, self.expected(orders)[3:53])
+
+class IndexedQueryTestCase(RandomEntitiesTest):
+    """Random filtered queries, answered from the stub's property indexes and composite
+    indexes, must return exactly what a scan of every entity of the kind returns.
+    """
+
+    INDEX_YAML = """
+indexes:
+- kind: Thing
+  properties:
+  - name: a
+  - name: b
+    direction: desc
+- kind: Thing
+  properties:
+  - name: b
+  - name: c
+- kind: Thing
+  properties:
+  - name: a
+  - name: c
+  - name: b
+"""
+
+    QUERIES = 40
+    OPERATORS = ['<', '<=', '>', '>=']
+
+    def setUp(self):
+        RandomEntitiesTest.setUp(self)
+        definitions = datastore_index.ParseIndexDefinitions(self.INDEX_YAML).indexes
+        for index in datastore_admin.IndexDefinitionsToProtos(APP_ID, definitions):
+            datastore_admin.CreateIndex(index)
+
+    def randomQuery(self):
+        """Return random filters and orders, which the datastore allows together: at most
+        one property with inequality filters, which is then sorted on first.
+        """
+        props = ['a', 'b', 'c']
+        self.random.shuffle(props)
+        filters, orders = {}, []
+        if self.random.randint(0, 1):
+            prop = props.pop()
+            for op in self.random.sample(self.OPERATORS, self.random.randint(1, 2)):
+                filters['%s %s' % (prop, op)] = self.randomScalar()
+            orders.append((prop, self.random.choice([ASCENDING, DESCENDING])))
+        for prop in props[:self.random.randint(0, len(props))]:
+            filters['%s =' % prop] = self.randomScalar()
+        for prop in props:
+            if self.random.randint(0, 1):
+                orders.append((prop, self.random.choice([ASCENDING, DESCENDING])))
+        return filters, orders
+
+    def checkRandomQueries(self, count):
+        for i in range(count):
+            filters, orders = self.randomQuery()
+            self.assertEqual(self.indexed(filters, orders), self.scan(filters, orders),
+                             (filters, orders))
+
+    def testFiltersMatchAScan(self):
+        self.checkRandomQueries(self.QUERIES * 2)
+
+    def testIndexesFollowPutsAndDeletes(self):
+        # The first queries build the indexes, which must then be kept up to date.
+        self.checkRandomQueries(self.QUERIES)
+        for entity in self.random.sample(self.entities, 40):
+            for prop in ('a', 'b', 'c'):
+                value = self.randomValue()
+                if value is not None:
+                    entity[prop] = value
+                elif prop in entity:
+                    del entity[prop]
+            datastore.Put(entity)
+        deleted = self.random.sample(self.entities, 20)
+        datastore.Delete([e.key() for e in deleted])
+        self.entities = [e for e in self.entities if e not in deleted]
+        self.checkRandomQueries(self.QUERIES)
+
+    def testEntitiesDeletedAfterTheIndexLookupAreSkipped(self):
+        filters = {'a >': None}
+        matching = self.scan(filters)
+        deleted = matching[0]
+
+        # Delete an entity between the index lookup and reading the entities, the way
+        # another thread can.
+        stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        lookup = stub._DatastoreFileStub__IndexedCandidates
+        def candidates_then_delete(*args):
+            keys = lookup(*args)
+            datastore.Delete(deleted)
+            return keys
+        stub._DatastoreFileStub__IndexedCandidates = candidates_then_delete
+        try:
+            self.assertEqual(self.indexed(filters), matching[1:])
+        finally:
+            del stub._DatastoreFileStub__IndexedCandidates
+
+    def candidates(self, filters):
+        """Return the keys which the stub's indexes pick out for the filters to check."""
+        query = datastore.Query('Thing', filters)._ToPb()
+        stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        keys = stub._DatastoreFileStub__IndexedCandidates(
+            APP_ID, (APP_ID, 'Thing'), query.filter_list(), [])
+        return sorted([datastore_types.Key._FromPb(key) for key in keys])
+
+    def testCompositeIndexesAreUsed(self):
+        # Equality filters on a and b pick out a single range of the (a, b) index, which
+        # holds just the matching entities.
+        for a, b in [(1, 2), ([1, 3], 2), (1, [2, u'x']), (1, 3), (3, 2)]:
+            entity = datastore.Entity('Thing')
+            entity['a'], entity['b'], entity['c'] = a, b, 1
+            datastore.Put(entity)
+        filters = {'a =': 1, 'b =': 2}
+        matching = self.scan(filters, [])
+        self.assertEqual(len(matching), 3)
+        self.assertEqual(self.candidates(filters), matching)
+        self.failUnless(len(self.candidates({'a =': 1})) > len(matching))
+        self.assertEqual(self.indexed(filters, []), matching)
+
+        # Only the first properties of the (a, c, b) index have equality filters.
+        filters = {'a =': 1, 'c >': 0, 'b =': 2}
+        self.assertEqual(self.indexed(filters, [('c', ASCENDING)]),
+                         self.scan(filters, [('c', ASCENDING)]))
+
+class FilterTestCase(RandomEntitiesTest):
+    """Query filters must match the entities that the old eval()-based comparison matched,
+    whether or not the query is answered from the indexes.
+    """
+
+    FILTERS = 120
+    OPERATORS = {'<': '<', '<=': '<=', '>': '>', '>=': '>=', '=': '=='}
+
+    def setUp(self):
+        RandomEntitiesTest.setUp(self)
+        for value in [None, datastore_types.Text(u'x'), datastore_types.GeoPt(1, 2),
+                      datastore_types.Rating(3), 2L]:
+            entity = datastore.Entity('Thing')
+            entity['a'] = value
+            datastore.Put(entity)
+            self.entities.append(entity)
+
+    def expected(self, filters):
+        """Return the keys of the entities which the reference says pass every filter."""
+        keys = []
+        for entity in datastore.Get([e.key() for e in self.entities]):
+            for condition, value in filters.items():
+                prop, op = condition.split()
+                if not isinstance(value, list):
+                    value = [value]
+                if not reference_passes_filter(entity, prop, self.OPERATORS[op], value):
+                    break
+            else:
+                keys.append(entity.key())
+        keys.sort()
+        return keys
+
+    def check(self, filters):
+        expected = self.expected(filters)
+        self.assertEqual(self.indexed(filters), expected, filters)
+        self.assertEqual(self.scan(filters), expected, filters)
+        return expected
+
+    def randomFilter(self, props=['a', 'b', 'c', '__key__'], ops=OPERATORS.keys()):
+        prop = self.random.choice(props)
+        op = self.random.choice(ops)
+        if prop == '__key__':
+            value = self.random.choice(self.entities).key()
+        else:
+            value = self.randomScalar()
+        return {'%s %s' % (prop, op): value}
+
+    def testRandomFiltersMatchTheReference(self):
+        for i in range(self.FILTERS):
+            self.check(self.randomFilter())
+
+    def testRandomFilterPairsMatchTheReference(self):
+        # Inequality filters on one property, or any filter and an equality filter.
+        for i in range(self.FILTERS / 2):
+            filters = self.randomFilter()
+            prop = filters.keys()[0].split()[0]
+            if self.random.randint(0, 1):
+                filters.update(self.randomFilter([prop]))
+            else:
+                filters.update(self.randomFilter(ops=['=']))
+            self.check(filters)
+
+    def testNone(self):
+        matching = self.check({'a =': None})
+        self.failUnless(matching)
+        self.assertEqual(self.check({'a <': None}), [])
+        # None sorts before every other type.
+        self.assertEqual(set(self.check({'a >=': None})),
+                         set(self.check({'a >': None})) | set(matching))
+
+    def testDifferentTypesAreNeverEqual(self):
+        for value in [2, 2L, 2.0, True, u'2', datastore_types.Rating(2)]:
+            for entity in datastore.Get(self.check({'a =': value})):
+                values = entity['a']
+                if not isinstance(values, list):
+                    values = [values]
+                self.failUnless(value in values, (value, values))
+
+    def keysWithValues(self, prop, types, single=False):
+        """Return the keys of the entities with a value of one of the types for prop, or
+        if single is true, with just one value for prop, of one of the types.
+        """
+        keys = []
+        for entity in datastore.Get([e.key() for e in self.entities]):
+            values = entity.get(prop, [])
+            if not isinstance(values, list):
+                values = [values]
+            elif single:
+                continue
+            if [v for v in values if type(v) in types]:
+                keys.append(entity.key())
+        return set(keys)
+
+    def testInequalitiesCompareTypes(self):
+        # Booleans, strings, floats, users and points all sort after every integer.
+        later = self.keysWithValues('a', [bool, unicode, float, users.User,
+                                          datastore_types.GeoPt])
+        self.failUnless(later)
+        self.failIf(later - set(self.check({'a >': 1000})))
+
+        # Datetimes share the integer type tag, but never compare to integers.  A list may
+        # pass each bound with a different value, so only single values are compared.
+        singles = self.keysWithValues('a', DatastoreFileStub._PROPERTY_TYPE_TAGS, True)
+        dates = self.check({'a >=': datetime.datetime(1970, 1, 1),
+                            'a <=': datetime.datetime(2100, 1, 1)})
+        self.assertEqual(set(dates) & singles,
+                         self.keysWithValues('a', [datetime.datetime], True))
+        integers = self.check({'a >=': -100, 'a <=': 100})
+        self.assertEqual(set(integers) & singles,
+                         self.keysWithValues('a', [int, long, datastore_types.Rating], True))
+
+    def testMultipleValues(self):
+        entity = datastore.Entity('Thing')
+        entity['b'] = [1, u'z', None]
+        datastore.Put(entity)
+        self.entities.append(entity)
+        for filters in [{'b =': 1}, {'b =': u'z'}, {'b =': None}, {'b >': 5},
+                        {'b <': 1}, {'b >': 0, 'b <': 2}]:
+            self.failUnless(entity.key() in self.check(filters), filters)
+        # Each filter may be passed by a different value.
+        self.failUnless(entity.key() in self.check({'b >': 1, 'b <': u'z'}))
+        self.failIf(entity.key() in self.check({'b >': u'z'}))
+
+    def testUnindexedValuesNeverMatch(self):
+        for filters in [{'a >': None}, {'a <': u'z'}, {'a =': u'x'}]:
+            for entity in datastore.Get(self.check(filters)):
+                self.failIf(isinstance(entity['a'], datastore_types.Text), filters)
+
+    def testKeyFilters(self):
+        keys = sorted([e.key() for e in self.entities])
+        middle = keys[len(keys) / 2]
+        self.assertEqual(self.check({'__key__ =': middle}), [middle])
+        self.assertEqual(self.check({'__key__ <': middle}), keys[:len(keys) / 2])
+        self.assertEqual(self.check({'__key__ >=': middle}), keys[len(keys) / 2:])
+
+class CursorTestCase(AppEngineTest):
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        self.limits = (datastore_file_stub._MAX_CURSORS,
+                       datastore_file_stub._MAX_CURSOR_BYTES,
+                       datastore_file_stub._CURSOR_TTL)
+        entities = []
+        for i in range(30):
+            entity = datastore.Entity('Thing')
+            entity['n'] = i
+            entities.append(entity)
+        datastore.Put(entities)
+
+    def tearDown(self):
+        (datastore_file_stub._MAX_CURSORS,
+         datastore_file_stub._MAX_CURSOR_BYTES,
+         datastore_file_stub._CURSOR_TTL) = self.limits
+
+    def run_query(self):
+        query = datastore.Query('Thing')
+        query.Order('n')
+        return query.Run()
+
+    def testCursorsAreCounted(self):
+        self.assertEqual(self.stub.GetCursorStats()['cursors'], 0)
+        self.run_query()
+        self.run_query()
+        stats = self.stub.GetCursorStats()
+        self.assertEqual(stats['cursors'], 2)
+        self.failUnless(stats['bytes'] > 0)
+
+    def testCountDoesNotLeaveACursor(self):
+        self.assertEqual(datastore.Query('Thing').Count(), 30)
+        self.assertEqual(self.stub.GetCursorStats()['cursors'], 0)
+
+    def testLeastRecentlyUsedCursorsAreEvicted(self):
+        datastore_file_stub._MAX_CURSORS = 3
+        first = self.run_query()
+        first.next()
+        for i in range(3):
+            self.run_query()
+
+        stats = self.stub.GetCursorStats()
+        self.assertEqual(stats['cursors'], 3)
+        self.assertEqual(stats['evicted'], 1)
+        self.assertRaises(datastore_errors.BadRequestError, list, first)
+
+    def testByteBudgetKeepsTheNewestCursor(self):
+        datastore_file_stub._MAX_CURSOR_BYTES = 1
+        self.run_query()
+        results = self.run_query()
+        self.assertEqual(self.stub.GetCursorStats()['cursors'], 1)
+        self.assertEqual([e['n'] for e in results], range(30))
+
+    def testUnusedCursorsExpire(self):
+        self.run_query()
+        datastore_file_stub._CURSOR_TTL = -1
+        self.run_query()
+        stats = self.stub.GetCursorStats()
+        self.assertEqual(stats['cursors'], 1)
+        self.assertEqual(stats['expired'], 1)
+
+    def testLaterBatchesSeeCurrentEntities(self):
+        results = self.run_query()
+        self.assertEqual(results.next()['n'], 0)
+
+        later = datastore.Query('Thing', {'n =': 29}).Get(1)[0]
+        later['changed'] = True
+        datastore.Put(later)
+        datastore.Delete(datastore.Query('Thing', {'n =': 28}).Get(1)[0])
+
+        rest = list(results)
+        self.assertEqual([e['n'] for e in rest], range(1, 28) + [29])
+        self.assertEqual(rest[-1]['changed'], True)
+
+class TransactionTestCase(AppEngineTest):
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.counters = []
+        for name in ('first', 'second'):
+            counter = datastore.Entity('Counter', name=name)
+            counter['count'] = 0
+            datastore.Put(counter)
+            self.counters.append(counter.key())
+
+        # Collisions are expected here, and logged as warnings.
+        self.level = logging.getLogger().level
+        logging.getLogger().setLevel(logging.ERROR)
+
+    def tearDown(self):
+        logging.getLogger().setLevel(self.level)
+
+    def count(self, key):
+        return datastore.Get(key)['count']
+
+    def increment(self, key, during=None, retries=datastore.DEFAULT_TRANSACTION_RETRIES):
+        """Increment a counter in a transaction, and return the number of attempts it took.
+        If given, during is called before the first attempt commits.
+        """
+        attempts = []
+        def transaction():
+            counter = datastore.Get(key)
+            counter['count'] += 1
+            datastore.Put(counter)
+            if not attempts and during:
+                during()
+            attempts.append(1)
+        datastore.RunInTransactionCustomRetries(retries, transaction)
+        return len(attempts)
+
+    def testWritesAreOnlyVisibleAfterCommit(self):
+        seen = []
+        def transaction():
+            counter = datastore.Get(self.counters[0])
+            counter['count'] = 5
+            datastore.Put(counter)
+            seen.append(self.count(self.counters[0]))
+        datastore.RunInTransaction(transaction)
+        self.assertEqual(seen, [0])
+        self.assertEqual(self.count(self.counters[0]), 5)
+
+    def testRollbackDiscardsWrites(self):
+        def transaction():
+            datastore.Delete(self.counters[0])
+            raise datastore_errors.Rollback()
+        datastore.RunInTransaction(transaction)
+        self.assertEqual(self.count(self.counters[0]), 0)
+
+    def testConflictingWriteRetriesTheTransaction(self):
+        def during():
+            counter = datastore.Get(self.counters[0])
+            counter['count'] = 10
+            thread = threading.Thread(target=datastore.Put, args=(counter,))
+            thread.start()
+            thread.join()
+
+        self.assertEqual(self.increment(self.counters[0], during), 2)
+        self.assertEqual(self.count(self.counters[0]), 11)
+
+    def testConflictWithoutRetriesFails(self):
+        def transaction():
+            counter = datastore.Get(self.counters[0])
+            thread = threading.Thread(target=self.increment, args=(self.counters[0],))
+            thread.start()
+            thread.join()
+            datastore.Put(counter)
+        self.assertRaises(datastore_errors.TransactionFailedError,
+                          datastore.RunInTransactionCustomRetries, 0, transaction)
+        self.assertEqual(self.count(self.counters[0]), 1)
+
+    def testTransactionsOnDifferentGroupsRunInParallel(self):
+        # The second transaction begins and commits while the first one is open.
+        def during():
+            thread = threading.Thread(target=self.increment, args=(self.counters[1],))
+            thread.start()
+            thread.join()
+
+        self.assertEqual(self.increment(self.counters[0], during), 1)
+        self.assertEqual(self.count(self.counters[0]), 1)
+        self.assertEqual(self.count(self.counters[1]), 1)
+
+    def groupVersions(self):
+        """Return the entity group versions which the stub keeps for open transactions."""
+        stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        return getattr(stub, '_%s__entity_group_versions' % stub.__class__.__name__)
+
+    def testGroupVersionsAreDroppedWhenTransactionsEnd(self):
+        def write(key):
+            thread = threading.Thread(target=datastore.Put, args=(datastore.Get(key),))
+            thread.start()
+            thread.join()
+
+        recorded = []
+        def during():
+            write(self.counters[0])
+            recorded.append(len(self.groupVersions()))
+        self.assertEqual(self.increment(self.counters[0], during), 2)
+        self.assertEqual(recorded, [1])
+        self.assertEqual(self.groupVersions(), {})
+
+        def rollback():
+            datastore.Get(self.counters[1])
+            write(self.counters[1])
+            recorded.append(len(self.groupVersions()))
+            raise datastore_errors.Rollback()
+        datastore.RunInTransaction(rollback)
+        self.assertEqual(recorded, [1, 1])
+        self.assertEqual(self.groupVersions(), {})
+
+        # Groups which no transaction uses get no version at all.
+        write(self.counters[0])
+        self.assertEqual(self.groupVersions(), {})
+
+    def testConcurrentIncrementsAreNotLost(self):
+        threads = [threading.Thread(target=self.increment, args=(self.counters[i % 2],),
+                                    kwargs={'retries': 100})
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.count(self.counters[0]), 5)
+        self.assertEqual(self.count(self.counters[1]), 5)
+
+class StoredEntityTestCase(AppEngineTest):
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+
+    def put(self, kind, count):
+        entities = []
+        for i in range(count):
+            entity = datastore.Entity(kind)
+            entity['n'] = i
+            entity['text'] = datastore_types.Text(u'x' * i)
+            entities.append(entity)
+        datastore.Put(entities)
+        return entities
+
+    def testMemoryIsTrackedPerKind(self):
+        self.put('Small', 3)
+        large = self.put('Large', 10)
+        kinds = self.stub.GetMemoryStats()['kinds']
+        small_stats = kinds[(u'test_app', 'Small')]
+        large_stats = kinds[(u'test_app', 'Large')]
+        self.assertEqual(small_stats['entities'], 3)
+        self.assertEqual(large_stats['entities'], 10)
+        self.failUnless(large_stats['bytes'] > small_stats['bytes'] > 0)
+
+        large[0]['text'] = datastore_types.Text(u'x' * 1000)
+        datastore.Put(large[0])
+        grown = self.stub.GetMemoryStats()['kinds'][(u'test_app', 'Large')]['bytes']
+        self.failUnless(grown >= large_stats['bytes'] + 1000)
+
+        datastore.Delete(large)
+        self.failIf((u'test_app', 'Large') in self.stub.GetMemoryStats()['kinds'])
+
+    def testDecodedEntitiesAreCached(self):
+        self.put('Thing', 5)
+        query = datastore.Query('Thing')
+        query.Order('n')
+        query.Get(5)
+        misses = self.stub.GetMemoryStats()['cache']['misses']
+        self.assertEqual([e['n'] for e in query.Get(5)], range(5))
+        cache = self.stub.GetMemoryStats()['cache']
+        self.assertEqual(cache['misses'], misses)
+        self.assertEqual(cache['entries'], 5)
+
+    def testWithoutACache(self):
+        stub = datastore_file_stub.DatastoreFileStub(u'test_app', None, entity_cache_size=0)
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+
+        entities = self.put('Thing', 5)
+        self.assertEqual(datastore.Get(entities[2].key())['n'], 2)
+        self.assertEqual([e['n'] for e in datastore.Query('Thing', {'n >': 2}).Get(5)], [3, 4])
+        self.assertEqual(stub.GetMemoryStats()['cache']['entries'], 0)
+
+class SchemaTestCase(AppEngineTest):
+    def schema(self):
+        """Return a dict of each kind's properties, and the value types each one has."""
+        request = datastore_pb.GetSchemaRequest()
+        request.set_app(datastore_types.ResolveAppId(None))
+        request.set_properties(True)
+        schema = datastore_pb.Schema()
+        apiproxy_stub_map.MakeSyncCall('datastore_v3', 'GetSchema', request, schema)
+
+        kinds = {}
+        for kind in schema.kind_list():
+            props = {}
+            for prop in kind.property_list():
+                value = prop.value()
+                props[prop.name()] = [t for t in ('int64value', 'stringvalue', 'doublevalue')
+                                      if getattr(value, 'has_' + t)()]
+            kinds[kind.key().path().element(0).type()] = props
+        return kinds
+
+    def testSchemaFollowsPutsAndDeletes(self):
+        first = datastore.Entity('Thing')
+        first['a'] = 1
+        first['b'] = u'text'
+        second = datastore.Entity('Thing')
+        second['a'] = [u'text', 2]
+        datastore.Put([first, second])
+        self.assertEqual(self.schema(), {'Thing': {'a': ['int64value', 'stringvalue'],
+                                                   'b': ['stringvalue']}})
+
+        second['a'] = 2.5
+        datastore.Put(second)
+        self.assertEqual(self.schema(), {'Thing': {'a': ['int64value', 'doublevalue'],
+                                                   'b': ['stringvalue']}})
+
+        datastore.Delete(first)
+        self.assertEqual(self.schema(), {'Thing': {'a': ['doublevalue']}})
+
+        datastore.Delete(second)
+        self.assertEqual(self.schema(), {})
+
+class DatastoreFileTestCase(AppEngineTest):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp()
+        os.close(handle)
+        os.remove(self.filename)
+        self.limits = (datastore_file_stub._FILE_CHUNK_SIZE,
+                       datastore_file_stub._MIN_PARALLEL_ENTITIES)
+        datastore_file_stub._FILE_CHUNK_SIZE = 7
+        AppEngineTest.setUp(self)
+
+        self.entities = []
+        for i in range(30):
+            entity = datastore.Entity(['Thing', 'Other'][i % 2])
+            entity['n'] = i
+            entity['name'] = [u'even', u'odd'][i % 2]
+            if i % 3:
+                entity['extra'] = 1.5
+            self.entities.append(entity)
+        datastore.Put(self.entities)
+
+    def tearDown(self):
+        (datastore_file_stub._FILE_CHUNK_SIZE,
+         datastore_file_stub._MIN_PARALLEL_ENTITIES) = self.limits
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def datastore_stub(self):
+        return DatastoreFileStub(APP_ID, self.filename)
+
+    def reopen(self):
+        """Start again with a new stub, which reads the datastore file."""
+        stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        before = stub.GetMemoryStats()['kinds']
+        AppEngineTest.setUp(self)
+        stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        self.assertEqual(stub.GetMemoryStats()['kinds'], before)
+
+    def check(self):
+        keys = [e.key() for e in self.entities]
+        self.assertEqual([dict(e) for e in datastore.Get(keys)],
+                         [dict(e) for e in self.entities])
+        self.assertEqual([e['n'] for e in datastore.Query('Thing', {'extra =': 1.5}).Get(50)],
+                         [2, 4, 8, 10, 14, 16, 20, 22, 26, 28])
+
+        entity = datastore.Entity('Thing')
+        datastore.Put(entity)
+        self.failUnless(entity.key().id() > max([key.id() for key in keys]))
+
+    def testChunkedFileIsReadWithoutDecoding(self):
+        self.reopen()
+        self.check()
+
+    def testOldFormatIsRead(self):
+        old = open(self.filename, 'wb')
+        pickle.dump([e._ToPb().Encode() for e in datastore.Get([e.key() for e in self.entities])],
+                    old, 1)
+        old.close()
+        self.reopen()
+        self.check()
+
+    def testOldFormatIsDecodedInParallel(self):
+        multiprocessing = datastore_file_stub.multiprocessing
+        if not multiprocessing:
+            return
+        datastore_file_stub._MIN_PARALLEL_ENTITIES = 1
+        cpu_count = multiprocessing.cpu_count
+        multiprocessing.cpu_count = lambda: 2
+        try:
+            self.testOldFormatIsRead()
+        finally:
+            multiprocessing.cpu_count = cpu_count
+
+class JournalTestCase(AppEngineTest):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp()
+        os.close(handle)
+        os.remove(self.filename)
+        self.min_records = datastore_file_stub._MIN_JOURNAL_RECORDS
+        AppEngineTest.setUp(self)
+
+        # The first run has no datastore file to read, and says so.
+        self.level = logging.getLogger().level
+        logging.getLogger().setLevel(logging.ERROR)
+
+    def tearDown(self):
+        self.waitForCompaction()
+        logging.getLogger().setLevel(self.level)
+        datastore_file_stub._MIN_JOURNAL_RECORDS = self.min_records
+        for path in [self.filename] + datastore_file_stub.JournalFiles(self.filename):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def datastore_stub(self):
+        return DatastoreFileStub(APP_ID, self.filename, use_journal=True)
+
+    def compactionThread(self):
+        stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        return stub._DatastoreFileStub__compaction_thread
+
+    def waitForCompaction(self):
+        if self.compactionThread():
+            self.compactionThread().join()
+
+    def journals(self):
+        return [path for path in datastore_file_stub.JournalFiles(self.filename)
+                if os.path.exists(path)]
+
+    def reopen(self):
+        """Start again with a new stub, which replays the journal."""
+        self.waitForCompaction()
+        AppEngineTest.setUp(self)
+
+    def thing(self, n):
+        entity = datastore.Entity('Thing')
+        entity['n'] = n
+        datastore.Put(entity)
+        return entity.key()
+
+    def testChangesAreReplayed(self):
+        kept, deleted, changed = [self.thing(n) for n in range(3)]
+        datastore.Delete(deleted)
+        def transaction():
+            entity = datastore.Get(changed)
+            entity['n'] = 20
+            datastore.Put(entity)
+        datastore.RunInTransaction(transaction)
+        self.failIf(os.path.exists(self.filename))
+        self.assertEqual(self.journals(), datastore_file_stub.JournalFiles(self.filename)[-1:])
+
+        self.reopen()
+        self.assertEqual(self.journals(), [])
+        self.failUnless(os.path.exists(self.filename))
+        self.assertEqual(datastore.Get(kept)['n'], 0)
+        self.assertRaises(datastore_errors.EntityNotFoundError, datastore.Get, deleted)
+        self.assertEqual(datastore.Get(changed)['n'], 20)
+        self.failUnless(self.thing(3).id() > changed.id())
+
+        self.reopen()
+        self.assertEqual(sorted([e['n'] for e in datastore.Query('Thing').Get(10)]), [0, 3, 20])
+
+    def testCompactionRemovesTheJournal(self):
+        datastore_file_stub._MIN_JOURNAL_RECORDS = 5
+        key = self.thing(0)
+        for n in range(1, 10):
+            entity = datastore.Get(key)
+            entity['n'] = n
+            datastore.Put(entity)
+            if self.compactionThread():
+                break
+        # The sixth record is more than both the minimum and the number of entities.
+        self.assertEqual(n, 5)
+        self.waitForCompaction()
+        self.assertEqual(self.journals(), [])
+        self.failUnless(os.path.exists(self.filename))
+
+        self.reopen()
+        self.assertEqual(datastore.Get(key)['n'], n)
+
+    def testJournalKeepsTheOrderOfWritesToAnEntity(self):
+        key = self.thing(0)
+        stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        write_changes = stub._DatastoreFileStub__WriteChanges
+
+        # Another thread tries to write the entity again between the first write reaching
+        # memory and reaching the journal.
+        def put(n):
+            entity = datastore.Get(key)
+            entity['n'] = n
+            datastore.Put(entity)
+        other = threading.Thread(target=put, args=(2,))
+        def write_changes_after_another_put(changes):
+            del stub._DatastoreFileStub__WriteChanges
+            other.start()
+            other.join(0.2)
+            write_changes(changes)
+        stub._DatastoreFileStub__WriteChanges = write_changes_after_another_put
+        put(1)
+        other.join()
+
+        self.assertEqual(datastore.Get(key)['n'], 2)
+        self.reopen()
+        self.assertEqual(datastore.Get(key)['n'], 2)
+
+    def testConcurrentWritesAreReplayed(self):
+        datastore_file_stub._MIN_JOURNAL_RECORDS = 5
+        keys = [self.thing(0) for i in range(4)]
+        def writer(seed):
+            rand = random.Random(seed)
+            for i in range(40):
+                entity = datastore.Get(rand.choice(keys))
+                entity['n'] = seed * 100 + i
+                datastore.Put(entity)
+        threads = [threading.Thread(target=writer, args=(seed,)) for seed in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expected = [e['n'] for e in datastore.Get(keys)]
+        self.reopen()
+        self.assertEqual([e['n'] for e in datastore.Get(keys)], expected)
+
+    def assertTornEndIsSkipped(self, tear):
+        first, second = self.thing(1), self.thing(2)
+        journal = datastore_file_stub.JournalFiles(self.filename)[-1]
+        data = open(journal, 'rb').read()
+        torn = open(journal, 'wb')
+        torn.write(tear(data))
+        torn.close()
+
+        self.reopen()
+        self.assertEqual(datastore.Get(first)['n'], 1)
+        self.assertEqual(self.journals(), [])
+        return second
+
+    def testTruncatedRecordIsSkipped(self):
+        second = self.assertTornEndIsSkipped(lambda data: data[:-5])
+        self.assertRaises(datastore_errors.EntityNotFoundError, datastore.Get, second)
+
+    def testGarbageAfterTheLastRecordIsSkipped(self):
+        second = self.assertTornEndIsSkipped(lambda data: data + 'garbage\x00\x01')
+        self.assertEqual(datastore.Get(second)['n'], 2)
+
+class SqliteStubTest(AppEngineTest):
+    def datastore_stub(self):
+        return datastore_sqlite_stub.DatastoreSqliteStub(APP_ID, None)
+
+class SqliteQueryTestCase(SqliteStubTest, QueryOrderTestCase):
+    """The query order tests are run against the SQLite stub, and random filters are
+    compared with the results of the file stub.
+    """
+
+    OPERATORS = ['<', '<=', '>', '>=', '=']
+
+    def setUp(self):
+        QueryOrderTestCase.setUp(self)
+        self.sqlite = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        self.file = DatastoreFileStub(APP_ID, '/dev/null', '/dev/null')
+        self.use(self.file)
+        datastore.Put(self.entities)
+        self.use(self.sqlite)
+
+    def use(self, stub):
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+
+    def both(self, make_query, *args):
+        """Return the keys of a query's results from the file stub and the SQLite stub."""
+        results = []
+        for stub in (self.file, self.sqlite):
+            self.use(stub)
+            results.append([e.key() for e in make_query().Get(*args)])
+        return results
+
+    def randomScalar(self):
+        # The file stub never matches a datetime filter to an integer or the other way
+        # round, where the SQLite stub compares them as integers, as the real datastore
+        # does.  So datetimes are left out, and tested on their own.
+        value = QueryOrderTestCase.randomScalar(self)
+        if isinstance(value, datetime.datetime):
+            return users.User('other@example.com')
+        return value
+
+    def testFilters(self):
+        for i in range(self.QUERIES):
+            props = ['a', 'b', 'c']
+            self.random.shuffle(props)
+            op = self.random.choice(self.OPERATORS)
+            filters = {'%s %s' % (props[0], op): self.randomScalar()}
+            if self.random.randint(0, 1):
+                filters['%s =' % props[1]] = self.randomScalar()
+
+            orders = self.randomOrders()
+            if op != '=':
+                orders = [(props[0], self.random.choice([ASCENDING, DESCENDING]))]
+                orders += [order for order in self.randomOrders() if order[0] != props[0]]
+
+            def make_query():
+                query = datastore.Query('Thing', filters)
+                query.Order(*orders)
+                return query
+            expected, actual = self.both(make_query, 30, self.random.randint(0, 5))
+            self.assertEqual(actual, expected, (filters, orders))
+
+    def testKeysAndAncestors(self):
+        parent = self.entities[10]
+        for i in range(5):
+            child = datastore.Entity('Thing', parent=parent.key(), name='child%d' % i)
+            child['a'] = i
+            for stub in (self.file, self.sqlite):
+                self.use(stub)
+                datastore.Put(child)
+        pivot = self.entities[20].key()
+
+        for make_query in (lambda: datastore.Query('Thing', {'__key__ >': pivot}),
+                           lambda: datastore.Query('Thing', {'__key__ <=': pivot}).Order(('__key__', DESCENDING)),
+                           lambda: datastore.Query('Thing').Ancestor(parent.key()),
+                           lambda: datastore.Query('Thing', {'a >=': 2}).Ancestor(parent.key()).Order('a')):
+            expected, actual = self.both(make_query, 200)
+            self.failUnless(expected)
+            self.assertEqual(actual, expected)
+
+    def testDatetimes(self):
+        for i in range(20):
+            entity = datastore.Entity('Event')
+            entity['when'] = [datetime.datetime(2009, 1, self.random.randint(1, 28))
+                              for j in range(self.random.randint(1, 2))]
+            for stub in (self.file, self.sqlite):
+                self.use(stub)
+                datastore.Put(entity)
+
+        middle = datetime.datetime(2009, 1, 14)
+        for direction in (ASCENDING, DESCENDING):
+            make_query = lambda: datastore.Query('Event', {'when >=': middle}).Order(('when', direction))
+            expected, actual = self.both(make_query, 50)
+            self.assertEqual(actual, expected)
+
+    def testDeletedResultsDoNotShiftLaterBatches(self):
+        # Each batch continues after the last result of the batch before, rather than
+        # skipping as many results as came before it.
+        for orders in ([], [('a', ASCENDING)], [('b', DESCENDING), ('a', ASCENDING)]):
+            expected = self.expected(orders)
+            results = self.query(orders).Run()
+            first = [results.next().key() for i in range(datastore_file_stub._BATCH_SIZE)]
+            datastore.Delete(first)
+            self.assertEqual(first + [e.key() for e in results], expected, orders)
+            datastore.Put([e for e in self.entities if e.key() in first])
+
+    def testCount(self):
+        for i in range(10):
+            value = self.randomScalar()
+            counts = []
+            for stub in (self.file, self.sqlite):
+                self.use(stub)
+                counts.append(datastore.Query('Thing', {'a >': value}).Count())
+            self.assertEqual(counts[1], counts[0], value)
+
+class SqliteCursorTestCase(SqliteStubTest, CursorTestCase):
+    pass
+
+class SqliteTransactionTestCase(SqliteStubTest, TransactionTestCase):
+    pass
+
+class SqliteSchemaTestCase(SqliteStubTest, SchemaTestCase):
+    pass
+
+class SqlitePersistenceTestCase(AppEngineTest):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp()
+        os.close(handle)
+        os.remove(self.filename)
+        AppEngineTest.setUp(self)
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def datastore_stub(self):
+        return datastore_sqlite_stub.DatastoreSqliteStub(APP_ID, self.filename)
+
+    def testEntitiesAndIdsOutliveTheStub(self):
+        entity = datastore.Entity('Thing')
+        entity['n'] = 1
+        datastore.Put(entity)
+
+        AppEngineTest.setUp(self)
+        self.assertEqual(datastore.Get(entity.key())['n'], 1)
+        self.assertEqual([e.key() for e in datastore.Query('Thing', {'n =': 1}).Get(5)],
+                         [entity.key()])
+
+        another = datastore.Entity('Thing')
+        datastore.Put(another)
+        self.failUnless(another.key().id() > entity.key().id())
+
+    def testOtherFilesAreRejected(self):
+        other = open(self.filename, 'wb')
+        other.write('not a database' * 100)
+        other.close()
+        self.assertRaises(datastore_errors.InternalError, self.datastore_stub)
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTest( unittest.makeSuite(QueryOrderTestCase, 'test') )
+    s.addTest( unittest.makeSuite(IndexedQueryTestCase, 'test') )
+    s.addTest( unittest.makeSuite(CursorTestCase, 'test') )
+    s.addTest( unittest.makeSuite(TransactionTestCase, 'test') )
+    s.addTest( unittest.makeSuite(StoredEntityTestCase, 'test') )
+    s.addTest( unittest.makeSuite(SchemaTestCase, 'test') )
+    s.addTest( unittest.makeSuite(DatastoreFileTestCase, 'test') )
+    s.addTest( unittest.makeSuite(JournalTestCase, 'test') )
+    s.addTest( unittest.makeSuite(SqliteQueryTestCase, 'test') )
+    s.addTest( unittest.makeSuite(SqliteCursorTestCase, 'test') )
+    s.addTest( unittest.makeSuite(SqliteTransactionTestCase, 'test') )
+    s.addTest( unittest.makeSuite(SqliteSchemaTestCase, 'test') )
+    s.addTest( unittest.makeSuite(SqlitePersistenceTestCase, 'test') )
+    return s
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# filter_benchmark.py - Time the datastore stub's query filters
+#
+# Copyright 2008-2009 Proven Corporation Co., Ltd., Thailand
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Filter random entities with the stub's compiled filters, and with the eval()-based
+comparison it used before, and print how long each takes.
+
+Usage: app_version=1 python filter_benchmark.py [entities]
+"""
+
+import sys
+import time
+import random
+import test_environment
+
+from google.appengine.api import datastore
+from google.appengine.api import datastore_file_stub
+
+# The unit tests keep the old comparison, to check the new one against.
+import datastore as datastore_test
+
+FILTERS = [
+    {'a =': 3},
+    {'a >': 10, 'a <=': 50},
+    {'b =': u'abc'},
+    {'b <': u'm'},
+    {'a >=': 0, 'b =': u'xyz'},
+]
+
+OPERATORS = {'<': '<', '<=': '<=', '>': '>', '>=': '>=', '=': '=='}
+
+def make_entities(count):
+    rand = random.Random(1)
+    entities = []
+    for i in range(count):
+        entity = datastore.Entity('Thing')
+        entity['a'] = rand.choice([rand.randint(0, 100), None, float(rand.randint(0, 100)),
+                                   [rand.randint(0, 100), u'x']])
+        entity['b'] = rand.choice([u'abc', u'xyz', u'%d' % rand.randint(0, 100), True])
+        entities.append(entity)
+    return entities
+
+def compiled(entities, filters):
+    results = entities
+    for filt in datastore.Query('Thing', filters)._ToPb().filter_list():
+        results = filter(datastore_file_stub._CompileFilter(filt), results)
+    return results
+
+def evaluated(entities, filters):
+    results = entities
+    for condition, value in filters.items():
+        prop, op = condition.split()
+        results = [e for e in results
+                   if datastore_test.reference_passes_filter(e, prop, OPERATORS[op], [value])]
+    return results
+
+def timed(function, entities, filters):
+    start = time.time()
+    results = function(entities, filters)
+    return time.time() - start, len(results)
+
+def main(argv):
+    count = 20000
+    if len(argv) > 1:
+        count = int(argv[1])
+    entities = make_entities(count)
+
+    print '%-30s %10s %10s %8s' % ('filters on %d entities' % count, 'compiled', 'eval',
+                                   'speedup')
+    for filters in FILTERS:
+        compiled_time, compiled_count = timed(compiled, entities, filters)
+        eval_time, eval_count = timed(evaluated, entities, filters)
+        assert compiled_count == eval_count, (filters, compiled_count, eval_count)
+        print '%-30s %9.3fs %9.3fs %7.1fx' % (', '.join(sorted(filters)), compiled_time,
+                                            eval_time, eval_time / compiled_time)
+
+if __name__ == '__main__':
+    main(sys.argv)
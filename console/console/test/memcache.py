@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+#
+# memcache.py - Unit tests for the memcache stub
+#
+# Copyright 2008-2009 Proven Corporation Co., Ltd., Thailand
+#
+# This file is part of App Engine Console.
+#
+# App Engine Console is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# App Engine Console is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with App Engine Console; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import time
+import threading
+import unittest
+import test_environment
+
+from appengine_test import AppEngineTest
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import memcache
+from google.appengine.api.memcache import memcache_stub
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class MemcacheStubTest(AppEngineTest):
+    capacity = 100
+    sweep_interval = None
+    stripes = 1
+
+    def setUp(self):
+        AppEngineTest.setUp(self)
+        self.clock = Clock()
+        self.stub = memcache_stub.MemcacheServiceStub(gettime=self.clock,
+                                                      capacity=self.capacity,
+                                                      sweep_interval=self.sweep_interval,
+                                                      stripes=self.stripes)
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub('memcache', self.stub)
+
+    def stats(self):
+        return memcache.Client().get_stats()
+
+    def items(self):
+        """Return the number of entries, without sweeping the expired ones as stats would."""
+        return sum([len(cache) for cache in self.stub._stripes])
+
+class EvictionTestCase(MemcacheStubTest):
+    def testLeastRecentlyUsedAreEvicted(self):
+        memcache.set('a', 'x' * 40)
+        memcache.set('b', 'x' * 40)
+        self.assertEqual(memcache.get('a'), 'x' * 40)
+        memcache.set('c', 'x' * 40)
+
+        self.assertEqual(memcache.get('b'), None)
+        self.assertEqual(memcache.get_multi(['a', 'c']), {'a': 'x' * 40, 'c': 'x' * 40})
+
+        stats = self.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['items'], 2)
+        self.assertEqual(stats['bytes'], 80)
+
+    def testNamespacesShareTheCapacity(self):
+        memcache.set('a', 'x' * 60, namespace='one')
+        memcache.set('a', 'x' * 60, namespace='two')
+        self.assertEqual(memcache.get('a', namespace='one'), None)
+        self.assertEqual(memcache.get('a', namespace='two'), 'x' * 60)
+
+    def testTooLargeIsNotStored(self):
+        memcache.set('a', 'x' * 10)
+        self.failIf(memcache.set('b', 'x' * 101))
+        self.assertEqual(memcache.get('a'), 'x' * 10)
+        self.assertEqual(self.stats()['evictions'], 0)
+
+    def testBytesFollowReplacesAndIncrements(self):
+        memcache.set('a', 'x' * 40)
+        memcache.set('a', 'x' * 30)
+        memcache.set('n', '9')
+        memcache.incr('n')
+        memcache.delete('a')
+        self.assertEqual(self.stats()['bytes'], 2)
+
+        memcache.flush_all()
+        self.assertEqual(self.stats()['bytes'], 0)
+
+    def testOldestItemAge(self):
+        self.assertEqual(self.stats()['oldest_item_age'], 0)
+        memcache.set('a', 'x')
+        self.clock.now += 5
+        memcache.set('b', 'x')
+        self.clock.now += 5
+        memcache.get('a')
+        self.clock.now += 10
+        self.assertEqual(self.stats()['oldest_item_age'], 15)
+
+class ExpirationTestCase(MemcacheStubTest):
+    def testExpiredAreSwept(self):
+        memcache.set('short', 'x' * 10, time=10)
+        memcache.set('long', 'x' * 10, time=100)
+        memcache.set('forever', 'x' * 10)
+        memcache.delete('forever', seconds=20)
+
+        self.clock.now += 15
+        self.stub._SweepExpired()
+        self.assertEqual(self.items(), 2)
+        self.assertEqual(self.stub._stripes[0].bytes, 20)
+
+        self.clock.now += 10
+        self.stub._SweepExpired()
+        self.assertEqual(self.items(), 1)
+        self.failIf(memcache.add('long', 'y'))
+
+    def testReplacedEntriesAreNotSwept(self):
+        memcache.set('a', 'x', time=10)
+        memcache.set('a', 'y', time=100)
+        self.clock.now += 15
+        self.stub._SweepExpired()
+        self.assertEqual(memcache.get('a'), 'y')
+
+class BackgroundSweepTestCase(MemcacheStubTest):
+    sweep_interval = 0.01
+
+    def testExpiredAreSweptInTheBackground(self):
+        memcache.set('a', 'x', time=10)
+        self.clock.now += 15
+        time.sleep(0.2)
+        self.assertEqual(self.items(), 0)
+
+class ConcurrencyTestCase(MemcacheStubTest):
+    capacity = 1024 * 1024
+    stripes = 8
+
+    def run_threads(self, target, count=8):
+        threads = [threading.Thread(target=target, args=(n,)) for n in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def testIncrementsAreAtomic(self):
+        memcache.set('counter', 0)
+        def count(n):
+            for i in range(200):
+                memcache.incr('counter')
+                memcache.incr('counter_%d' % (i % 10), initial_value=0)
+        self.run_threads(count)
+
+        self.assertEqual(memcache.get('counter'), 1600)
+        self.assertEqual(memcache.get_multi(['counter_%d' % i for i in range(10)]).values(),
+                         ['160'] * 10)
+
+    def testOnlyOneAddWins(self):
+        for attempt in range(20):
+            added = []
+            def add(n):
+                if memcache.add('lock_%d' % attempt, n):
+                    added.append(n)
+            self.run_threads(add)
+            self.assertEqual(len(added), 1)
+            self.assertEqual(memcache.get('lock_%d' % attempt), added[0])
+
+    def testStatsAddUpTheStripes(self):
+        memcache.set_multi(dict([('key_%d' % i, 'x' * i) for i in range(100)]))
+        # Setting looks up the keys' chunk headers, which counts as misses.
+        before = self.stats()
+        memcache.get_multi(['key_%d' % i for i in range(150)])
+        stats = self.stats()
+        self.assertEqual(stats['items'], 100)
+        self.assertEqual(stats['bytes'], sum(range(100)))
+        self.assertEqual(stats['hits'] - before['hits'], 100)
+        self.assertEqual(stats['misses'] - before['misses'], 50)
+        self.failUnless(len([cache for cache in self.stub._stripes if len(cache)]) > 1)
+
+class CompareAndSetTestCase(MemcacheStubTest):
+    capacity = 1024 * 1024
+    stripes = 4
+
+    def testCasSucceedsWhenUnchanged(self):
+        client = memcache.Client()
+        memcache.set('a', 1)
+        self.assertEqual(client.gets('a'), 1)
+        self.failUnless(client.cas('a', 2))
+        self.assertEqual(memcache.get('a'), 2)
+
+        # The ID is used up by a successful cas, until the next gets.
+        self.failIf(client.cas('a', 3))
+        self.assertEqual(client.gets('a'), 2)
+        self.failUnless(client.cas('a', 3))
+
+    def testCasFailsWhenChanged(self):
+        client = memcache.Client()
+        memcache.set('a', 1)
+        client.gets('a')
+        memcache.set('a', 5)
+        self.failIf(client.cas('a', 2))
+        self.assertEqual(memcache.get('a'), 5)
+
+        client.gets('a')
+        memcache.incr('a')
+        self.failIf(client.cas('a', 2))
+
+        client.gets('a')
+        memcache.delete('a')
+        self.failIf(client.cas('a', 2))
+        self.assertEqual(memcache.get('a'), None)
+
+    def testCasNeedsGets(self):
+        client = memcache.Client()
+        memcache.set('a', 1)
+        self.failIf(client.cas('a', 2))
+        client.gets('a')
+        client.cas_reset()
+        self.failIf(client.cas('a', 2))
+
+    def testCasIdsAreUniqueAcrossFlushes(self):
+        client = memcache.Client()
+        memcache.set('a', 1)
+        client.gets('a')
+        memcache.flush_all()
+        memcache.set('a', 1)
+        self.failIf(client.cas('a', 2))
+
+    def testCasMulti(self):
+        client = memcache.Client()
+        memcache.set_multi({'a': 1, 'b': 1, 'c': 1})
+        self.assertEqual(client.get_multi(['a', 'b'], key_prefix='', for_cas=True),
+                         {'a': 1, 'b': 1})
+        memcache.set('b', 5)
+        self.assertEqual(sorted(client.cas_multi({'a': 2, 'b': 2, 'c': 2})), ['b', 'c'])
+        self.assertEqual(memcache.get_multi(['a', 'b', 'c']), {'a': 2, 'b': 5, 'c': 1})
+
+    def testConcurrentCasLosesNoUpdates(self):
+        memcache.set('total', 0)
+        def add(n):
+            client = memcache.Client()
+            for i in range(50):
+                while True:
+                    total = client.gets('total')
+                    if client.cas('total', total + 1):
+                        break
+        threads = [threading.Thread(target=add, args=(n,)) for n in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(memcache.get('total'), 300)
+
+class OffsetMultiTestCase(MemcacheStubTest):
+    capacity = 1024 * 1024
+    stripes = 4
+
+    def testOffsetMulti(self):
+        memcache.set_multi({'up': 10, 'down': 10, 'text': 'x'}, key_prefix='n:')
+        self.assertEqual(memcache.offset_multi({'up': 5, 'down': -3, 'text': 1, 'missing': 1},
+                                               key_prefix='n:'),
+                         {'up': 15, 'down': 7, 'text': None, 'missing': None})
+        self.assertEqual(memcache.offset_multi({'missing': 2, 'floor': -5}, key_prefix='n:',
+                                               initial_value=3),
+                         {'missing': 5, 'floor': 0})
+        self.assertEqual(memcache.get('up', namespace=None), None)
+        self.assertEqual(memcache.get('n:up'), 15)
+
+    def testOffsetMultiInNamespace(self):
+        memcache.set('a', 1, namespace='ns')
+        self.assertEqual(memcache.offset_multi({'a': 1}, namespace='ns'), {'a': 2})
+        self.assertEqual(memcache.offset_multi({'a': 1}), {'a': None})
+
+    def testOffsetMultiRejectsNonIntegers(self):
+        self.assertRaises(TypeError, memcache.offset_multi, {'a': 1.5})
+
+class SerializationTestCase(MemcacheStubTest):
+    capacity = 16 * memcache.MAX_VALUE_SIZE
+    stripes = 4
+
+    def tearDown(self):
+        for codec_id in memcache._CODECS.keys():
+            del memcache._CODECS[codec_id]
+
+    def testCompression(self):
+        text = 'all work and no play ' * 1000
+        self.failUnless(memcache.set('a', text, min_compress_len=1000))
+        self.failUnless(memcache.set('short', 'x' * 999, min_compress_len=1000))
+        self.failUnless(self.stats()['bytes'] < 999 + len(text) / 10)
+        self.assertEqual(memcache.get('a'), text)
+        self.assertEqual(memcache.get('short'), 'x' * 999)
+
+        # Values which do not get shorter are stored as they are.
+        noise = os.urandom(5000)
+        memcache.flush_all()
+        memcache.set_multi({'noise': noise, 'list': range(1000)}, min_compress_len=100)
+        self.failUnless(self.stats()['bytes'] > 5000)
+        self.assertEqual(memcache.get_multi(['noise', 'list']), {'noise': noise, 'list': range(1000)})
+
+    def testLargeValuesAreChunked(self):
+        big = os.urandom(memcache.MAX_VALUE_SIZE * 2 + 10)
+        self.failUnless(memcache.set('big', big))
+        self.assertEqual(memcache.get('big'), big)
+        # The value's header, its three chunks, and the record of its header.
+        self.assertEqual(self.stats()['items'], 5)
+
+        self.assertEqual(memcache.set_multi({'big': big[::-1], 'small': 1}, key_prefix='p:'), [])
+        self.assertEqual(memcache.get_multi(['big', 'small', 'missing'], key_prefix='p:'),
+                         {'big': big[::-1], 'small': 1})
+
+        client = memcache.Client()
+        self.assertEqual(client.gets('big'), big)
+        self.failUnless(client.cas('big', big[1:]))
+        self.assertEqual(memcache.get('big'), big[1:])
+
+    def testValuesWithLostChunksAreMisses(self):
+        memcache.set('big', 'x' * (memcache.MAX_VALUE_SIZE + 1))
+        stub_keys = [key for cache in self.stub._stripes for (namespace, key) in cache._entries]
+        chunk_key = [key for key in stub_keys
+                     if key not in ('big', memcache._chunk_header_key('big'))][0]
+        memcache.delete(chunk_key)
+        self.assertEqual(memcache.get('big'), None)
+
+    def testFailedAddsLeaveNoChunks(self):
+        memcache.set('big', 'x' * (memcache.MAX_VALUE_SIZE + 1))
+        items = self.items()
+        self.failIf(memcache.add('big', 'y' * (memcache.MAX_VALUE_SIZE * 2 + 1)))
+        self.assertEqual(memcache.add_multi({'big': 'y' * (memcache.MAX_VALUE_SIZE * 2 + 1)}),
+                         ['big'])
+        self.assertEqual(self.items(), items)
+        self.assertEqual(memcache.get('big'), 'x' * (memcache.MAX_VALUE_SIZE + 1))
+
+        self.failIf(memcache.replace('missing', 'y' * (memcache.MAX_VALUE_SIZE + 1)))
+        self.assertEqual(self.items(), items)
+
+    def testStaleCasLeavesNoChunks(self):
+        memcache.set('big', 'x' * (memcache.MAX_VALUE_SIZE + 1))
+        client = memcache.Client()
+        client.gets('big')
+        memcache.set('big', 'y' * (memcache.MAX_VALUE_SIZE + 1))
+        items = self.items()
+        self.failIf(client.cas('big', 'z' * (memcache.MAX_VALUE_SIZE * 2 + 1)))
+        self.assertEqual(self.items(), items)
+        self.assertEqual(memcache.get('big'), 'y' * (memcache.MAX_VALUE_SIZE + 1))
+
+    def testOverwritingDeletesTheOldChunks(self):
+        memcache.set('big', 'x' * (memcache.MAX_VALUE_SIZE + 1))
+        items = self.items()
+        for i in range(5):
+            self.failUnless(memcache.set('big', str(i) * (memcache.MAX_VALUE_SIZE + 1)))
+            memcache.set_multi({'big': str(i) * (memcache.MAX_VALUE_SIZE + 1)})
+            self.assertEqual(self.items(), items)
+        self.assertEqual(memcache.get('big'), '4' * (memcache.MAX_VALUE_SIZE + 1))
+
+        memcache.set('big', 'small')
+        self.assertEqual(self.items(), 1)
+        self.assertEqual(memcache.get('big'), 'small')
+
+    def testDeletingDeletesTheChunks(self):
+        memcache.set_multi({'a': 'x' * (memcache.MAX_VALUE_SIZE + 1),
+                            'b': 'y' * (memcache.MAX_VALUE_SIZE + 1),
+                            'c': 'small'})
+        memcache.delete('a')
+        self.assertEqual(self.items(), 5)
+        memcache.delete_multi(['b', 'c'])
+        self.assertEqual(self.items(), 0)
+
+    def testTooLargeValues(self):
+        self.assertRaises(ValueError, memcache.set, 'huge',
+                          'x' * (memcache.MAX_VALUE_SIZE * memcache.MAX_CHUNKS + 1))
+
+    def testEntityListCodec(self):
+        entities = []
+        for i in range(3):
+            entity = datastore.Entity('Thing')
+            entity['n'] = i
+            entity['text'] = u'entity %d' % i
+            entities.append(entity)
+        memcache.register_entity_list_codec()
+        memcache.set('entities', entities)
+
+        stored = self.stub._Stripe('', 'entities')._entries[('', 'entities')]
+        self.assertEqual(stored.flags & memcache.FLAG_TYPE_MASK, memcache.TYPE_CODEC)
+        self.assertEqual(stored.flags >> memcache.FLAG_CODEC_SHIFT, memcache.CODEC_ENTITY_LIST)
+
+        found = memcache.get('entities')
+        self.assertEqual([(e.kind(), dict(e)) for e in found],
+                         [(e.kind(), dict(e)) for e in entities])
+
+        # Other lists are still pickled.
+        memcache.set('numbers', [1, 2])
+        self.assertEqual(memcache.get('numbers'), [1, 2])
+
+    def testRegisteredCodecs(self):
+        memcache.register_codec(7, lambda value: isinstance(value, set),
+                                lambda value: ','.join(sorted(value)),
+                                lambda stored: set(stored.split(',')))
+        memcache.set('set', set(['b', 'a']))
+        self.assertEqual(memcache.get('set'), set(['a', 'b']))
+
+        del memcache._CODECS[7]
+        self.assertRaises(ValueError, memcache.get, 'set')
+        self.assertRaises(ValueError, memcache.register_codec, 256, None, None, None)
+
+class AsyncTestCase(MemcacheStubTest):
+    capacity = 4 * 1024 * 1024
+    stripes = 4
+
+    def testOverlappingCalls(self):
+        memcache.set('old', 'gone')
+        set_rpc = memcache.set_multi_async({'a': 1, 'b': [2]}, key_prefix='p:')
+        delete_rpc = memcache.delete_multi_async(['old'])
+        incr_rpc = memcache.incr_async('counter', initial_value=10)
+        self.assertEqual(set_rpc.get_result(), [])
+        self.assertEqual(delete_rpc.get_result(), True)
+        self.assertEqual(incr_rpc.get_result(), 11)
+
+        get_rpc = memcache.get_multi_async(['a', 'b', 'old'], key_prefix='p:')
+        offset_rpc = memcache.offset_multi_async({'counter': -4, 'missing': 1})
+        self.assertEqual(get_rpc.get_result(), {'a': 1, 'b': [2]})
+        self.assertEqual(offset_rpc.get_result(), {'counter': 7, 'missing': None})
+        self.assertEqual(memcache.decr_async('counter', 2).get_result(), 5)
+
+    def testPolicies(self):
+        memcache.set('there', 1)
+        self.assertEqual(memcache.add_multi_async({'there': 2, 'new': 2}).get_result(),
+                         ['there'])
+        self.assertEqual(memcache.replace_multi_async({'there': 3, 'absent': 3}).get_result(),
+                         ['absent'])
+
+        client = memcache.Client()
+        client.get_multi_async(['there'], for_cas=True).get_result()
+        memcache.set('there', 4)
+        self.assertEqual(client.cas_multi_async({'there': 5}).get_result(), ['there'])
+        self.assertEqual(memcache.get('there'), 4)
+
+    def testCreateRpc(self):
+        called = []
+        rpc = memcache.create_rpc(deadline=2, callback=lambda: called.append(True))
+        self.assertEqual(rpc.deadline, 2)
+        self.failUnless(memcache.get_multi_async(['x'], rpc=rpc) is rpc)
+        rpc.wait()
+        self.assertEqual(called, [True])
+        self.assertEqual(rpc.get_result(), {})
+
+    def testChunkedValue(self):
+        value = os.urandom(memcache.MAX_VALUE_SIZE * 2)
+        self.assertEqual(memcache.set_multi_async({'big': value}).get_result(), [])
+        self.assertEqual(memcache.get_multi_async(['big']).get_result(), {'big': value})
+
+        self.assertEqual(memcache.set_multi_async({'big': value[1:]}).get_result(), [])
+        self.assertEqual(self.items(), 4)
+        self.assertEqual(memcache.delete_multi_async(['big']).get_result(), True)
+        self.assertEqual(self.items(), 0)
+
+    def testValidation(self):
+        self.assertRaises(ValueError, memcache.set_multi_async, {'a': 1}, time=-1)
+        self.assertRaises(ValueError, memcache.incr_async, 'a', -1)
+        self.assertRaises(TypeError, memcache.offset_multi_async, {'a': 1.5})
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTest( unittest.makeSuite(EvictionTestCase, 'test') )
+    s.addTest( unittest.makeSuite(ExpirationTestCase, 'test') )
+    s.addTest( unittest.makeSuite(BackgroundSweepTestCase, 'test') )
+    s.addTest( unittest.makeSuite(ConcurrencyTestCase, 'test') )
+    s.addTest( unittest.makeSuite(CompareAndSetTestCase, 'test') )
+    s.addTest( unittest.makeSuite(OffsetMultiTestCase, 'test') )
+    s.addTest( unittest.makeSuite(SerializationTestCase, 'test') )
+    s.addTest( unittest.makeSuite(AsyncTestCase, 'test') )
+    return s
+
+if __name__ == "__main__":
+    unittest.main()
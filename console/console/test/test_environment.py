@@ -29,6 +29,7 @@ def addPath(dir):
 thisFile    = abspath(__file__)
 thisDir     = dirname(thisFile)
 appPath     = abspath(join(thisDir, '..', '..'))
+mainPath    = join(appPath, 'console')
 consolePath = join(appPath, 'console', 'app')
 gaePath     = abspath(join(appPath, '..', 'google_appengine'))
 gaeLibPath  = join(gaePath, 'lib')
@@ -37,5 +38,5 @@ webobPath   = join(gaeLibPath, 'webob')
 djangoPath  = join(gaeLibPath, 'django')
 
 # Go in reverse priority order due to to the insertion mechanism.
-for dir in (consolePath, appPath, gaePath, yamlPath, webobPath, djangoPath):
+for dir in (consolePath, mainPath, appPath, gaePath, yamlPath, webobPath, djangoPath):
     addPath(dir)
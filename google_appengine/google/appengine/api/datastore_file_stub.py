@@ -19,15 +19,40 @@
 In-memory persistent stub for the Python datastore API. Gets, queries,
 and searches are implemented as in-memory scans over all entities.
 
-Stores entities across sessions as pickled proto bufs in a single file. On
-startup, all entities are read from the file and loaded into memory. On
-every Put(), the file is wiped and all entities are written from scratch.
+Stores entities across sessions as encoded proto bufs in a single file. On
+startup, all entities are read from the file and loaded into memory. Only
+their encoded proto bufs are kept there, and the datastore.Entity forms of
+the most recently used ones are cached. On every Put(), the file is wiped
+and all entities are written from scratch.
 Clients can also manually Read() and Write() the file themselves.
 
-Transactions are serialized through __tx_lock. Each transaction acquires it
-when it begins and releases it when it commits or rolls back. This is
-important, since there are other member variables like __tx_snapshot that are
-per-transaction, so they should only be used by one tx at a time.
+The file is a series of pickled chunks, each holding some entities with their
+schemas, so reading it needs neither to decode nor to hold the whole file at
+once. Files in the older format, a single pickled list of entities, are still
+read; those entities have to be decoded, which is spread over a process pool
+when there are many of them and more than one CPU.
+
+In journal mode, each Put() or Delete() instead appends just the changed
+entities, and tombstones for the deleted ones, to a journal file next to the
+datastore file. Once the journal holds more records than the datastore has
+entities, a background thread writes the datastore file from scratch and the
+journal starts again. Read() replays any journals on top of the datastore file.
+
+Queries with a kind use sorted in-memory indexes of single properties, and of
+the composite indexes in index.yaml, to find the entities they could match
+without scanning the whole kind. An index is built the first time a query can
+use it, and kept up to date by Put() and Delete() after that.
+
+Query cursors only hold the keys of their results. They expire after a while
+without being used, and the least recently used ones are dropped once there
+are too many of them or they hold too much between them.
+
+Transactions are optimistic, and only conflict with each other if they use the
+same entity group. Each entity group has a version, which goes up whenever
+one of its entities is written. A transaction remembers the version of each
+group the first time it reads or writes it, and holds its writes until it
+commits. The commit fails with CONCURRENT_TRANSACTION if any of those groups
+has been written to since then. Otherwise the writes are applied.
 """
 
 
@@ -35,18 +60,29 @@ per-transaction, so they should only be used by one tx at a time.
 
 
 
+import array
+import bisect
 import datetime
+import heapq
+import itertools
 import logging
 import md5
+import operator
 import os
 import struct
 import sys
 import tempfile
 import threading
+import time
 import warnings
 
 import cPickle as pickle
 
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None
+
 from google.appengine.api import api_base_pb
 from google.appengine.api import apiproxy_stub
 from google.appengine.api import datastore
@@ -77,34 +113,711 @@ _MAX_QUERY_COMPONENTS = 100
 
 _BATCH_SIZE = 20
 
+
+_MAX_CURSORS = 100
+
+
+_MAX_CURSOR_BYTES = 16 * 1024 * 1024
+
+
+_CURSOR_TTL = 600
+
+
+_CURSOR_RESULT_OVERHEAD = 16
+
+
+_ENTITY_CACHE_SIZE = 5000
+
+
+_JOURNAL_SUFFIX = '.journal'
+
+
+_COMPACTING_SUFFIX = '.compacting'
+
+
+_MIN_JOURNAL_RECORDS = 1000
+
+
+_FILE_FORMAT = 'DatastoreFileStub chunks 1'
+
+
+_FILE_CHUNK_SIZE = 1000
+
+
+_MIN_PARALLEL_ENTITIES = 10000
+
+
+def JournalFiles(datastore_file):
+  """Returns the journal files which belong to a datastore file.
+
+  Args:
+    datastore_file: string, the datastore file
+
+  Returns:
+    list of strings, the journal being compacted and the current journal, in
+    the order they must be replayed
+  """
+  journal = datastore_file + _JOURNAL_SUFFIX
+  return [journal + _COMPACTING_SUFFIX, journal]
+
+
+_INDEX_MAXIMUM = (sys.maxint,)
+
+
+_UNINDEXABLE_TYPES = frozenset([datastore_types.Blob, datastore_types.IM, str])
+
+
+def _SortKey(value):
+  """Returns the key which a property value is sorted by.
+
+  The key is (type tag, value), which sorts values of different types by the
+  tags that the real datastore orders them by, and values of the same type by
+  value. Datetimes are converted to timestamps.
+
+  Args:
+    value: a property value
+
+  Returns:
+    tuple
+  """
+  if isinstance(value, datetime.datetime):
+    value = datastore_types.DatetimeToTimestamp(value)
+  return (DatastoreFileStub._PROPERTY_TYPE_TAGS.get(value.__class__), value)
+
+
+def _IndexValue(value):
+  """Returns the key which an indexed property value is sorted by.
+
+  This is the _SortKey() of the value, which sorts values of the same type the
+  same way that query filters compare them.
+
+  Args:
+    value: a property value
+
+  Returns:
+    tuple, or None if values of this type can not be put in an index.
+  """
+  if (value.__class__ in _UNINDEXABLE_TYPES or
+      value.__class__ not in DatastoreFileStub._PROPERTY_TYPE_TAGS):
+    return None
+  return _SortKey(value)
+
+
+_FILTER_OPERATORS = {
+    datastore_pb.Query_Filter.LESS_THAN:             operator.lt,
+    datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:    operator.le,
+    datastore_pb.Query_Filter.GREATER_THAN:          operator.gt,
+    datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: operator.ge,
+    datastore_pb.Query_Filter.EQUAL:                 operator.eq,
+}
+
+
+def _HasPropIndexed(entity, prop):
+  """Returns True if prop is in the entity and is indexed."""
+  if prop in datastore_types._SPECIAL_PROPERTIES:
+    return True
+  elif prop in entity.unindexed_properties():
+    return False
+
+  values = entity.get(prop, [])
+  if not isinstance(values, (tuple, list)):
+    values = [values]
+
+  for value in values:
+    if type(value) not in datastore_types._RAW_PROPERTY_TYPES:
+      return True
+  return False
+
+
+def _CompileFilter(filt):
+  """Returns a function which tells whether an entity passes a query filter.
+
+  The filter's operator, values and their type tags are worked out here, once
+  per filter, rather than for every entity the filter is applied to.
+
+  Args:
+    filt: datastore_pb.Query_Filter, not an IN filter
+
+  Returns:
+    function of a datastore.Entity, which returns True if the entity passes
+  """
+  assert filt.op() != datastore_pb.Query_Filter.IN
+
+  prop = filt.property(0).name().decode('utf-8')
+  op = _FILTER_OPERATORS[filt.op()]
+  is_equality = (filt.op() == datastore_pb.Query_Filter.EQUAL)
+  type_tags = DatastoreFileStub._PROPERTY_TYPE_TAGS
+
+  filter_val_list = []
+  for filter_prop in filt.property_list():
+    filter_val = datastore_types.FromPropertyPb(filter_prop)
+    filter_val_list.append((filter_val, type_tags.get(filter_val.__class__)))
+
+  def passes_filter(entity):
+    """Returns True if the entity passes the filter, False otherwise.
+
+    Values of the same type are compared directly. Values of different types
+    never match an equality filter, and are otherwise compared by their type
+    tags.
+    """
+    if not _HasPropIndexed(entity, prop):
+      return False
+
+    try:
+      entity_vals = datastore._GetPropertyValue(entity, prop)
+    except KeyError:
+      entity_vals = []
+
+    if not isinstance(entity_vals, list):
+      entity_vals = [entity_vals]
+
+    for fixed_entity_val in entity_vals:
+      fixed_entity_type = type_tags.get(fixed_entity_val.__class__)
+      for filter_val, filter_type in filter_val_list:
+        if fixed_entity_type == filter_type:
+          try:
+            if op(fixed_entity_val, filter_val):
+              return True
+          except TypeError:
+            pass
+        elif not is_equality and op(fixed_entity_type, filter_type):
+          return True
+
+    return False
+
+  return passes_filter
+
+
+class _ReverseOrder(object):
+  """Wraps a sort key so that it sorts in the opposite direction."""
+
+  __slots__ = ('key',)
+
+  def __init__(self, key):
+    self.key = key
+
+  def __cmp__(self, other):
+    return cmp(other.key, self.key)
+
+
+def _CompareSortKeys(x, y):
+  """Compares two sort keys the way that query results were compared before
+  they had sort keys, for the rare values that can't be compared directly.
+
+  Values with the same type tag that can't be compared are treated as equal.
+
+  Args:
+    x, y: sort keys, as returned by the sort key function of a query
+
+  Returns:
+    integer, like cmp()
+  """
+  for a, b in zip(x[:-1], y[:-1]):
+    reverse = isinstance(a, _ReverseOrder)
+    if reverse:
+      a, b = a.key, b.key
+
+    result = cmp(a[0], b[0])
+    if not result:
+      try:
+        result = cmp(a[1], b[1])
+      except TypeError:
+        result = 0
+    if reverse:
+      result = -result
+    if result:
+      return result
+
+  return cmp(x[-1], y[-1])
+
+
+class _SortedResults(object):
+  """The keys of the results of a query, which are only sorted as far as they
+  are needed.
+
+  Each entity's sort key is computed once, and ends with the entity's key. A
+  query with a limit usually only needs its first offset + limit results, so
+  those are picked out with a heap and the rest are only sorted if a cursor
+  goes past them. Only the sort keys are kept, not the entities themselves.
+
+  Supports len() and slicing, like the list of the result keys after the
+  offset.
+  """
+
+  def __init__(self, entities, sort_key, compare, offset, needed):
+    """Constructor.
+
+    Args:
+      entities: list of datastore.Entity, in any order
+      sort_key: function which returns the sort key of an entity
+      compare: function which compares two entities, used if their sort keys
+          can't be computed
+      offset: the number of results to skip
+      needed: the number of results, including the offset, to sort now
+    """
+    self.__offset = offset
+    self.__decorated = None
+
+    try:
+      decorated = [sort_key(entity) for entity in entities]
+    except TypeError:
+      entities = sorted(entities, compare)
+      self.__sorted = [entity.key() for entity in entities]
+      return
+
+    if needed < len(decorated):
+      try:
+        top = heapq.nsmallest(needed, decorated)
+        self.__sorted = [key[-1] for key in top]
+        self.__decorated = decorated
+        return
+      except TypeError:
+        pass
+
+    self.__SortAll(decorated)
+
+  def __SortAll(self, decorated):
+    """Sorts all of the results.
+
+    Args:
+      decorated: list of the sort keys of the results
+    """
+    try:
+      decorated.sort()
+    except TypeError:
+      decorated.sort(_CompareSortKeys)
+    self.__sorted = [key[-1] for key in decorated]
+    self.__decorated = None
+
+  def __len__(self):
+    total = len(self.__sorted)
+    if self.__decorated is not None:
+      total = len(self.__decorated)
+    return max(total - self.__offset, 0)
+
+  def __getitem__(self, index):
+    start, stop, step = index.indices(len(self))
+    if (self.__decorated is not None and
+        self.__offset + stop > len(self.__sorted)):
+      self.__SortAll(self.__decorated)
+    return self.__sorted[self.__offset + start:self.__offset + stop:step]
+
+
+class _PropertyIndex(object):
+  """A sorted in-memory index of some properties of the entities of a kind.
+
+  Each row is (values, encoded key, key), where values holds the _IndexValue()
+  of one value of each property. An entity has a row for each combination of
+  its values, and none if it lacks one of the properties or doesn't index it.
+
+  Values which _IndexValue() can't handle are only counted, in unindexable,
+  and the index must not be used while there are any.
+
+  The rows are kept in one sorted list, so Add() and Remove() take time
+  linear in the number of rows, and filling a large index one entity at a
+  time is quadratic. Build() sorts once, so indexes are built lazily from
+  the entities already stored.
+
+  Public properties:
+    properties: tuple of the property names
+    unindexable: the number of values which are missing from the index
+    multiple: the number of entities with more than one row. A filter only
+      needs one of an entity's values to match, so while there are any, a
+      range must not be bounded at both ends.
+  """
+
+  def __init__(self, properties):
+    """Constructor.
+
+    Args:
+      properties: tuple of property names
+    """
+    self.properties = properties
+    self.unindexable = 0
+    self.multiple = 0
+    self.__rows = []
+
+  def __len__(self):
+    return len(self.__rows)
+
+  def __Rows(self, entity):
+    """Returns the rows for an entity.
+
+    Args:
+      entity: datastore.Entity
+
+    Returns:
+      (rows, unindexable), where rows is a list of tuples of index values,
+      and unindexable is the number of values that are left out of them.
+    """
+    unindexed = entity.unindexed_properties()
+    unindexable = 0
+    rows = [()]
+    for name in self.properties:
+      if name in unindexed or name not in entity:
+        return [], 0
+
+      values = entity[name]
+      if not isinstance(values, list):
+        values = [values]
+      for value in values:
+        if type(value) not in datastore_types._RAW_PROPERTY_TYPES:
+          break
+      else:
+        return [], 0
+
+      index_values = []
+      for value in values:
+        index_value = _IndexValue(value)
+        if index_value is None:
+          unindexable += 1
+        elif index_value not in index_values:
+          index_values.append(index_value)
+
+      rows = [row + (index_value,) for row in rows
+              for index_value in index_values]
+
+    return rows, unindexable
+
+  def Build(self, stored_entities):
+    """Adds many entities to the index at once.
+
+    Args:
+      stored_entities: dict of entity_pb.Reference to _StoredEntity
+    """
+    for key, stored in stored_entities.iteritems():
+      rows, unindexable = self.__Rows(stored.native)
+      encoded = key.Encode()
+      self.__rows.extend([(values, encoded, key) for values in rows])
+      self.unindexable += unindexable
+      self.multiple += len(rows) > 1
+    self.__rows.sort()
+
+  def Add(self, key, entity):
+    """Adds an entity to the index.
+
+    Args:
+      key: entity_pb.Reference
+      entity: datastore.Entity
+    """
+    rows, unindexable = self.__Rows(entity)
+    encoded = key.Encode()
+    for values in rows:
+      bisect.insort(self.__rows, (values, encoded, key))
+    self.unindexable += unindexable
+    self.multiple += len(rows) > 1
+
+  def Remove(self, key, entity):
+    """Removes an entity, as it was when it was added, from the index.
+
+    Args:
+      key: entity_pb.Reference
+      entity: datastore.Entity
+    """
+    rows, unindexable = self.__Rows(entity)
+    encoded = key.Encode()
+    for values in rows:
+      position = bisect.bisect_left(self.__rows, (values, encoded))
+      if (position < len(self.__rows) and
+          self.__rows[position][:2] == (values, encoded)):
+        del self.__rows[position]
+    self.unindexable -= unindexable
+    self.multiple -= len(rows) > 1
+
+  def Range(self, prefix, lower=None, upper=None):
+    """Finds the rows whose values start with the given prefix, and whose
+    following value is within the given bounds.
+
+    Args:
+      prefix: tuple of index values
+      lower: (index value, inclusive) or None
+      upper: (index value, inclusive) or None
+
+    Returns:
+      (start, end) positions of the rows
+    """
+    if lower:
+      value, inclusive = lower
+      bound = prefix + (value,)
+      if not inclusive:
+        bound += (_INDEX_MAXIMUM,)
+    else:
+      bound = prefix
+    start = bisect.bisect_left(self.__rows, (bound,))
+
+    if upper:
+      value, inclusive = upper
+      bound = prefix + (value,)
+      if inclusive:
+        bound += (_INDEX_MAXIMUM,)
+    else:
+      bound = prefix + (_INDEX_MAXIMUM,)
+    end = bisect.bisect_left(self.__rows, (bound,))
+
+    return start, max(start, end)
+
+  def Keys(self, start, end):
+    """Returns the keys of the entities with rows in the given positions, in
+    index order, without duplicates.
+
+    Args:
+      start, end: positions from Range()
+
+    Returns:
+      list of entity_pb.Reference
+    """
+    seen = set()
+    keys = []
+    for values, encoded, key in self.__rows[start:end]:
+      if encoded not in seen:
+        seen.add(encoded)
+        keys.append(key)
+    return keys
+
+
+class _EntityCache(object):
+  """A cache of the native forms of stored entities, which keeps roughly the
+  size most recently used ones.
+
+  Entries live in one of two generations. New entries, and entries that are
+  used while in the old generation, go in the new one. Once the new generation
+  holds half of size entries, the old one is dropped and the new one takes
+  its place.
+
+  Public properties:
+    size: the most entries to keep; 0 turns the cache off
+    hits: the number of lookups that found an entry
+    misses: the number of lookups that didn't
+  """
+
+  def __init__(self, size):
+    """Constructor.
+
+    Args:
+      size: integer
+    """
+    self.size = size
+    self.hits = 0
+    self.misses = 0
+    self.__new = {}
+    self.__old = {}
+
+  def __len__(self):
+    return len(self.__new) + len(self.__old)
+
+  def Get(self, stored):
+    """Returns the cached native form of an entity.
+
+    Args:
+      stored: _StoredEntity
+
+    Returns:
+      datastore.Entity, or None if it isn't cached.
+    """
+    native = self.__new.get(stored)
+    if native is None:
+      native = self.__old.pop(stored, None)
+      if native is None:
+        self.misses += 1
+        return None
+      self.Put(stored, native)
+    self.hits += 1
+    return native
+
+  def Put(self, stored, native):
+    """Caches the native form of an entity.
+
+    Args:
+      stored: _StoredEntity
+      native: datastore.Entity
+    """
+    if not self.size:
+      return
+    self.__new[stored] = native
+    if len(self.__new) * 2 >= self.size:
+      self.__old = self.__new
+      self.__new = {}
+
+  def Discard(self, stored):
+    """Drops an entity that is no longer stored from the cache.
+
+    Args:
+      stored: _StoredEntity
+    """
+    self.__new.pop(stored, None)
+    self.__old.pop(stored, None)
+
+  def Clear(self):
+    self.__new = {}
+    self.__old = {}
+
+
+def _SchemaValueType(value):
+  """Returns the type of a property value, as far as the schema is concerned.
+
+  Args:
+    value: entity_pb.PropertyValue
+
+  Returns:
+    string, the name of the field that holds the value, or None if it has
+    none.
+  """
+  if value.has_int64value():
+    return 'int64value'
+  elif value.has_booleanvalue():
+    return 'booleanvalue'
+  elif value.has_stringvalue():
+    return 'stringvalue'
+  elif value.has_doublevalue():
+    return 'doublevalue'
+  elif value.has_pointvalue():
+    return 'pointvalue'
+  elif value.has_uservalue():
+    return 'uservalue'
+  elif value.has_referencevalue():
+    return 'referencevalue'
+  return None
+
+
+def _EntitySchema(entity):
+  """Returns the schema of an entity.
+
+  Args:
+    entity: entity_pb.EntityProto
+
+  Returns:
+    sorted tuple of the distinct (name, _SchemaValueType()) pairs of the
+    entity's indexed property values
+  """
+  schema = set()
+  for prop in entity.property_list():
+    schema.add((prop.name(), _SchemaValueType(prop.value())))
+  return tuple(sorted(schema))
+
+
+def _EntitySchemas(encoded_entities):
+  """Decodes some entities and returns their schemas. Runs in a worker
+  process when an old datastore file is read in parallel.
+
+  Args:
+    encoded_entities: list of encoded entity_pb.EntityProto
+
+  Returns:
+    list of the _EntitySchema() of each entity
+  """
+  return [_EntitySchema(entity_pb.EntityProto(encoded))
+          for encoded in encoded_entities]
+
+
+def _EntityKey(encoded_entity):
+  """Returns the key of an encoded entity, without decoding the rest of it.
+
+  Args:
+    encoded_entity: encoded entity_pb.EntityProto
+
+  Returns:
+    entity_pb.Reference
+  """
+  buf = array.array('B')
+  buf.fromstring(encoded_entity)
+  decoder = ProtocolBuffer.Decoder(buf, 0, len(buf))
+  while decoder.avail() > 0:
+    tag = decoder.getVarInt32()
+    if tag == 106:
+      length = decoder.getVarInt32()
+      start = decoder.pos()
+      return entity_pb.Reference(encoded_entity[start:start + length])
+    decoder.skipData(tag)
+  raise ProtocolBuffer.ProtocolBufferDecodeError('entity has no key')
+
+
+def _SetSchemaPlaceholder(value_pb, value_type):
+  """Sets the placeholder value that stands for a type in a schema.
+
+  Args:
+    value_pb: entity_pb.PropertyValue
+    value_type: string, as returned by _SchemaValueType()
+  """
+  if value_type == 'int64value':
+    value_pb.set_int64value(0)
+  elif value_type == 'booleanvalue':
+    value_pb.set_booleanvalue(False)
+  elif value_type == 'stringvalue':
+    value_pb.set_stringvalue('none')
+  elif value_type == 'doublevalue':
+    value_pb.set_doublevalue(0.0)
+  elif value_type == 'pointvalue':
+    value_pb.mutable_pointvalue().set_x(0.0)
+    value_pb.mutable_pointvalue().set_y(0.0)
+  elif value_type == 'uservalue':
+    value_pb.mutable_uservalue().set_gaiaid(0)
+    value_pb.mutable_uservalue().set_email('none')
+    value_pb.mutable_uservalue().set_auth_domain('none')
+  elif value_type == 'referencevalue':
+    value_pb.mutable_referencevalue().set_app('none')
+    pathelem = value_pb.mutable_referencevalue().add_pathelement()
+    pathelem.set_type('none')
+    pathelem.set_name('none')
+
+
 class _StoredEntity(object):
-  """Simple wrapper around an entity stored by the stub.
+  """An entity stored by the stub.
+
+  Only the encoded entity is kept. The other forms are decoded when they are
+  needed, and the native forms of recently used entities are kept in an
+  _EntityCache.
 
   Public properties:
-    protobuf: Native protobuf Python object, entity_pb.EntityProto.
-    encoded_protobuf: Encoded binary representation of above protobuf.
-    native: datastore.Entity instance.
+    encoded_protobuf: Encoded binary representation of the entity, an
+      entity_pb.EntityProto.
+    schema: tuple of the distinct (name, _SchemaValueType()) pairs of the
+      entity's indexed property values. Entities with the same pairs share
+      the tuple.
+    protobuf: entity_pb.EntityProto, decoded each time.
+    native: datastore.Entity instance, decoded or taken from the cache.
   """
 
-  def __init__(self, entity):
+  __slots__ = ('encoded_protobuf', 'schema', 'cache')
+
+  def __init__(self, encoded_protobuf, schema, cache):
     """Create a _StoredEntity object and store an entity.
 
     Args:
-      entity: entity_pb.EntityProto to store.
+      encoded_protobuf: the encoded entity_pb.EntityProto to store.
+      schema: tuple of (name, type) pairs
+      cache: _EntityCache for the native form.
     """
-    self.protobuf = entity
+    self.encoded_protobuf = encoded_protobuf
+    self.schema = schema
+    self.cache = cache
+
+  def protobuf(self):
+    return entity_pb.EntityProto(self.encoded_protobuf)
+  protobuf = property(protobuf)
 
-    self.encoded_protobuf = entity.Encode()
+  def native(self):
+    native = self.cache.Get(self)
+    if native is None:
+      native = datastore.Entity._FromPb(self.protobuf)
+      self.cache.Put(self, native)
+    return native
+  native = property(native)
 
-    self.native = datastore.Entity._FromPb(entity)
 
 class _Cursor(object):
   """A query cursor.
 
+  A cursor only holds the keys of its results. The entities are looked up
+  when a batch of results is returned, so a cursor doesn't keep old versions
+  of entities alive, and results that have been deleted since the query ran
+  are skipped.
+
   Public properties:
     cursor: the integer cursor
     count: the original total number of results
     keys_only: whether the query is keys_only
+    size: the estimated number of bytes held by the cursor
+    last_used: when the cursor was created or last returned results
 
   Class attributes:
     _next_cursor: the next cursor to allocate
@@ -114,19 +827,36 @@ class _Cursor(object):
   _next_cursor = 1
   _next_cursor_lock = threading.Lock()
 
-  def __init__(self, results, keys_only):
+  def __init__(self, results, keys_only, lookup, key_size=None):
     """Constructor.
 
     Args:
-      # the query results, in order, such that results[self.offset:] is
-      # the next result
-      results: list of entity_pb.EntityProto
+      # the keys of the query results, in order, such that
+      # results[self.offset:] is the next result
+      results: list of datastore_types.Key, or _SortedResults
       keys_only: integer
+      # returns the encoded entity_pb.EntityProto stored under a
+      # result key, or None if there is none
+      lookup: function
+      # returns the size in bytes of a result key. By default, results are
+      # datastore_types.Key, and this is the size of their protocol buffers.
+      key_size: function
     """
     self.__results = results
+    self.__lookup = lookup
     self.count = len(results)
     self.keys_only = keys_only
     self._offset = 0
+    self.last_used = time.time()
+
+    self.size = 0
+    if self.count:
+      first = results[0:1][0]
+      if key_size is None:
+        size = first._ToPb().ByteSize()
+      else:
+        size = key_size(first)
+      self.size = self.count * (size + _CURSOR_RESULT_OVERHEAD)
 
     self._next_cursor_lock.acquire()
     try:
@@ -144,6 +874,8 @@ class _Cursor(object):
       offset: integer, overrides the internal offset
       compiled: boolean, whether we are compiling this query
     """
+    self.last_used = time.time()
+
     _offset = offset
     if offset is None:
       _offset = self._offset
@@ -153,15 +885,18 @@ class _Cursor(object):
     result.mutable_cursor().set_cursor(self.cursor)
     result.set_keys_only(self.keys_only)
 
-    self.count = len(self.__results[_offset:_offset + count])
+    keys = self.__results[_offset:_offset + count]
+    self.count = len(keys)
 
-    results_pbs = [r._ToPb() for r in self.__results[_offset:_offset + count]]
-    result.result_list().extend(results_pbs)
+    for key in keys:
+      encoded = self.__lookup(key)
+      if encoded is not None:
+        result.add_result().MergeFromString(encoded)
 
     if offset is None:
       self._offset += self.count
 
-    result.set_more_results(len(self.__results[_offset + self.count:]) > 0)
+    result.set_more_results(len(self.__results) > _offset + self.count)
     if compiled and result.more_results():
       compiled_query = _FakeCompiledQuery(cursor=self.cursor,
                                           offset=_offset + self.count,
@@ -169,6 +904,141 @@ class _Cursor(object):
       result.mutable_compiled_query().CopyFrom(compiled_query._ToPb())
 
 
+class _CursorCache(object):
+  """The live cursors of a stub.
+
+  Cursors that haven't been used for _CURSOR_TTL seconds expire. When there
+  are more than _MAX_CURSORS cursors, or they hold more than
+  _MAX_CURSOR_BYTES between them, the least recently used ones are evicted.
+  The newest cursor is always kept.
+  """
+
+  def __init__(self):
+    self.__cursors = {}
+    self.__size = 0
+    self.__expired = 0
+    self.__evicted = 0
+    self.__lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.__cursors)
+
+  def Add(self, cursor):
+    """Adds a new cursor, and expires or evicts old ones.
+
+    Args:
+      cursor: _Cursor
+    """
+    self.__lock.acquire()
+    try:
+      self.__Expire()
+      self.__cursors[cursor.cursor] = cursor
+      self.__size += cursor.size
+
+      while (len(self.__cursors) > 1 and
+             (len(self.__cursors) > _MAX_CURSORS or
+              self.__size > _MAX_CURSOR_BYTES)):
+        oldest = min(self.__cursors.itervalues(),
+                     key=operator.attrgetter('last_used'))
+        if oldest is cursor:
+          break
+        self.__Remove(oldest.cursor)
+        self.__evicted += 1
+    finally:
+      self.__lock.release()
+
+  def Get(self, handle):
+    """Returns a live cursor.
+
+    Args:
+      handle: integer, the cursor's handle
+
+    Returns:
+      _Cursor
+
+    Raises:
+      KeyError if there is no such cursor, or it has expired or been evicted.
+    """
+    self.__lock.acquire()
+    try:
+      self.__Expire()
+      return self.__cursors[handle]
+    finally:
+      self.__lock.release()
+
+  def Remove(self, handle):
+    """Removes a cursor, if it is still live.
+
+    Args:
+      handle: integer, the cursor's handle
+    """
+    self.__lock.acquire()
+    try:
+      if handle in self.__cursors:
+        self.__Remove(handle)
+    finally:
+      self.__lock.release()
+
+  def Stats(self):
+    """Returns statistics about the live cursors.
+
+    Returns:
+      dict with 'cursors', the number of live cursors; 'bytes', their
+      estimated size; 'expired' and 'evicted', the number of cursors that
+      have been dropped for each reason so far.
+    """
+    self.__lock.acquire()
+    try:
+      return {'cursors': len(self.__cursors),
+              'bytes': self.__size,
+              'expired': self.__expired,
+              'evicted': self.__evicted,
+             }
+    finally:
+      self.__lock.release()
+
+  def __Remove(self, handle):
+    """Removes a cursor. The caller must hold the lock."""
+    self.__size -= self.__cursors.pop(handle).size
+
+  def __Expire(self):
+    """Removes cursors that have outlived _CURSOR_TTL. The caller must hold
+    the lock."""
+    deadline = time.time() - _CURSOR_TTL
+    for handle, cursor in self.__cursors.items():
+      if cursor.last_used < deadline:
+        self.__Remove(handle)
+        self.__expired += 1
+
+
+class _Transaction(object):
+  """The state of a transaction, until it commits or rolls back.
+
+  Public properties:
+    groups: dict mapping each entity group the transaction has used to its
+      version when the transaction first used it
+    changes: dict mapping entity_pb.Reference to the entity_pb.EntityProto to
+      store there at commit, or None to delete it
+  """
+
+  def __init__(self):
+    self.groups = {}
+    self.changes = {}
+
+
+def _EntityGroup(key):
+  """Returns the entity group that a key is in.
+
+  Args:
+    key: entity_pb.Reference
+
+  Returns:
+    tuple, which identifies the group's root entity
+  """
+  root = key.path().element(0)
+  return (key.app(), root.type(), root.id(), root.name())
+
+
 class _FakeCompiledQuery(object):
   def __init__(self, cursor, offset, keys_only=False):
     self.cursor = cursor
@@ -233,7 +1103,9 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
                history_file=None,
                require_indexes=False,
                service_name='datastore_v3',
-               trusted=False):
+               trusted=False,
+               use_journal=False,
+               entity_cache_size=_ENTITY_CACHE_SIZE):
     """Constructor.
 
     Initializes and loads the datastore from the backing files, if they exist.
@@ -248,6 +1120,10 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
       service_name: Service name expected for all calls.
       trusted: bool, default False.  If True, this stub allows an app to
         access the data of another app.
+      use_journal: bool, default False.  If True, writes are appended to a
+        journal instead of rewriting the whole datastore file each time.
+      entity_cache_size: int, the number of entities to keep decoded in
+        memory.  0 decodes entities every time they are used.
     """
     super(DatastoreFileStub, self).__init__(service_name)
 
@@ -258,15 +1134,19 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     self.SetTrusted(trusted)
 
     self.__entities = {}
+    self.__entity_cache = _EntityCache(entity_cache_size)
+    self.__kind_sizes = {}
 
-    self.__schema_cache = {}
-
-    self.__tx_snapshot = {}
+    self.__schema_counts = {}
+    self.__schemas = {}
 
-    self.__queries = {}
+    self.__queries = _CursorCache()
 
     self.__transactions = {}
 
+    self.__entity_group_versions = {}
+    self.__enlisted_groups = {}
+
     self.__indexes = {}
     self.__require_indexes = require_indexes
 
@@ -278,190 +1158,676 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     self.__id_lock = threading.Lock()
     self.__tx_handle_lock = threading.Lock()
     self.__index_id_lock = threading.Lock()
-    self.__tx_lock = threading.Lock()
     self.__entities_lock = threading.Lock()
     self.__file_lock = threading.Lock()
     self.__indexes_lock = threading.Lock()
 
+    self.__property_indexes = {}
+
+    self.__use_journal = use_journal
+    self.__journal = None
+    self.__journal_records = 0
+    self.__compaction_thread = None
+
     self.Read()
 
-  def Clear(self):
-    """ Clears the datastore by deleting all currently stored entities and
-    queries. """
-    self.__entities = {}
-    self.__queries = {}
-    self.__transactions = {}
-    self.__query_history = {}
-    self.__schema_cache = {}
+  def Clear(self):
+    """ Clears the datastore by deleting all currently stored entities and
+    queries. """
+    self.__entities = {}
+    self.__entity_cache.Clear()
+    self.__kind_sizes = {}
+    self.__queries = _CursorCache()
+    self.__transactions = {}
+    self.__entity_group_versions = {}
+    self.__enlisted_groups = {}
+    self.__query_history = {}
+    self.__schema_counts = {}
+    self.__schemas = {}
+    self.__property_indexes = {}
+
+  def GetMemoryStats(self):
+    """Returns statistics about the memory used by stored entities.
+
+    Returns:
+      dict with 'kinds', which maps each (app, kind) to a dict with
+      'entities', the number of entities of the kind, and 'bytes', their
+      total encoded size; and 'cache', a dict with the number of 'entries' in
+      the cache of decoded entities, and its 'hits' and 'misses' so far.
+    """
+    kinds = {}
+    for app_kind, size in self.__kind_sizes.items():
+      kinds[app_kind] = {'entities': len(self.__entities.get(app_kind, ())),
+                         'bytes': size}
+    cache = self.__entity_cache
+    return {'kinds': kinds,
+            'cache': {'entries': len(cache),
+                      'hits': cache.hits,
+                      'misses': cache.misses,
+                     },
+           }
+
+  def GetCursorStats(self):
+    """Returns statistics about the live query cursors.
+
+    Returns:
+      dict with 'cursors', the number of live cursors; 'bytes', their
+      estimated size; 'expired' and 'evicted', the number of cursors that
+      have been dropped for each reason so far.
+    """
+    return self.__queries.Stats()
+
+  def SetTrusted(self, trusted):
+    """Set/clear the trusted bit in the stub.
+
+    This bit indicates that the app calling the stub is trusted. A
+    trusted app can write to datastores of other apps.
+
+    Args:
+      trusted: boolean.
+    """
+    self.__trusted = trusted
+
+  def __ValidateAppId(self, app_id):
+    """Verify that this is the stub for app_id.
+
+    Args:
+      app_id: An application ID.
+
+    Raises:
+      datastore_errors.BadRequestError: if this is not the stub for app_id.
+    """
+    if not self.__trusted and app_id != self.__app_id:
+      raise datastore_errors.BadRequestError(
+          'app %s cannot access app %s\'s data' % (self.__app_id, app_id))
+
+  def __ValidateKey(self, key):
+    """Validate this key.
+
+    Args:
+      key: entity_pb.Reference
+
+    Raises:
+      datastore_errors.BadRequestError: if the key is invalid
+    """
+    assert isinstance(key, entity_pb.Reference)
+
+    self.__ValidateAppId(key.app())
+
+    for elem in key.path().element_list():
+      if elem.has_id() == elem.has_name():
+        raise datastore_errors.BadRequestError(
+          'each key path element should have id or name but not both: %r' % key)
+
+  def _AppIdNamespaceKindForKey(self, key):
+    """ Get (app, kind) tuple from given key.
+
+    The (app, kind) tuple is used as an index into several internal
+    dictionaries, e.g. __entities.
+
+    Args:
+      key: entity_pb.Reference
+
+    Returns:
+      Tuple (app, kind), both are unicode strings.
+    """
+    last_path = key.path().element_list()[-1]
+    return key.app(), last_path.type()
+
+  def _StoreEntity(self, entity, encoded=None):
+    """ Store the given entity.
+
+    Args:
+      entity: entity_pb.EntityProto
+      encoded: string, the encoded entity, if the caller already has it
+    """
+    if encoded is None:
+      encoded = entity.Encode()
+    self.__StoreEncoded(entity.key(), encoded, _EntitySchema(entity), entity)
+
+  def __StoreEncoded(self, key, encoded, schema, entity=None):
+    """Stores an encoded entity.
+
+    Args:
+      key: entity_pb.Reference, the entity's key
+      encoded: string, the encoded entity_pb.EntityProto
+      schema: tuple, the entity's _EntitySchema()
+      entity: entity_pb.EntityProto, the decoded entity, if the caller already
+        has it
+    """
+    app_kind = self._AppIdNamespaceKindForKey(key)
+    kind_dict = self.__entities.setdefault(app_kind, {})
+    schema = self.__schemas.setdefault(schema, schema)
+    stored = _StoredEntity(encoded, schema, self.__entity_cache)
+
+    old = kind_dict.setdefault(key, stored)
+    if old is stored:
+      old = None
+    else:
+      kind_dict[key] = stored
+    self.__BumpVersion(key)
+
+    counts = self.__schema_counts.setdefault(app_kind, {})
+    for pair in schema:
+      counts[pair] = counts.get(pair, 0) + 1
+    if old:
+      self.__UncountSchema(app_kind, old)
+
+    size = self.__kind_sizes.get(app_kind, 0) + len(encoded)
+    if old:
+      size -= len(old.encoded_protobuf)
+    self.__kind_sizes[app_kind] = size
+
+    indexes = self.__property_indexes.get(app_kind)
+    if indexes:
+      if entity is None:
+        entity = entity_pb.EntityProto(encoded)
+      native = datastore.Entity._FromPb(entity)
+      self.__entity_cache.Put(stored, native)
+      for index in indexes.itervalues():
+        if old:
+          index.Remove(key, old.native)
+        index.Add(key, native)
+
+    if old:
+      self.__entity_cache.Discard(old)
+
+  READ_PB_EXCEPTIONS = (ProtocolBuffer.ProtocolBufferDecodeError, LookupError,
+                        TypeError, ValueError)
+  READ_ERROR_MSG = ('Data in %s is corrupt or a different version. '
+                    'Try running with the --clear_datastore flag.\n%r')
+  READ_PY250_MSG = ('Are you using FloatProperty and/or GeoPtProperty? '
+                    'Unfortunately loading float values from the datastore '
+                    'file does not work with Python 2.5.0. '
+                    'Please upgrade to a newer Python 2.5 release or use '
+                    'the --clear_datastore flag.\n')
+
+  def Read(self):
+    """ Reads the datastore and history files into memory.
+
+    The in-memory query history is cleared, but the datastore is *not*
+    cleared; the entities in the files are merged into the entities in memory.
+    If you want them to overwrite the in-memory datastore, call Clear() before
+    calling Read().
+
+    If the datastore file contains an entity with the same app name, kind, and
+    key as an entity already in the datastore, the entity from the file
+    overwrites the entity in the datastore.
+
+    Any journals are replayed on top of the datastore file, and then written
+    into it, so that they start out empty again.
+
+    Also sets __next_id to one greater than the highest id allocated so far.
+    """
+    if self.__compaction_thread:
+      self.__compaction_thread.join()
+
+    if self.__datastore_file and self.__datastore_file != '/dev/null':
+      self.__ReadDatastore(self.__datastore_file)
+
+      replayed = False
+      for journal_file in JournalFiles(self.__datastore_file):
+        for records in self.__ReadJournal(journal_file):
+          replayed = True
+          for encoded_key, encoded_entity in records:
+            if encoded_entity is None:
+              self.__RemoveEntity(entity_pb.Reference(encoded_key))
+            else:
+              self.__LoadEntity(encoded_entity)
+
+      if replayed:
+        self.Write()
+
+  def __LoadEntity(self, encoded_entity):
+    """Decodes an entity from the datastore file or a journal and stores it.
+
+    Args:
+      encoded_entity: string, the encoded entity_pb.EntityProto
+    """
+    try:
+      entity = entity_pb.EntityProto(encoded_entity)
+    except self.READ_PB_EXCEPTIONS, e:
+      raise datastore_errors.InternalError(self.READ_ERROR_MSG %
+                                           (self.__datastore_file, e))
+    except struct.error, e:
+      if (sys.version_info[0:3] == (2, 5, 0)
+          and e.message.startswith('unpack requires a string argument')):
+        raise datastore_errors.InternalError(self.READ_PY250_MSG +
+                                             self.READ_ERROR_MSG %
+                                             (self.__datastore_file, e))
+      else:
+        raise
+
+    self._StoreEntity(entity, encoded_entity)
+    self.__AdvanceNextId(entity.key())
+
+  def __LoadEncoded(self, encoded_entity, schema):
+    """Stores an entity from the datastore file, without decoding it.
+
+    Args:
+      encoded_entity: string, the encoded entity_pb.EntityProto
+      schema: tuple, the entity's _EntitySchema()
+    """
+    key = _EntityKey(encoded_entity)
+    self.__StoreEncoded(key, encoded_entity, schema)
+    self.__AdvanceNextId(key)
+
+  def __LoadEntities(self, encoded_entities):
+    """Stores the entities of a datastore file in the old format, which have
+    to be decoded to find their schemas. Many entities are decoded in
+    parallel by a pool of processes, if there is more than one CPU.
+
+    Args:
+      encoded_entities: list of encoded entity_pb.EntityProto
+    """
+    pool = None
+    if multiprocessing and len(encoded_entities) >= _MIN_PARALLEL_ENTITIES:
+      try:
+        if multiprocessing.cpu_count() > 1:
+          pool = multiprocessing.Pool()
+      except (NotImplementedError, OSError), e:
+        logging.warning('Could not decode the datastore in parallel: %s', e)
+
+    if pool is None:
+      for encoded_entity in encoded_entities:
+        self.__LoadEntity(encoded_entity)
+      return
+
+    try:
+      chunks = [encoded_entities[start:start + _FILE_CHUNK_SIZE]
+                for start in xrange(0, len(encoded_entities), _FILE_CHUNK_SIZE)]
+      try:
+        for chunk, schemas in itertools.izip(
+            chunks, pool.imap(_EntitySchemas, chunks)):
+          for encoded_entity, schema in itertools.izip(chunk, schemas):
+            self.__LoadEncoded(encoded_entity, schema)
+      except self.READ_PB_EXCEPTIONS, e:
+        raise datastore_errors.InternalError(self.READ_ERROR_MSG %
+                                             (self.__datastore_file, e))
+    finally:
+      pool.terminate()
+
+  def __AdvanceNextId(self, key):
+    """Makes sure that ids allocated from now on are greater than a key's id.
+
+    Args:
+      key: entity_pb.Reference
+    """
+    last_path = key.path().element_list()[-1]
+    if last_path.has_id() and last_path.id() >= self.__next_id:
+      self.__next_id = last_path.id() + 1
+
+  def __RemoveEntity(self, key):
+    """Removes an entity from memory, if it is there.
+
+    Args:
+      key: entity_pb.Reference
+
+    Returns:
+      True if the entity was removed, False if it did not exist.
+    """
+    app_kind = self._AppIdNamespaceKindForKey(key)
+    try:
+      old = self.__entities[app_kind].pop(key)
+    except KeyError:
+      return False
+    self.__BumpVersion(key)
+
+    for index in self.__property_indexes.get(app_kind, {}).itervalues():
+      index.Remove(key, old.native)
+    self.__entity_cache.Discard(old)
+
+    self.__kind_sizes[app_kind] -= len(old.encoded_protobuf)
+    self.__UncountSchema(app_kind, old)
+    if not self.__entities[app_kind]:
+      del self.__entities[app_kind]
+      del self.__kind_sizes[app_kind]
+      del self.__schema_counts[app_kind]
+    return True
+
+  def __UncountSchema(self, app_kind, old):
+    """Takes an entity that is no longer stored out of its kind's schema.
+
+    Args:
+      app_kind: (app, kind) tuple
+      old: _StoredEntity
+    """
+    counts = self.__schema_counts[app_kind]
+    for pair in old.schema:
+      if counts[pair] == 1:
+        del counts[pair]
+      else:
+        counts[pair] -= 1
 
-  def SetTrusted(self, trusted):
-    """Set/clear the trusted bit in the stub.
+  def __BumpVersion(self, key):
+    """Records that an entity group has been written to, so that transactions
+    which used it before can't commit.
 
-    This bit indicates that the app calling the stub is trusted. A
-    trusted app can write to datastores of other apps.
+    Only the groups which open transactions have enlisted need a version, so
+    writes to any other group are not recorded. Must be called with
+    self.__entities_lock held.
 
     Args:
-      trusted: boolean.
+      key: entity_pb.Reference of an entity in the group
     """
-    self.__trusted = trusted
+    group = _EntityGroup(key)
+    if group in self.__enlisted_groups:
+      self.__entity_group_versions[group] = (
+          self.__entity_group_versions.get(group, 0) + 1)
 
-  def __ValidateAppId(self, app_id):
-    """Verify that this is the stub for app_id.
+  def __GetTransaction(self, transaction):
+    """Returns the state of a transaction.
 
     Args:
-      app_id: An application ID.
+      transaction: datastore_pb.Transaction
+
+    Returns:
+      _Transaction
 
     Raises:
-      datastore_errors.BadRequestError: if this is not the stub for app_id.
+      apiproxy_errors.ApplicationError if there is no such transaction.
     """
-    if not self.__trusted and app_id != self.__app_id:
-      raise datastore_errors.BadRequestError(
-          'app %s cannot access app %s\'s data' % (self.__app_id, app_id))
+    try:
+      return self.__transactions[transaction.handle()]
+    except KeyError:
+      raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.BAD_REQUEST,
+        'Transaction handle %d not found' % transaction.handle())
 
-  def __ValidateKey(self, key):
-    """Validate this key.
+  def __EnlistGroup(self, tx, key):
+    """Records the version of an entity group when a transaction first uses
+    it.
 
     Args:
-      key: entity_pb.Reference
+      tx: _Transaction
+      key: entity_pb.Reference of an entity in the group
+    """
+    group = _EntityGroup(key)
+    if group not in tx.groups:
+      self.__entities_lock.acquire()
+      try:
+        tx.groups[group] = self.__entity_group_versions.get(group, 0)
+        self.__enlisted_groups[group] = (
+            self.__enlisted_groups.get(group, 0) + 1)
+      finally:
+        self.__entities_lock.release()
 
-    Raises:
-      datastore_errors.BadRequestError: if the key is invalid
+  def __ReleaseGroups(self, tx):
+    """Forgets a finished transaction's entity groups. A group's version is
+    dropped once no open transaction has it enlisted. Must be called with
+    self.__entities_lock held.
+
+    Args:
+      tx: _Transaction
     """
-    assert isinstance(key, entity_pb.Reference)
+    for group in tx.groups:
+      count = self.__enlisted_groups.get(group, 0) - 1
+      if count > 0:
+        self.__enlisted_groups[group] = count
+      else:
+        self.__enlisted_groups.pop(group, None)
+        self.__entity_group_versions.pop(group, None)
 
-    self.__ValidateAppId(key.app())
+  def Write(self):
+    """ Writes out the datastore and history files. Be careful! If the files
+    already exist, this method overwrites them!
 
-    for elem in key.path().element_list():
-      if elem.has_id() == elem.has_name():
-        raise datastore_errors.BadRequestError(
-          'each key path element should have id or name but not both: %r' % key)
+    Everything in the journals is then in the datastore file, so they are
+    removed.
+    """
+    if self.__compaction_thread:
+      self.__compaction_thread.join()
 
-  def _AppIdNamespaceKindForKey(self, key):
-    """ Get (app, kind) tuple from given key.
+    self.__WriteDatastore()
 
-    The (app, kind) tuple is used as an index into several internal
-    dictionaries, e.g. __entities.
+    if self.__datastore_file and self.__datastore_file != '/dev/null':
+      self.__file_lock.acquire()
+      try:
+        self.__CloseJournal()
+        for journal_file in JournalFiles(self.__datastore_file):
+          if os.path.exists(journal_file):
+            os.remove(journal_file)
+      finally:
+        self.__file_lock.release()
 
-    Args:
-      key: entity_pb.Reference
+  def __WriteDatastore(self):
+    """ Writes out the datastore file. Be careful! If the file already exist,
+    this method overwrites it!
+    """
+    if self.__datastore_file and self.__datastore_file != '/dev/null':
+      self.__WriteChunked(self.__Snapshot(), self.__datastore_file)
+
+  def __Snapshot(self):
+    """Returns what has to be written to the datastore file.
 
     Returns:
-      Tuple (app, kind), both are unicode strings.
+      list of (encoded entity_pb.EntityProto, schema) pairs, one for each
+      stored entity
     """
-    last_path = key.path().element_list()[-1]
-    return key.app(), last_path.type()
+    records = []
+    for kind_dict in self.__entities.values():
+      for entity in kind_dict.values():
+        records.append((entity.encoded_protobuf, entity.schema))
+    return records
 
-  def _StoreEntity(self, entity):
-    """ Store the given entity.
+  def __WriteChanges(self, changes):
+    """ Persists some changed entities. In journal mode, they are appended to
+    the journal, otherwise the whole datastore file is written out.
+
+    The caller must hold __entities_lock, so that changes to the same entity
+    are persisted in the same order as they were made in memory, and a
+    journal replay ends with the last of them.
 
     Args:
-      entity: entity_pb.EntityProto
+      changes: list of (entity_pb.Reference, string) pairs, where the string is
+        the encoded entity_pb.EntityProto, or None if the entity was deleted.
     """
-    key = entity.key()
-    app_kind = self._AppIdNamespaceKindForKey(key)
-    if app_kind not in self.__entities:
-      self.__entities[app_kind] = {}
-    self.__entities[app_kind][key] = _StoredEntity(entity)
+    if not self.__use_journal:
+      self.__WriteDatastore()
+      return
 
-    if app_kind in self.__schema_cache:
-      del self.__schema_cache[app_kind]
+    if not self.__datastore_file or self.__datastore_file == '/dev/null':
+      return
 
-  READ_PB_EXCEPTIONS = (ProtocolBuffer.ProtocolBufferDecodeError, LookupError,
-                        TypeError, ValueError)
-  READ_ERROR_MSG = ('Data in %s is corrupt or a different version. '
-                    'Try running with the --clear_datastore flag.\n%r')
-  READ_PY250_MSG = ('Are you using FloatProperty and/or GeoPtProperty? '
-                    'Unfortunately loading float values from the datastore '
-                    'file does not work with Python 2.5.0. '
-                    'Please upgrade to a newer Python 2.5 release or use '
-                    'the --clear_datastore flag.\n')
+    records = [(key.Encode(), encoded) for key, encoded in changes]
+    if not records:
+      return
 
-  def Read(self):
-    """ Reads the datastore and history files into memory.
+    self.__file_lock.acquire()
+    try:
+      if self.__journal is None:
+        self.__journal = open(JournalFiles(self.__datastore_file)[-1], 'ab')
+      pickle.dump(records, self.__journal, 1)
+      self.__journal.flush()
+      self.__journal_records += len(records)
+    finally:
+      self.__file_lock.release()
 
-    The in-memory query history is cleared, but the datastore is *not*
-    cleared; the entities in the files are merged into the entities in memory.
-    If you want them to overwrite the in-memory datastore, call Clear() before
-    calling Read().
+    num_entities = sum([len(kind_dict)
+                        for kind_dict in self.__entities.values()])
+    if self.__journal_records > max(_MIN_JOURNAL_RECORDS, num_entities):
+      self.__StartCompaction()
 
-    If the datastore file contains an entity with the same app name, kind, and
-    key as an entity already in the datastore, the entity from the file
-    overwrites the entity in the datastore.
+  def __CloseJournal(self):
+    """Closes the current journal. The caller must hold __file_lock."""
+    if self.__journal is not None:
+      self.__journal.close()
+      self.__journal = None
+    self.__journal_records = 0
 
-    Also sets __next_id to one greater than the highest id allocated so far.
+  def __StartCompaction(self):
+    """Starts a background thread which writes out the whole datastore file,
+    so that the journal can start again.
+
+    The current journal is set aside first. If an earlier compaction failed to
+    finish, the journal is appended to the one it set aside instead, since
+    neither is in the datastore file yet.
+
+    The caller must hold __entities_lock, so that the snapshot matches the
+    journal that is set aside, and only one compaction is started at a time.
     """
-    if self.__datastore_file and self.__datastore_file != '/dev/null':
-      for encoded_entity in self.__ReadPickled(self.__datastore_file):
+    if self.__compaction_thread and self.__compaction_thread.isAlive():
+      return
+
+    compacting_file, journal_file = JournalFiles(self.__datastore_file)
+
+    records = self.__Snapshot()
+
+    self.__file_lock.acquire()
+    try:
+      self.__CloseJournal()
+      if os.path.exists(compacting_file):
+        compacting = open(compacting_file, 'ab')
         try:
-          entity = entity_pb.EntityProto(encoded_entity)
-        except self.READ_PB_EXCEPTIONS, e:
-          raise datastore_errors.InternalError(self.READ_ERROR_MSG %
-                                               (self.__datastore_file, e))
-        except struct.error, e:
-          if (sys.version_info[0:3] == (2, 5, 0)
-              and e.message.startswith('unpack requires a string argument')):
-            raise datastore_errors.InternalError(self.READ_PY250_MSG +
-                                                 self.READ_ERROR_MSG %
-                                                 (self.__datastore_file, e))
-          else:
-            raise
+          compacting.write(open(journal_file, 'rb').read())
+        finally:
+          compacting.close()
+        os.remove(journal_file)
+      else:
+        os.rename(journal_file, compacting_file)
+    finally:
+      self.__file_lock.release()
 
-        self._StoreEntity(entity)
+    self.__compaction_thread = threading.Thread(target=self.__Compact,
+                                                args=(records,))
+    self.__compaction_thread.setDaemon(True)
+    self.__compaction_thread.start()
 
-        last_path = entity.key().path().element_list()[-1]
-        if last_path.has_id() and last_path.id() >= self.__next_id:
-          self.__next_id = last_path.id() + 1
+  def __Compact(self, records):
+    """Writes out the datastore file, then removes the journal which was set
+    aside for it. Runs in the compaction thread.
 
-  def Write(self):
-    """ Writes out the datastore and history files. Be careful! If the files
-    already exist, this method overwrites them!
+    Args:
+      records: list of (encoded entity_pb.EntityProto, schema) pairs, as
+        returned by __Snapshot()
     """
-    self.__WriteDatastore()
+    try:
+      self.__WriteChunked(records, self.__datastore_file)
 
-  def __WriteDatastore(self):
-    """ Writes out the datastore file. Be careful! If the file already exist,
-    this method overwrites it!
-    """
-    if self.__datastore_file and self.__datastore_file != '/dev/null':
-      encoded = []
-      for kind_dict in self.__entities.values():
-        for entity in kind_dict.values():
-          encoded.append(entity.encoded_protobuf)
+      self.__file_lock.acquire()
+      try:
+        os.remove(JournalFiles(self.__datastore_file)[0])
+      finally:
+        self.__file_lock.release()
+    except (IOError, OSError), e:
+      logging.warning('Could not compact the datastore journal: %s', e)
+
+  def __ReadJournal(self, filename):
+    """Reads the batches of changes recorded in a journal file.
 
-      self.__WritePickled(encoded, self.__datastore_file)
+    A batch which was only partly written, because the server stopped while
+    writing it, ends the journal.
 
-  def __ReadPickled(self, filename):
-    """Reads a pickled object from the given file and returns it.
+    Args:
+      filename: string, the journal file
+
+    Returns:
+      list of lists of (encoded entity_pb.Reference, encoded
+      entity_pb.EntityProto or None) pairs
     """
+    batches = []
+
     self.__file_lock.acquire()
+    try:
+      if not os.path.isfile(filename):
+        return batches
+
+      journal = open(filename, 'rb')
+      try:
+        while True:
+          try:
+            batches.append(pickle.load(journal))
+          except EOFError:
+            break
+          except (AttributeError, LookupError, ImportError, NameError,
+                  TypeError, ValueError, struct.error, pickle.PickleError), e:
+            logging.warning('Ignoring the end of datastore journal %s: %r',
+                            filename, e)
+            break
+      finally:
+        journal.close()
+    finally:
+      self.__file_lock.release()
+
+    return batches
 
+  def __ReadDatastore(self, filename):
+    """Reads the datastore file and stores its entities.
+
+    A file in the chunked format is read and stored a chunk at a time, and
+    its entities are not decoded. A file in the old format, a single pickled
+    list of encoded entities, is read all at once.
+
+    Args:
+      filename: string, the datastore file
+    """
+    self.__file_lock.acquire()
     try:
+      if not os.path.isfile(filename):
+        logging.warning('Could not read datastore data from %s', filename)
+        return
+
+      datastore_file = open(filename, 'rb')
       try:
-        if filename and filename != '/dev/null' and os.path.isfile(filename):
-          return pickle.load(open(filename, 'rb'))
-        else:
-          logging.warning('Could not read datastore data from %s', filename)
-      except (AttributeError, LookupError, ImportError, NameError, TypeError,
-              ValueError, struct.error, pickle.PickleError), e:
-        raise datastore_errors.InternalError(
-          'Could not read data from %s. Try running with the '
-          '--clear_datastore flag. Cause:\n%r' % (filename, e))
+        try:
+          try:
+            first = pickle.load(datastore_file)
+          except EOFError:
+            return
+          if first != _FILE_FORMAT:
+            self.__LoadEntities(first)
+            return
+
+          while True:
+            try:
+              schemas, records = pickle.load(datastore_file)
+            except EOFError:
+              break
+            for index, encoded_entity in records:
+              self.__LoadEncoded(encoded_entity, schemas[index])
+        except (AttributeError, LookupError, ImportError, NameError, TypeError,
+                ValueError, struct.error, pickle.PickleError,
+                ProtocolBuffer.ProtocolBufferDecodeError), e:
+          raise datastore_errors.InternalError(
+            'Could not read data from %s. Try running with the '
+            '--clear_datastore flag. Cause:\n%r' % (filename, e))
+      finally:
+        datastore_file.close()
     finally:
       self.__file_lock.release()
 
-    return []
+  def __WriteChunked(self, records, filename, openfile=file):
+    """Writes entities to the given file in the chunked format.
 
-  def __WritePickled(self, obj, filename, openfile=file):
-    """Pickles the object and writes it to the given file.
+    The file holds _FILE_FORMAT, and then pickled chunks of up to
+    _FILE_CHUNK_SIZE entities. Each chunk is a list of the distinct schemas
+    of its entities, and a list of (schema index, encoded entity) pairs. The
+    entities can be stored from there without decoding them, since their
+    keys can be picked out of them.
+
+    Args:
+      records: list of (encoded entity_pb.EntityProto, schema) pairs
+      filename: string, the datastore file
     """
-    if not filename or filename == '/dev/null' or not obj:
+    if not filename or filename == '/dev/null':
       return
 
     tmpfile = openfile(os.tempnam(os.path.dirname(filename)), 'wb')
 
     pickler = pickle.Pickler(tmpfile, protocol=1)
     pickler.fast = True
-    pickler.dump(obj)
+    pickler.dump(_FILE_FORMAT)
+    for start in xrange(0, len(records), _FILE_CHUNK_SIZE):
+      schemas = []
+      indexes = {}
+      chunk = []
+      for encoded, schema in records[start:start + _FILE_CHUNK_SIZE]:
+        index = indexes.get(id(schema))
+        if index is None:
+          index = indexes[id(schema)] = len(schemas)
+          schemas.append(schema)
+        chunk.append((index, encoded))
+      pickler.dump((schemas, chunk))
 
     tmpfile.close()
 
@@ -536,71 +1902,78 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
         assert (clone.has_entity_group() and
                 clone.entity_group().element_size() > 0)
 
-    self.__entities_lock.acquire()
-
-    try:
+    if put_request.has_transaction():
+      tx = self.__GetTransaction(put_request.transaction())
       for clone in clones:
-        self._StoreEntity(clone)
-    finally:
-      self.__entities_lock.release()
-
-    if not put_request.has_transaction():
-      self.__WriteDatastore()
+        self.__EnlistGroup(tx, clone.key())
+        tx.changes[clone.key()] = clone
+    else:
+      self.__entities_lock.acquire()
+      try:
+        for clone in clones:
+          self._StoreEntity(clone)
+        self.__WriteChanges([(clone.key(), clone.Encode())
+                             for clone in clones])
+      finally:
+        self.__entities_lock.release()
 
     put_response.key_list().extend([c.key() for c in clones])
 
 
   def _Dynamic_Get(self, get_request, get_response):
+    tx = None
     if get_request.has_transaction():
-      entities = self.__tx_snapshot
-    else:
-      entities = self.__entities
+      tx = self.__GetTransaction(get_request.transaction())
+    entities = self.__entities
 
     for key in get_request.key_list():
       self.__ValidateAppId(key.app())
       app_kind = self._AppIdNamespaceKindForKey(key)
+      if tx is not None:
+        self.__EnlistGroup(tx, key)
 
       group = get_response.add_entity()
       try:
-        entity = entities[app_kind][key].protobuf
+        encoded = entities[app_kind][key].encoded_protobuf
       except KeyError:
-        entity = None
+        encoded = None
 
-      if entity:
-        group.mutable_entity().CopyFrom(entity)
+      if encoded:
+        group.mutable_entity().MergeFromString(encoded)
 
 
   def _Dynamic_Delete(self, delete_request, delete_response):
+    for key in delete_request.key_list():
+      self.__ValidateAppId(key.app())
+
+    if delete_request.has_transaction():
+      tx = self.__GetTransaction(delete_request.transaction())
+      for key in delete_request.key_list():
+        self.__EnlistGroup(tx, key)
+        tx.changes[key] = None
+      return
+
+    deleted = []
     self.__entities_lock.acquire()
     try:
       for key in delete_request.key_list():
-        self.__ValidateAppId(key.app())
-        app_kind = self._AppIdNamespaceKindForKey(key)
-        try:
-          del self.__entities[app_kind][key]
-          if not self.__entities[app_kind]:
-            del self.__entities[app_kind]
-
-          del self.__schema_cache[app_kind]
-        except KeyError:
-          pass
-
-        if not delete_request.has_transaction():
-          self.__WriteDatastore()
+        if self.__RemoveEntity(key):
+          deleted.append(key)
+      if deleted:
+        self.__WriteChanges([(key, None) for key in deleted])
     finally:
       self.__entities_lock.release()
 
 
   def _Dynamic_RunQuery(self, query, query_result, count=None):
-    if not self.__tx_lock.acquire(False):
+    if query.has_transaction():
       if not query.has_ancestor():
         raise apiproxy_errors.ApplicationError(
           datastore_pb.Error.BAD_REQUEST,
           'Only ancestor queries are allowed inside transactions.')
-      entities = self.__tx_snapshot
-    else:
-      entities = self.__entities
-      self.__tx_lock.release()
+      tx = self.__GetTransaction(query.transaction())
+      self.__EnlistGroup(tx, query.ancestor())
+    entities = self.__entities
 
     app_id_namespace = datastore_types.parse_app_id_namespace(query.app())
     app_id = app_id_namespace.app_id()
@@ -655,8 +2028,16 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     try:
       query.set_app(app_id_namespace.to_encoded())
       if query.has_kind():
-        results = entities[app_id_namespace.to_encoded(), query.kind()].values()
-        results = [entity.native for entity in results]
+        app_kind = (app_id_namespace.to_encoded(), query.kind())
+        kind_dict = entities[app_kind]
+        keys = self.__IndexedCandidates(app_id, app_kind, filters, orders)
+        if keys is None:
+          results = [entity.native for entity in kind_dict.values()]
+        else:
+          # The indexes are read without the entities lock, so an entity may
+          # have been deleted since; skip it rather than failing the query.
+          stored = [kind_dict.get(key) for key in keys]
+          results = [entity.native for entity in stored if entity is not None]
       else:
         results = []
         for key in entities:
@@ -672,84 +2053,12 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
         return path[:len(ancestor_path)] == ancestor_path
       results = filter(is_descendant, results)
 
-    operators = {datastore_pb.Query_Filter.LESS_THAN:             '<',
-                 datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:    '<=',
-                 datastore_pb.Query_Filter.GREATER_THAN:          '>',
-                 datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
-                 datastore_pb.Query_Filter.EQUAL:                 '==',
-                 }
-
-    def has_prop_indexed(entity, prop):
-      """Returns True if prop is in the entity and is indexed."""
-      if prop in datastore_types._SPECIAL_PROPERTIES:
-        return True
-      elif prop in entity.unindexed_properties():
-        return False
-
-      values = entity.get(prop, [])
-      if not isinstance(values, (tuple, list)):
-        values = [values]
-
-      for value in values:
-        if type(value) not in datastore_types._RAW_PROPERTY_TYPES:
-          return True
-      return False
-
-    for filt in filters:
-      assert filt.op() != datastore_pb.Query_Filter.IN
-
-      prop = filt.property(0).name().decode('utf-8')
-      op = operators[filt.op()]
-
-      filter_val_list = [datastore_types.FromPropertyPb(filter_prop)
-                         for filter_prop in filt.property_list()]
-
-      def passes_filter(entity):
-        """Returns True if the entity passes the filter, False otherwise.
-
-        The filter being evaluated is filt, the current filter that we're on
-        in the list of filters in the query.
-        """
-        if not has_prop_indexed(entity, prop):
-          return False
-
-        try:
-          entity_vals = datastore._GetPropertyValue(entity, prop)
-        except KeyError:
-          entity_vals = []
-
-        if not isinstance(entity_vals, list):
-          entity_vals = [entity_vals]
-
-        for fixed_entity_val in entity_vals:
-          for filter_val in filter_val_list:
-            fixed_entity_type = self._PROPERTY_TYPE_TAGS.get(
-              fixed_entity_val.__class__)
-            filter_type = self._PROPERTY_TYPE_TAGS.get(filter_val.__class__)
-            if fixed_entity_type == filter_type:
-              comp = u'%r %s %r' % (fixed_entity_val, op, filter_val)
-            elif op != '==':
-              comp = '%r %s %r' % (fixed_entity_type, op, filter_type)
-            else:
-              continue
-
-            logging.log(logging.DEBUG - 1,
-                        'Evaling filter expression "%s"', comp)
-
-            try:
-              ret = eval(comp)
-              if ret and ret != NotImplementedError:
-                return True
-            except TypeError:
-              pass
-
-        return False
-
+    for passes_filter in [_CompileFilter(filt) for filt in filters]:
       results = filter(passes_filter, results)
 
     for order in orders:
       prop = order.property().decode('utf-8')
-      results = [entity for entity in results if has_prop_indexed(entity, prop)]
+      results = [entity for entity in results if _HasPropIndexed(entity, prop)]
 
     def order_compare_entities(a, b):
       """ Return a negative, zero or positive number depending on whether
@@ -803,7 +2112,31 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
       else:
         return cmp(x_type, y_type)
 
-    results.sort(order_compare_entities)
+    order_properties = [
+        (o.property().decode('utf-8'),
+         o.direction() is datastore_pb.Query_Order.DESCENDING)
+        for o in orders]
+
+    def entity_sort_key(entity):
+      """Return the key which sorts entities the same way that
+      order_compare_entities compares them."""
+      key = []
+      for prop, descending in order_properties:
+        value = datastore._GetPropertyValue(entity, prop)
+        if isinstance(value, list):
+          if descending:
+            value_key = max([_SortKey(v) for v in value])
+          else:
+            value_key = min([_SortKey(v) for v in value])
+        else:
+          value_key = _SortKey(value)
+
+        if descending:
+          value_key = _ReverseOrder(value_key)
+        key.append(value_key)
+
+      key.append(entity.key())
+      return tuple(key)
 
     offset = 0
     limit = len(results)
@@ -813,7 +2146,8 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
       limit = query.limit()
     if limit > _MAXIMUM_RESULTS:
       limit = _MAXIMUM_RESULTS
-    results = results[offset:]
+    results = _SortedResults(results, entity_sort_key, order_compare_entities,
+                             offset, offset + limit)
 
     clone = datastore_pb.Query()
     clone.CopyFrom(query)
@@ -823,8 +2157,18 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     else:
       self.__query_history[clone] = 1
 
-    cursor = _Cursor(results, query.keys_only())
-    self.__queries[cursor.cursor] = cursor
+    def lookup(key):
+      """Return the entity that a result's key refers to, if it's still
+      there."""
+      reference = key._ToPb()
+      app_kind = self._AppIdNamespaceKindForKey(reference)
+      stored = entities.get(app_kind, {}).get(reference)
+      if stored is None:
+        return None
+      return stored.encoded_protobuf
+
+    cursor = _Cursor(results, query.keys_only(), lookup)
+    self.__queries.Add(cursor)
 
     if count is None:
       if query.has_count():
@@ -836,12 +2180,143 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
 
     cursor.PopulateQueryResult(query_result, count, compiled=query.compile())
 
+  def __GetPropertyIndex(self, app_kind, properties):
+    """Returns the in-memory index of some properties of a kind, building it
+    if this is the first time it is needed.
+
+    Args:
+      app_kind: (app, kind) tuple
+      properties: tuple of property names
+
+    Returns:
+      _PropertyIndex
+    """
+    kind_indexes = self.__property_indexes.setdefault(app_kind, {})
+    index = kind_indexes.get(properties)
+    if index is None:
+      self.__entities_lock.acquire()
+      try:
+        index = _PropertyIndex(properties)
+        index.Build(self.__entities.get(app_kind, {}))
+        kind_indexes[properties] = index
+      finally:
+        self.__entities_lock.release()
+    return index
+
+  def __IndexedCandidates(self, app_id, app_kind, filters, orders):
+    """Uses the in-memory indexes to find the entities a query could match.
+
+    Equality and inequality filters are answered by a range scan of the index
+    of their property, or of a composite index whose properties start with
+    the ones that have equality filters. A composite index only has rows for
+    entities with all of its properties, so it is only used if the query
+    filters or sorts on all of them. A sort order can be answered by a scan
+    of the whole index of its property. The smallest range is used, and the
+    filters and orders must still be applied to the entities it returns.
+
+    Args:
+      app_id: string, the app the query is for
+      app_kind: (app, kind) tuple
+      filters: list of datastore_pb.Query_Filter, normalized
+      orders: list of datastore_pb.Query_Order, normalized
+
+    Returns:
+      list of entity_pb.Reference, or None if no index can be used
+    """
+    equal = {}
+    lower = {}
+    upper = {}
+    for filt in filters:
+      if filt.property_size() != 1:
+        continue
+      prop = filt.property(0).name().decode('utf-8')
+      if prop in datastore_types._SPECIAL_PROPERTIES:
+        continue
+      value = _IndexValue(datastore_types.FromPropertyPb(filt.property(0)))
+      if value is None:
+        continue
+
+      op = filt.op()
+      if op == datastore_pb.Query_Filter.EQUAL:
+        equal.setdefault(prop, value)
+      elif op in (datastore_pb.Query_Filter.GREATER_THAN,
+                  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL):
+        inclusive = (op == datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL)
+        if prop not in lower or (value, not inclusive) > (lower[prop][0],
+                                                          not lower[prop][1]):
+          lower[prop] = (value, inclusive)
+      elif op in (datastore_pb.Query_Filter.LESS_THAN,
+                  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL):
+        inclusive = (op == datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL)
+        if prop not in upper or (value, inclusive) < upper[prop]:
+          upper[prop] = (value, inclusive)
+
+    scans = []
+    for prop in set(equal) | set(lower) | set(upper):
+      if prop in equal:
+        scans.append(((prop,), (equal[prop],), None, None))
+      else:
+        scans.append(((prop,), (), lower.get(prop), upper.get(prop)))
+
+    required = set([filt.property(0).name().decode('utf-8')
+                    for filt in filters])
+    required.update([order.property().decode('utf-8') for order in orders])
+
+    for index in self.__indexes.get(app_id, []):
+      definition = index.definition()
+      if (definition.entity_type() != app_kind[1] or definition.ancestor()):
+        continue
+      props = tuple([prop.name().decode('utf-8')
+                     for prop in definition.property_list()])
+      if not required.issuperset(props):
+        continue
+      prefix = []
+      for prop in props:
+        if prop not in equal:
+          break
+        prefix.append(equal[prop])
+      if not prefix:
+        continue
+      elif len(prefix) < len(props):
+        following = props[len(prefix)]
+        scans.append((props, tuple(prefix), lower.get(following),
+                      upper.get(following)))
+      else:
+        scans.append((props, tuple(prefix), None, None))
+
+    if orders:
+      prop = orders[0].property().decode('utf-8')
+      if prop not in datastore_types._SPECIAL_PROPERTIES:
+        scans.append(((prop,), (), None, None))
+
+    best = None
+    for props, prefix, lower_bound, upper_bound in scans:
+      index = self.__GetPropertyIndex(app_kind, props)
+      if index.unindexable:
+        continue
+      if lower_bound and upper_bound and index.multiple:
+        lower_start, lower_end = index.Range(prefix, lower_bound)
+        upper_start, upper_end = index.Range(prefix, None, upper_bound)
+        if lower_end - lower_start < upper_end - upper_start:
+          start, end = lower_start, lower_end
+        else:
+          start, end = upper_start, upper_end
+      else:
+        start, end = index.Range(prefix, lower_bound, upper_bound)
+      if best is None or end - start < best[2] - best[1]:
+        best = (index, start, end)
+
+    if best is None:
+      return None
+    index, start, end = best
+    return index.Keys(start, end)
+
   def _Dynamic_RunCompiledQuery(self, compiled_request, query_result):
     cursor_handle = compiled_request.compiled_query().limit()
     cursor_offset = compiled_request.compiled_query().offset()
 
     try:
-      cursor = self.__queries[cursor_handle]
+      cursor = self.__queries.Get(cursor_handle)
     except KeyError:
       raise apiproxy_errors.ApplicationError(
           datastore_pb.Error.BAD_REQUEST, 'Cursor %d not found' % cursor_handle)
@@ -856,7 +2331,7 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     cursor_handle = next_request.cursor().cursor()
 
     try:
-      cursor = self.__queries[cursor_handle]
+      cursor = self.__queries.Get(cursor_handle)
     except KeyError:
       raise apiproxy_errors.ApplicationError(
           datastore_pb.Error.BAD_REQUEST, 'Cursor %d not found' % cursor_handle)
@@ -874,8 +2349,8 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
       count = query.limit()
     self._Dynamic_RunQuery(query, query_result, count=count)
     cursor = query_result.cursor().cursor()
-    integer64proto.set_value(self.__queries[cursor].count)
-    del self.__queries[cursor]
+    integer64proto.set_value(self.__queries.Get(cursor).count)
+    self.__queries.Remove(cursor)
 
   def _Dynamic_BeginTransaction(self, request, transaction):
     self.__tx_handle_lock.acquire()
@@ -883,105 +2358,76 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     self.__next_tx_handle += 1
     self.__tx_handle_lock.release()
 
-    self.__transactions[handle] = None
+    self.__transactions[handle] = _Transaction()
     transaction.set_handle(handle)
 
-    self.__tx_lock.acquire()
-    snapshot = [(app_kind, dict(entities))
-                for app_kind, entities in self.__entities.items()]
-    self.__tx_snapshot = dict(snapshot)
-
   def _Dynamic_Commit(self, transaction, transaction_response):
-    if not self.__transactions.has_key(transaction.handle()):
-      raise apiproxy_errors.ApplicationError(
-        datastore_pb.Error.BAD_REQUEST,
-        'Transaction handle %d not found' % transaction.handle())
+    tx = self.__GetTransaction(transaction)
+    del self.__transactions[transaction.handle()]
 
-    self.__tx_snapshot = {}
+    changes = []
+    self.__entities_lock.acquire()
     try:
-      self.__WriteDatastore()
+      for group, version in tx.groups.iteritems():
+        if self.__entity_group_versions.get(group, 0) != version:
+          raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.CONCURRENT_TRANSACTION,
+            'Concurrency exception.')
+
+      for key, entity in tx.changes.iteritems():
+        if entity is None:
+          if self.__RemoveEntity(key):
+            changes.append((key, None))
+        else:
+          self._StoreEntity(entity)
+          changes.append((key, entity.Encode()))
+      if changes:
+        self.__WriteChanges(changes)
     finally:
-      self.__tx_lock.release()
+      self.__ReleaseGroups(tx)
+      self.__entities_lock.release()
 
   def _Dynamic_Rollback(self, transaction, transaction_response):
-    if not self.__transactions.has_key(transaction.handle()):
-      raise apiproxy_errors.ApplicationError(
-        datastore_pb.Error.BAD_REQUEST,
-        'Transaction handle %d not found' % transaction.handle())
+    tx = self.__GetTransaction(transaction)
+    del self.__transactions[transaction.handle()]
 
-    self.__entities = self.__tx_snapshot
-    self.__tx_snapshot = {}
-    self.__tx_lock.release()
+    self.__entities_lock.acquire()
+    try:
+      self.__ReleaseGroups(tx)
+    finally:
+      self.__entities_lock.release()
 
   def _Dynamic_GetSchema(self, req, schema):
     app_str = req.app()
     self.__ValidateAppId(app_str)
 
-    kinds = []
-
     for app, kind in self.__entities:
       if (app != app_str or
           (req.has_start_kind() and kind < req.start_kind()) or
           (req.has_end_kind() and kind > req.end_kind())):
         continue
 
-      app_kind = (app, kind)
-      if app_kind in self.__schema_cache:
-        kinds.append(self.__schema_cache[app_kind])
-        continue
-
-      kind_pb = entity_pb.EntityProto()
+      kind_pb = schema.add_kind()
       kind_pb.mutable_key().set_app('')
       kind_pb.mutable_key().mutable_path().add_element().set_type(kind)
       kind_pb.mutable_entity_group()
 
+      if not req.properties():
+        continue
+
       props = {}
+      for name, value_type in self.__schema_counts.get((app, kind), {}):
+        props.setdefault(name, []).append(value_type)
 
-      for entity in self.__entities[app_kind].values():
-        for prop in entity.protobuf.property_list():
-          if prop.name() not in props:
-            props[prop.name()] = entity_pb.PropertyValue()
-          props[prop.name()].MergeFrom(prop.value())
-
-      for value_pb in props.values():
-        if value_pb.has_int64value():
-          value_pb.set_int64value(0)
-        if value_pb.has_booleanvalue():
-          value_pb.set_booleanvalue(False)
-        if value_pb.has_stringvalue():
-          value_pb.set_stringvalue('none')
-        if value_pb.has_doublevalue():
-          value_pb.set_doublevalue(0.0)
-        if value_pb.has_pointvalue():
-          value_pb.mutable_pointvalue().set_x(0.0)
-          value_pb.mutable_pointvalue().set_y(0.0)
-        if value_pb.has_uservalue():
-          value_pb.mutable_uservalue().set_gaiaid(0)
-          value_pb.mutable_uservalue().set_email('none')
-          value_pb.mutable_uservalue().set_auth_domain('none')
-          value_pb.mutable_uservalue().clear_nickname()
-          value_pb.mutable_uservalue().clear_obfuscated_gaiaid()
-        if value_pb.has_referencevalue():
-          value_pb.clear_referencevalue()
-          value_pb.mutable_referencevalue().set_app('none')
-          pathelem = value_pb.mutable_referencevalue().add_pathelement()
-          pathelem.set_type('none')
-          pathelem.set_name('none')
-
-      for name, value_pb in props.items():
+      names = props.keys()
+      names.sort()
+      for name in names:
         prop_pb = kind_pb.add_property()
         prop_pb.set_name(name)
         prop_pb.set_multiple(False)
-        prop_pb.mutable_value().CopyFrom(value_pb)
-
-      kinds.append(kind_pb)
-      self.__schema_cache[app_kind] = kind_pb
-
-    for kind_pb in kinds:
-      kind = schema.add_kind()
-      kind.CopyFrom(kind_pb)
-      if not req.properties():
-        kind.clear_property()
+        value_pb = prop_pb.mutable_value()
+        for value_type in props[name]:
+          _SetSchemaPlaceholder(value_pb, value_type)
 
     schema.set_more_results(False)
 
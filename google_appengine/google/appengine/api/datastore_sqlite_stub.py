@@ -0,0 +1,1233 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+SQLite-backed persistent stub for the Python datastore API.
+
+Entities are stored as encoded proto bufs in a SQLite database file, and are
+only read from it when a Get() or a query needs them. Nothing is loaded at
+startup, and the datastore can be much bigger than memory.
+
+Each indexed property value of an entity also has a row in the
+EntityProperties table. Property values and keys are encoded as byte strings
+which SQLite sorts in the order that the datastore sorts what they stand for:
+first by type, then by value. Queries are translated into SQL over these rows,
+with the same results as in DatastoreFileStub. A filter matches an entity if
+any of its values of the property does, and an entity is sorted by its
+smallest value of the property in an ascending order, or its biggest in a
+descending one. Unlike in DatastoreFileStub, values of different types with
+the same type tag, like integers and datetimes, are compared by value, as the
+real datastore does.
+
+Query cursors, transactions and composite index definitions work the same way
+as in DatastoreFileStub. A cursor only holds the keys of the results it has
+fetched so far, and runs the query again from where it stopped when it needs
+more of them.
+"""
+
+
+
+
+
+
+import md5
+import sqlite3
+import struct
+import threading
+
+from google.appengine.api import apiproxy_stub
+from google.appengine.api import datastore_admin
+from google.appengine.api import datastore_errors
+from google.appengine.api import datastore_file_stub
+from google.appengine.api import datastore_types
+from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import entity_pb
+from google.appengine.runtime import apiproxy_errors
+
+
+_SCHEMA = (
+  'CREATE TABLE IF NOT EXISTS Entities ('
+  ' key BLOB PRIMARY KEY, app BLOB NOT NULL, kind BLOB NOT NULL,'
+  ' entity BLOB NOT NULL)',
+
+  'CREATE INDEX IF NOT EXISTS EntitiesByKind ON Entities (app, kind, key)',
+
+  'CREATE TABLE IF NOT EXISTS EntityProperties ('
+  ' key BLOB NOT NULL, app BLOB NOT NULL, kind BLOB NOT NULL,'
+  ' name BLOB NOT NULL, value BLOB NOT NULL)',
+
+  'CREATE INDEX IF NOT EXISTS PropertiesByValue'
+  ' ON EntityProperties (app, kind, name, value, key)',
+
+  'CREATE INDEX IF NOT EXISTS PropertiesByKey'
+  ' ON EntityProperties (key, name, value)',
+
+  'CREATE TABLE IF NOT EXISTS Metadata (name TEXT PRIMARY KEY, value INTEGER)',
+)
+
+
+_OPERATORS = {
+  datastore_pb.Query_Filter.LESS_THAN: '<',
+  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL: '<=',
+  datastore_pb.Query_Filter.GREATER_THAN: '>',
+  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
+  datastore_pb.Query_Filter.EQUAL: '=',
+}
+
+
+_DIRECTIONS = {False: 'ASC', True: 'DESC'}
+
+
+_INT64_OFFSET = 1 << 63
+_UINT64_MASK = (1 << 64) - 1
+
+_INT64_TAG = chr(entity_pb.PropertyValue.kint64Value)
+_BOOLEAN_TAG = chr(entity_pb.PropertyValue.kbooleanValue)
+_STRING_TAG = chr(entity_pb.PropertyValue.kstringValue)
+_DOUBLE_TAG = chr(entity_pb.PropertyValue.kdoubleValue)
+_POINT_TAG = chr(entity_pb.PropertyValue.kPointValueGroup)
+_USER_TAG = chr(entity_pb.PropertyValue.kUserValueGroup)
+_REFERENCE_TAG = chr(entity_pb.PropertyValue.kReferenceValueGroup)
+_NONE_TAG = chr(0)
+
+
+_SCHEMA_VALUE_TYPES = {
+  _INT64_TAG: 'int64value',
+  _BOOLEAN_TAG: 'booleanvalue',
+  _STRING_TAG: 'stringvalue',
+  _DOUBLE_TAG: 'doublevalue',
+  _POINT_TAG: 'pointvalue',
+  _USER_TAG: 'uservalue',
+  _REFERENCE_TAG: 'referencevalue',
+  _NONE_TAG: None,
+}
+
+
+def _Utf8(value):
+  """Returns a string as UTF-8 bytes.
+
+  Args:
+    value: str or unicode
+
+  Returns:
+    str
+  """
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+
+def _Blob(value):
+  """Wraps a string so that SQLite stores it as a BLOB, which is compared
+  byte by byte.
+
+  Args:
+    value: str or unicode
+
+  Returns:
+    buffer
+  """
+  return buffer(_Utf8(value))
+
+
+def _EncodeInt64(value):
+  """Encodes an integer so that encoded integers sort in numeric order.
+
+  Args:
+    value: integer, which fits in 64 bits
+
+  Returns:
+    string
+  """
+  return struct.pack('>Q', value + _INT64_OFFSET)
+
+
+def _EncodeDouble(value):
+  """Encodes a float so that encoded floats sort in numeric order.
+
+  Args:
+    value: float
+
+  Returns:
+    string
+  """
+  if value == 0:
+    value = 0.0
+  bits, = struct.unpack('>Q', struct.pack('>d', value))
+  if bits & _INT64_OFFSET:
+    bits ^= _UINT64_MASK
+  else:
+    bits |= _INT64_OFFSET
+  return struct.pack('>Q', bits)
+
+
+def _EncodeString(value):
+  """Encodes a string so that it can be followed by other encoded values
+  without changing the order that it sorts in.
+
+  Args:
+    value: string
+
+  Returns:
+    string
+  """
+  return _Utf8(value).replace('\x00', '\x00\xff') + '\x00\x01'
+
+
+def _EncodePath(app, elements):
+  """Encodes a key so that encoded keys sort the way datastore_types.Key
+  compares them: by app, and then by each path element's type and its id or
+  name, with ids before names.
+
+  Args:
+    app: string
+    elements: list of entity_pb.Path_Element or
+      entity_pb.PropertyValue_ReferenceValuePathElement
+
+  Returns:
+    string
+  """
+  parts = [_EncodeString(app)]
+  for element in elements:
+    parts.append(_EncodeString(element.type()))
+    if element.has_name():
+      parts.append('\x02' + _EncodeString(element.name()))
+    else:
+      parts.append('\x01' + _EncodeInt64(element.id()))
+  return ''.join(parts)
+
+
+def _EncodeKey(key):
+  """Encodes a key the same way as a property value that refers to it.
+
+  The encoded keys of an entity's descendants all start with its own encoded
+  key, and are less than it followed by '\\xff'.
+
+  Args:
+    key: entity_pb.Reference
+
+  Returns:
+    string
+  """
+  return _REFERENCE_TAG + _EncodePath(key.app(), key.path().element_list())
+
+
+def _EncodeValue(value):
+  """Encodes a property value so that encoded values sort by type tag, and
+  then by value, the way that DatastoreFileStub compares them.
+
+  Args:
+    value: entity_pb.PropertyValue
+
+  Returns:
+    string, whose first character is the value's type tag
+  """
+  if value.has_int64value():
+    return _INT64_TAG + _EncodeInt64(value.int64value())
+  elif value.has_booleanvalue():
+    return _BOOLEAN_TAG + chr(value.booleanvalue())
+  elif value.has_stringvalue():
+    return _STRING_TAG + _Utf8(value.stringvalue())
+  elif value.has_doublevalue():
+    return _DOUBLE_TAG + _EncodeDouble(value.doublevalue())
+  elif value.has_pointvalue():
+    point = value.pointvalue()
+    return _POINT_TAG + _EncodeDouble(point.x()) + _EncodeDouble(point.y())
+  elif value.has_uservalue():
+    user = value.uservalue()
+    return (_USER_TAG + _EncodeString(user.email()) +
+            _EncodeString(user.auth_domain()))
+  elif value.has_referencevalue():
+    reference = value.referencevalue()
+    return _REFERENCE_TAG + _EncodePath(reference.app(),
+                                        reference.pathelement_list())
+  return _NONE_TAG
+
+
+def _SortedAfter(columns, position):
+  """Returns a SQL condition that matches the results which sort after a
+  position.
+
+  The condition starts with a range on the first column, which an index
+  that returns the results in order can seek to.
+
+  Args:
+    columns: list of (expression, params, descending) triples, the SQL
+      expressions that the results are sorted by, as returned by
+      DatastoreSqliteStub.__TranslateQuery()
+    position: sequence of the values of the columns at the position
+
+  Returns:
+    (condition, params), the SQL condition and the values of its parameters
+  """
+  operators = {False: '>', True: '<'}
+  tests = []
+  params = []
+  equal = []
+  equal_params = []
+  for (expression, expression_params, descending), value in zip(columns,
+                                                                position):
+    tests.append('(%s)' % ' AND '.join(
+        equal + ['%s %s ?' % (expression, operators[descending])]))
+    params += equal_params + expression_params + [value]
+    equal.append('%s = ?' % expression)
+    equal_params += expression_params + [value]
+
+  expression, expression_params, descending = columns[0]
+  condition = '%s %s= ? AND (%s)' % (expression, operators[descending],
+                                     ' OR '.join(tests))
+  return condition, expression_params + [position[0]] + params
+
+
+class _QueryResults(object):
+  """The encoded keys of the results of a query, which are fetched from the
+  database as they are needed.
+
+  Each fetch runs the query again for the results which sort after the last
+  one fetched, so that the database can seek to them rather than skip the
+  results before them, and asks for one more result than is needed, to find
+  out whether there are more.
+
+  Supports len(), which is the number of results fetched so far, and
+  slicing, like the list of the result keys after the offset.
+  """
+
+  def __init__(self, fetch, offset, needed):
+    """Constructor.
+
+    Args:
+      # returns a list of up to limit (encoded key, position) pairs of the
+      # results after position, or from the first if it is None, skipping
+      # offset of them
+      fetch: function(position, offset, limit)
+      offset: the number of results to skip
+      needed: the number of results after the offset to fetch now
+    """
+    self.__fetch = fetch
+    self.__offset = offset
+    self.__position = None
+    self.__keys = []
+    self.__exhausted = False
+    self.__Fill(needed)
+
+  def __Fill(self, stop):
+    """Fetches results until there are more than stop of them, or there are
+    no more.
+
+    Args:
+      stop: integer, or None to fetch every result
+    """
+    while not self.__exhausted and (stop is None or len(self.__keys) <= stop):
+      if stop is None:
+        wanted = datastore_file_stub._MAXIMUM_RESULTS
+      else:
+        wanted = stop + 1 - len(self.__keys)
+      results = self.__fetch(self.__position, self.__offset, wanted)
+      self.__offset = 0
+      self.__keys.extend([key for key, position in results])
+      if results:
+        self.__position = results[-1][1]
+      if len(results) < wanted:
+        self.__exhausted = True
+
+  def __len__(self):
+    return len(self.__keys)
+
+  def __getitem__(self, index):
+    self.__Fill(index.stop)
+    return self.__keys[index]
+
+
+class DatastoreSqliteStub(apiproxy_stub.APIProxyStub):
+  """Persistent stub for the Python datastore API, backed by SQLite.
+
+  A DatastoreSqliteStub instance handles a single app's data, and is a drop-in
+  replacement for DatastoreFileStub.
+  """
+
+  _INDEX_STATE_TRANSITIONS = (
+      datastore_file_stub.DatastoreFileStub._INDEX_STATE_TRANSITIONS)
+
+  READ_ERROR_MSG = ('Data in %s is not a SQLite datastore, or is corrupt. '
+                    'Try running with the --clear_datastore flag.\n%r')
+
+  def __init__(self,
+               app_id,
+               datastore_file,
+               require_indexes=False,
+               service_name='datastore_v3',
+               trusted=False):
+    """Constructor.
+
+    Opens the datastore file, and creates its tables if they don't exist.
+
+    Args:
+      app_id: string
+      datastore_file: string, the SQLite database which stores all entities
+          across sessions.  Use None to keep them in memory instead.
+      require_indexes: bool, default False.  If True, composite indexes must
+          exist in index.yaml for queries that need them.
+      service_name: Service name expected for all calls.
+      trusted: bool, default False.  If True, this stub allows an app to
+        access the data of another app.
+    """
+    super(DatastoreSqliteStub, self).__init__(service_name)
+
+    assert isinstance(app_id, basestring) and app_id != ''
+    self.__app_id = app_id
+    self.__datastore_file = datastore_file
+    self.SetTrusted(trusted)
+
+    self.__queries = datastore_file_stub._CursorCache()
+
+    self.__transactions = {}
+
+    self.__entity_group_versions = {}
+    self.__enlisted_groups = {}
+
+    self.__indexes = {}
+    self.__require_indexes = require_indexes
+
+    self.__query_history = {}
+
+    self.__next_id = 1
+    self.__next_tx_handle = 1
+    self.__next_index_id = 1
+    self.__id_lock = threading.Lock()
+    self.__tx_handle_lock = threading.Lock()
+    self.__index_id_lock = threading.Lock()
+    self.__connection_lock = threading.Lock()
+    self.__indexes_lock = threading.Lock()
+
+    self.__Connect()
+
+  def __Connect(self):
+    """Opens the database, creates its tables, and reads the next id.
+
+    Raises:
+      datastore_errors.InternalError if the file is not a SQLite database.
+    """
+    filename = self.__datastore_file
+    if not filename or filename == '/dev/null':
+      filename = ':memory:'
+
+    self.__connection = sqlite3.connect(filename, isolation_level=None,
+                                        check_same_thread=False)
+    self.__connection.text_factory = str
+    try:
+      for statement in _SCHEMA:
+        self.__connection.execute(statement)
+      row = self.__connection.execute(
+          'SELECT value FROM Metadata WHERE name = ?', ('next_id',)).fetchone()
+    except sqlite3.DatabaseError, e:
+      raise datastore_errors.InternalError(self.READ_ERROR_MSG %
+                                           (filename, e))
+    if row:
+      self.__next_id = row[0]
+
+  def Clear(self):
+    """ Clears the datastore by deleting all currently stored entities and
+    queries. """
+    self.__connection_lock.acquire()
+    try:
+      self.__connection.execute('DELETE FROM Entities')
+      self.__connection.execute('DELETE FROM EntityProperties')
+    finally:
+      self.__connection_lock.release()
+    self.__queries = datastore_file_stub._CursorCache()
+    self.__transactions = {}
+    self.__entity_group_versions = {}
+    self.__enlisted_groups = {}
+    self.__query_history = {}
+
+  def GetCursorStats(self):
+    """Returns statistics about the live query cursors.
+
+    Returns:
+      dict with 'cursors', the number of live cursors; 'bytes', their
+      estimated size; 'expired' and 'evicted', the number of cursors that
+      have been dropped for each reason so far.
+    """
+    return self.__queries.Stats()
+
+  def SetTrusted(self, trusted):
+    """Set/clear the trusted bit in the stub.
+
+    This bit indicates that the app calling the stub is trusted. A
+    trusted app can write to datastores of other apps.
+
+    Args:
+      trusted: boolean.
+    """
+    self.__trusted = trusted
+
+  def __ValidateAppId(self, app_id):
+    """Verify that this is the stub for app_id.
+
+    Args:
+      app_id: An application ID.
+
+    Raises:
+      datastore_errors.BadRequestError: if this is not the stub for app_id.
+    """
+    if not self.__trusted and app_id != self.__app_id:
+      raise datastore_errors.BadRequestError(
+          'app %s cannot access app %s\'s data' % (self.__app_id, app_id))
+
+  def __ValidateKey(self, key):
+    """Validate this key.
+
+    Args:
+      key: entity_pb.Reference
+
+    Raises:
+      datastore_errors.BadRequestError: if the key is invalid
+    """
+    assert isinstance(key, entity_pb.Reference)
+
+    self.__ValidateAppId(key.app())
+
+    for elem in key.path().element_list():
+      if elem.has_id() == elem.has_name():
+        raise datastore_errors.BadRequestError(
+          'each key path element should have id or name but not both: %r' % key)
+
+  def __Execute(self, sql, params=()):
+    """Runs a SQL statement, and returns all of the rows it selects.
+
+    Args:
+      sql: string
+      params: sequence of the values of the statement's parameters
+
+    Returns:
+      list of tuples
+    """
+    self.__connection_lock.acquire()
+    try:
+      return self.__connection.execute(sql, params).fetchall()
+    finally:
+      self.__connection_lock.release()
+
+  def __ApplyChanges(self, changes):
+    """Stores and deletes entities, in a single SQLite transaction. The caller
+    must hold the connection lock.
+
+    Args:
+      changes: list of (entity_pb.Reference, entity_pb.EntityProto) pairs,
+        where the entity is None to delete the entity with that key
+    """
+    cursor = self.__connection.cursor()
+    cursor.execute('BEGIN')
+    try:
+      written = []
+      for key, entity in changes:
+        encoded_key = _Blob(_EncodeKey(key))
+        cursor.execute('DELETE FROM EntityProperties WHERE key = ?',
+                       (encoded_key,))
+        if entity is None:
+          cursor.execute('DELETE FROM Entities WHERE key = ?', (encoded_key,))
+          if cursor.rowcount > 0:
+            written.append(key)
+          continue
+
+        app = _Blob(key.app())
+        kind = _Blob(key.path().element_list()[-1].type())
+        cursor.execute('INSERT OR REPLACE INTO Entities VALUES (?, ?, ?, ?)',
+                       (encoded_key, app, kind, _Blob(entity.Encode())))
+
+        rows = set()
+        for prop in entity.property_list():
+          rows.add((prop.name(), _EncodeValue(prop.value())))
+        cursor.executemany(
+            'INSERT INTO EntityProperties VALUES (?, ?, ?, ?, ?)',
+            [(encoded_key, app, kind, _Blob(name), _Blob(value))
+             for name, value in rows])
+        written.append(key)
+
+      cursor.execute('INSERT OR REPLACE INTO Metadata VALUES (?, ?)',
+                     ('next_id', self.__next_id))
+      cursor.execute('COMMIT')
+    except:
+      cursor.execute('ROLLBACK')
+      raise
+
+    for key in written:
+      self.__BumpVersion(key)
+
+  def __Lookup(self, encoded_key):
+    """Returns the encoded entity stored under an encoded key.
+
+    Args:
+      encoded_key: string, as returned by _EncodeKey()
+
+    Returns:
+      string, the encoded entity_pb.EntityProto, or None if there is none
+    """
+    rows = self.__Execute('SELECT entity FROM Entities WHERE key = ?',
+                          (_Blob(encoded_key),))
+    if rows:
+      return str(rows[0][0])
+    return None
+
+  def __BumpVersion(self, key):
+    """Records that an entity group has been written to, so that transactions
+    which used it before can't commit.
+
+    Only the groups which open transactions have enlisted need a version, so
+    writes to any other group are not recorded. Must be called with
+    self.__connection_lock held.
+
+    Args:
+      key: entity_pb.Reference of an entity in the group
+    """
+    group = datastore_file_stub._EntityGroup(key)
+    if group in self.__enlisted_groups:
+      self.__entity_group_versions[group] = (
+          self.__entity_group_versions.get(group, 0) + 1)
+
+  def __GetTransaction(self, transaction):
+    """Returns the state of a transaction.
+
+    Args:
+      transaction: datastore_pb.Transaction
+
+    Returns:
+      _Transaction
+
+    Raises:
+      apiproxy_errors.ApplicationError if there is no such transaction.
+    """
+    try:
+      return self.__transactions[transaction.handle()]
+    except KeyError:
+      raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.BAD_REQUEST,
+        'Transaction handle %d not found' % transaction.handle())
+
+  def __EnlistGroup(self, tx, key):
+    """Records the version of an entity group when a transaction first uses
+    it.
+
+    Args:
+      tx: _Transaction
+      key: entity_pb.Reference of an entity in the group
+    """
+    group = datastore_file_stub._EntityGroup(key)
+    if group not in tx.groups:
+      self.__connection_lock.acquire()
+      try:
+        tx.groups[group] = self.__entity_group_versions.get(group, 0)
+        self.__enlisted_groups[group] = (
+            self.__enlisted_groups.get(group, 0) + 1)
+      finally:
+        self.__connection_lock.release()
+
+  def __ReleaseGroups(self, tx):
+    """Forgets a finished transaction's entity groups. A group's version is
+    dropped once no open transaction has it enlisted. Must be called with
+    self.__connection_lock held.
+
+    Args:
+      tx: _Transaction
+    """
+    for group in tx.groups:
+      count = self.__enlisted_groups.get(group, 0) - 1
+      if count > 0:
+        self.__enlisted_groups[group] = count
+      else:
+        self.__enlisted_groups.pop(group, None)
+        self.__entity_group_versions.pop(group, None)
+
+  def MakeSyncCall(self, service, call, request, response):
+    """ The main RPC entry point. service must be 'datastore_v3'.
+    """
+    self.assertPbIsInitialized(request)
+    super(DatastoreSqliteStub, self).MakeSyncCall(service,
+                                                  call,
+                                                  request,
+                                                  response)
+    self.assertPbIsInitialized(response)
+
+  def assertPbIsInitialized(self, pb):
+    """Raises an exception if the given PB is not initialized and valid."""
+    explanation = []
+    assert pb.IsInitialized(explanation), explanation
+    pb.Encode()
+
+  def QueryHistory(self):
+    """Returns a dict that maps Query PBs to times they've been run.
+    """
+    return dict((pb, times) for pb, times in self.__query_history.items()
+                if pb.app() == self.__app_id)
+
+  def _Dynamic_Put(self, put_request, put_response):
+    clones = []
+    for entity in put_request.entity_list():
+      self.__ValidateKey(entity.key())
+
+      clone = entity_pb.EntityProto()
+      clone.CopyFrom(entity)
+
+      for property in clone.property_list():
+        if property.value().has_uservalue():
+          uid = md5.new(property.value().uservalue().email().lower()).digest()
+          uid = '1' + ''.join(['%02d' % ord(x) for x in uid])[:20]
+          property.mutable_value().mutable_uservalue().set_obfuscated_gaiaid(
+              uid)
+
+      clones.append(clone)
+
+      assert clone.has_key()
+      assert clone.key().path().element_size() > 0
+
+      last_path = clone.key().path().element_list()[-1]
+      if last_path.id() == 0 and not last_path.has_name():
+        self.__id_lock.acquire()
+        last_path.set_id(self.__next_id)
+        self.__next_id += 1
+        self.__id_lock.release()
+
+        assert clone.entity_group().element_size() == 0
+        group = clone.mutable_entity_group()
+        root = clone.key().path().element(0)
+        group.add_element().CopyFrom(root)
+
+      else:
+        assert (clone.has_entity_group() and
+                clone.entity_group().element_size() > 0)
+
+    if put_request.has_transaction():
+      tx = self.__GetTransaction(put_request.transaction())
+      for clone in clones:
+        self.__EnlistGroup(tx, clone.key())
+        tx.changes[clone.key()] = clone
+    else:
+      self.__connection_lock.acquire()
+      try:
+        self.__ApplyChanges([(clone.key(), clone) for clone in clones])
+      finally:
+        self.__connection_lock.release()
+
+    put_response.key_list().extend([c.key() for c in clones])
+
+  def _Dynamic_Get(self, get_request, get_response):
+    tx = None
+    if get_request.has_transaction():
+      tx = self.__GetTransaction(get_request.transaction())
+
+    for key in get_request.key_list():
+      self.__ValidateAppId(key.app())
+      if tx is not None:
+        self.__EnlistGroup(tx, key)
+
+      group = get_response.add_entity()
+      encoded = self.__Lookup(_EncodeKey(key))
+      if encoded:
+        group.mutable_entity().MergeFromString(encoded)
+
+  def _Dynamic_Delete(self, delete_request, delete_response):
+    for key in delete_request.key_list():
+      self.__ValidateAppId(key.app())
+
+    if delete_request.has_transaction():
+      tx = self.__GetTransaction(delete_request.transaction())
+      for key in delete_request.key_list():
+        self.__EnlistGroup(tx, key)
+        tx.changes[key] = None
+      return
+
+    self.__connection_lock.acquire()
+    try:
+      self.__ApplyChanges([(key, None) for key in delete_request.key_list()])
+    finally:
+      self.__connection_lock.release()
+
+  def __PrepareQuery(self, query):
+    """Checks that a query can be run, and records it in the query history.
+
+    Args:
+      query: datastore_pb.Query, whose app is set to the encoded app and
+        namespace
+
+    Returns:
+      (filters, orders), the query's normalized filters and orders
+
+    Raises:
+      apiproxy_errors.ApplicationError if the query can't be run.
+    """
+    if query.has_transaction():
+      if not query.has_ancestor():
+        raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          'Only ancestor queries are allowed inside transactions.')
+      tx = self.__GetTransaction(query.transaction())
+      self.__EnlistGroup(tx, query.ancestor())
+
+    app_id_namespace = datastore_types.parse_app_id_namespace(query.app())
+    app_id = app_id_namespace.app_id()
+    self.__ValidateAppId(app_id)
+
+    if (query.has_offset() and
+        query.offset() > datastore_file_stub._MAX_QUERY_OFFSET):
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST, 'Too big query offset.')
+
+    num_components = len(query.filter_list()) + len(query.order_list())
+    if query.has_ancestor():
+      num_components += 1
+    if num_components > datastore_file_stub._MAX_QUERY_COMPONENTS:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          ('query is too large. may not have more than %s filters'
+           ' + sort orders ancestor total' %
+           datastore_file_stub._MAX_QUERY_COMPONENTS))
+
+    (filters, orders) = datastore_index.Normalize(query.filter_list(),
+                                                  query.order_list())
+
+    if self.__require_indexes:
+      self.__CheckIndexes(app_id, query)
+
+    query.set_app(app_id_namespace.to_encoded())
+
+    clone = datastore_pb.Query()
+    clone.CopyFrom(query)
+    clone.clear_hint()
+    if clone in self.__query_history:
+      self.__query_history[clone] += 1
+    else:
+      self.__query_history[clone] = 1
+
+    return filters, orders
+
+  def __CheckIndexes(self, app_id, query):
+    """Checks that the composite index a query needs, if any, exists.
+
+    Args:
+      app_id: string
+      query: datastore_pb.Query
+
+    Raises:
+      apiproxy_errors.ApplicationError with NEED_INDEX if it doesn't.
+    """
+    required, kind, ancestor, props, num_eq_filters = (
+        datastore_index.CompositeIndexForQuery(query))
+    if not required:
+      return
+
+    required_key = kind, ancestor, props
+    indexes = self.__indexes.get(app_id)
+    if not indexes:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.NEED_INDEX,
+          "This query requires a composite index, but none are defined. "
+          "You must create an index.yaml file in your application root.")
+    eq_filters_set = set(props[:num_eq_filters])
+    remaining_filters = props[num_eq_filters:]
+    for index in indexes:
+      definition = datastore_admin.ProtoToIndexDefinition(index)
+      index_key = datastore_index.IndexToKey(definition)
+      if required_key == index_key:
+        return
+      if num_eq_filters > 1 and (kind, ancestor) == index_key[:2]:
+        this_props = index_key[2]
+        this_eq_filters_set = set(this_props[:num_eq_filters])
+        this_remaining_filters = this_props[num_eq_filters:]
+        if (eq_filters_set == this_eq_filters_set and
+            remaining_filters == this_remaining_filters):
+          return
+
+    raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.NEED_INDEX,
+        "This query requires a composite index that is not defined. "
+        "You must update the index.yaml file in your application root.")
+
+  def __TranslateQuery(self, query, filters, orders):
+    """Translates a query into SQL over the Entities table, aliased as e.
+
+    Filters on properties are subqueries of the EntityProperties rows which
+    match them. Each sort order sorts by the smallest or biggest value of the
+    property, and entities without the property are left out. Ties are
+    broken by key.
+
+    The first sort order on a property joins the property's rows, aliased as
+    p, keeping the row of each entity's smallest or biggest value, so that
+    the PropertiesByValue index can return them in order. Later sort orders
+    are subqueries of the values.
+
+    Args:
+      query: datastore_pb.Query
+      filters: list of datastore_pb.Query_Filter, as normalized
+      orders: list of datastore_pb.Query_Order, as normalized
+
+    Returns:
+      (tables, where, params, columns), where tables is the SQL that the
+      results are selected from, where is the SQL condition that matches
+      them, params are the values of its parameters, and columns is a list
+      of (expression, params, descending) triples: the SQL expressions that
+      the results are sorted by, in order, with the values of their
+      parameters and whether they sort in descending order. The last is
+      the key, so that the columns identify a result.
+    """
+    conditions = ['e.app = ?']
+    params = [_Blob(query.app())]
+
+    property_rows = ('SELECT key FROM EntityProperties'
+                     ' WHERE app = ? AND name = ?')
+    property_params = [_Blob(query.app())]
+    if query.has_kind():
+      conditions.append('e.kind = ?')
+      params.append(_Blob(query.kind()))
+      property_rows = ('SELECT key FROM EntityProperties'
+                       ' WHERE app = ? AND kind = ? AND name = ?')
+      property_params.append(_Blob(query.kind()))
+
+    if query.has_ancestor():
+      ancestor = _EncodeKey(query.ancestor())
+      conditions.append('e.key >= ? AND e.key < ?')
+      params += [_Blob(ancestor), _Blob(ancestor + '\xff')]
+
+    for filt in filters:
+      assert filt.op() != datastore_pb.Query_Filter.IN
+
+      name = filt.property(0).name()
+      values = [_Blob(_EncodeValue(prop.value()))
+                for prop in filt.property_list()]
+
+      if name == datastore_types._KEY_SPECIAL_PROPERTY:
+        tests = ['e.key %s ?' % _OPERATORS[filt.op()]] * len(values)
+        conditions.append('(%s)' % ' OR '.join(tests))
+        params += values
+      else:
+        tests = ['value %s ?' % _OPERATORS[filt.op()]] * len(values)
+        conditions.append('e.key IN (%s AND (%s))' %
+                          (property_rows, ' OR '.join(tests)))
+        params += property_params + [_Blob(name)] + values
+
+    tables = 'Entities e'
+    columns = []
+    key_descending = False
+    for order in orders:
+      name = order.property()
+      descending = order.direction() == datastore_pb.Query_Order.DESCENDING
+      if descending:
+        aggregate = 'MAX'
+      else:
+        aggregate = 'MIN'
+
+      if name == datastore_types._KEY_SPECIAL_PROPERTY:
+        key_descending = descending
+        break
+
+      if not columns:
+        tables = 'EntityProperties p CROSS JOIN Entities e ON e.key = p.key'
+        if query.has_kind():
+          conditions.append('p.app = ? AND p.kind = ? AND p.name = ?')
+        else:
+          conditions.append('p.app = ? AND p.name = ?')
+        params += property_params + [_Blob(name)]
+        conditions.append('p.value = (SELECT %s(q.value)'
+                          ' FROM EntityProperties q'
+                          ' WHERE q.key = p.key AND q.name = p.name)' %
+                          aggregate)
+        columns.append(('p.value', [], descending))
+        continue
+
+      conditions.append('EXISTS (SELECT 1 FROM EntityProperties q'
+                        ' WHERE q.key = e.key AND q.name = ?)')
+      params.append(_Blob(name))
+      columns.append(('(SELECT %s(q.value) FROM EntityProperties q'
+                      ' WHERE q.key = e.key AND q.name = ?)' % aggregate,
+                      [_Blob(name)], descending))
+    if columns:
+      columns.append(('p.key', [], key_descending))
+    else:
+      columns.append(('e.key', [], key_descending))
+
+    return tables, ' AND '.join(conditions), params, columns
+
+  def _Dynamic_RunQuery(self, query, query_result):
+    filters, orders = self.__PrepareQuery(query)
+    tables, where, params, columns = self.__TranslateQuery(
+        query, filters, orders)
+
+    select = []
+    select_params = []
+    order_by = []
+    for i, (expression, expression_params, descending) in enumerate(columns):
+      select.append('%s AS s%d' % (expression, i))
+      select_params += expression_params
+      order_by.append('s%d %s' % (i, _DIRECTIONS[descending]))
+
+    def fetch(position, offset, limit):
+      """Returns the encoded keys and positions of some of the results."""
+      condition, condition_params = where, params
+      if position is not None:
+        after, after_params = _SortedAfter(columns, position)
+        condition = '%s AND %s' % (where, after)
+        condition_params = params + after_params
+      rows = self.__Execute('SELECT %s FROM %s WHERE %s ORDER BY %s'
+                            ' LIMIT ? OFFSET ?' %
+                            (', '.join(select), tables, condition,
+                             ', '.join(order_by)),
+                            select_params + condition_params +
+                            [limit, offset])
+      return [(str(row[-1]), row) for row in rows]
+
+    if query.has_count():
+      count = query.count()
+    elif query.has_limit():
+      count = query.limit()
+    else:
+      count = datastore_file_stub._BATCH_SIZE
+    count = min(count, datastore_file_stub._MAXIMUM_RESULTS)
+
+    results = _QueryResults(fetch, query.offset(), count)
+    cursor = datastore_file_stub._Cursor(results, query.keys_only(),
+                                         self.__Lookup, key_size=len)
+    self.__queries.Add(cursor)
+
+    cursor.PopulateQueryResult(query_result, count, compiled=query.compile())
+
+  def _Dynamic_RunCompiledQuery(self, compiled_request, query_result):
+    cursor_handle = compiled_request.compiled_query().limit()
+    cursor_offset = compiled_request.compiled_query().offset()
+
+    try:
+      cursor = self.__queries.Get(cursor_handle)
+    except KeyError:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST, 'Cursor %d not found' % cursor_handle)
+
+    count = datastore_file_stub._BATCH_SIZE
+    if compiled_request.has_count():
+      count = compiled_request.count()
+    cursor.PopulateQueryResult(
+        query_result, count, cursor_offset, compiled=True)
+
+  def _Dynamic_Next(self, next_request, query_result):
+    cursor_handle = next_request.cursor().cursor()
+
+    try:
+      cursor = self.__queries.Get(cursor_handle)
+    except KeyError:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST, 'Cursor %d not found' % cursor_handle)
+
+    count = datastore_file_stub._BATCH_SIZE
+    if next_request.has_count():
+      count = next_request.count()
+    cursor.PopulateQueryResult(query_result, count)
+
+  def _Dynamic_Count(self, query, integer64proto):
+    self.__ValidateAppId(query.app())
+    filters, orders = self.__PrepareQuery(query)
+    tables, where, params, columns = self.__TranslateQuery(
+        query, filters, orders)
+
+    limit = datastore_file_stub._MAXIMUM_RESULTS
+    if query.has_limit():
+      limit = min(query.limit(), limit)
+
+    rows = self.__Execute('SELECT COUNT(*) FROM'
+                          ' (SELECT 1 FROM %s WHERE %s'
+                          ' LIMIT ? OFFSET ?)' % (tables, where),
+                          params + [limit, query.offset()])
+    integer64proto.set_value(rows[0][0])
+
+  def _Dynamic_BeginTransaction(self, request, transaction):
+    self.__tx_handle_lock.acquire()
+    handle = self.__next_tx_handle
+    self.__next_tx_handle += 1
+    self.__tx_handle_lock.release()
+
+    self.__transactions[handle] = datastore_file_stub._Transaction()
+    transaction.set_handle(handle)
+
+  def _Dynamic_Commit(self, transaction, transaction_response):
+    tx = self.__GetTransaction(transaction)
+    del self.__transactions[transaction.handle()]
+
+    self.__connection_lock.acquire()
+    try:
+      for group, version in tx.groups.iteritems():
+        if self.__entity_group_versions.get(group, 0) != version:
+          raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.CONCURRENT_TRANSACTION,
+            'Concurrency exception.')
+
+      if tx.changes:
+        self.__ApplyChanges(tx.changes.items())
+    finally:
+      self.__ReleaseGroups(tx)
+      self.__connection_lock.release()
+
+  def _Dynamic_Rollback(self, transaction, transaction_response):
+    tx = self.__GetTransaction(transaction)
+    del self.__transactions[transaction.handle()]
+
+    self.__connection_lock.acquire()
+    try:
+      self.__ReleaseGroups(tx)
+    finally:
+      self.__connection_lock.release()
+
+  def _Dynamic_GetSchema(self, req, schema):
+    app_str = req.app()
+    self.__ValidateAppId(app_str)
+
+    kinds = self.__Execute('SELECT DISTINCT kind FROM Entities WHERE app = ?'
+                           ' ORDER BY kind', (_Blob(app_str),))
+    for row in kinds:
+      kind = str(row[0])
+      if ((req.has_start_kind() and kind < req.start_kind()) or
+          (req.has_end_kind() and kind > req.end_kind())):
+        continue
+
+      kind_pb = schema.add_kind()
+      kind_pb.mutable_key().set_app('')
+      kind_pb.mutable_key().mutable_path().add_element().set_type(kind)
+      kind_pb.mutable_entity_group()
+
+      if not req.properties():
+        continue
+
+      props = {}
+      rows = self.__Execute('SELECT DISTINCT name, substr(value, 1, 1)'
+                            ' FROM EntityProperties WHERE app = ? AND kind = ?',
+                            (_Blob(app_str), _Blob(kind)))
+      for name, tag in rows:
+        props.setdefault(str(name), []).append(
+            _SCHEMA_VALUE_TYPES.get(str(tag)))
+
+      names = props.keys()
+      names.sort()
+      for name in names:
+        prop_pb = kind_pb.add_property()
+        prop_pb.set_name(name)
+        prop_pb.set_multiple(False)
+        value_pb = prop_pb.mutable_value()
+        for value_type in sorted(props[name]):
+          datastore_file_stub._SetSchemaPlaceholder(value_pb, value_type)
+
+    schema.set_more_results(False)
+
+  def _Dynamic_AllocateIds(self, allocate_ids_request, allocate_ids_response):
+    model_key = allocate_ids_request.model_key()
+    size = allocate_ids_request.size()
+
+    self.__ValidateAppId(model_key.app())
+
+    try:
+      self.__id_lock.acquire()
+      start = self.__next_id
+      self.__next_id += size
+      end = self.__next_id - 1
+    finally:
+     self.__id_lock.release()
+
+    self.__Execute('INSERT OR REPLACE INTO Metadata VALUES (?, ?)',
+                   ('next_id', self.__next_id))
+
+    allocate_ids_response.set_start(start)
+    allocate_ids_response.set_end(end)
+
+  def _Dynamic_CreateIndex(self, index, id_response):
+    self.__ValidateAppId(index.app_id())
+    if index.id() != 0:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             'New index id must be 0.')
+    elif self.__FindIndex(index):
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             'Index already exists.')
+
+    self.__index_id_lock.acquire()
+    index.set_id(self.__next_index_id)
+    id_response.set_value(self.__next_index_id)
+    self.__next_index_id += 1
+    self.__index_id_lock.release()
+
+    clone = entity_pb.CompositeIndex()
+    clone.CopyFrom(index)
+    app = index.app_id()
+    clone.set_app_id(app)
+
+    self.__indexes_lock.acquire()
+    try:
+      if app not in self.__indexes:
+        self.__indexes[app] = []
+      self.__indexes[app].append(clone)
+    finally:
+      self.__indexes_lock.release()
+
+  def _Dynamic_GetIndices(self, app_str, composite_indices):
+    self.__ValidateAppId(app_str.value())
+    composite_indices.index_list().extend(
+      self.__indexes.get(app_str.value(), []))
+
+  def _Dynamic_UpdateIndex(self, index, void):
+    self.__ValidateAppId(index.app_id())
+    stored_index = self.__FindIndex(index)
+    if not stored_index:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             "Index doesn't exist.")
+    elif (index.state() != stored_index.state() and
+          index.state() not in self._INDEX_STATE_TRANSITIONS[stored_index.state()]):
+      raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.BAD_REQUEST,
+        "cannot move index state from %s to %s" %
+          (entity_pb.CompositeIndex.State_Name(stored_index.state()),
+          (entity_pb.CompositeIndex.State_Name(index.state()))))
+
+    self.__indexes_lock.acquire()
+    try:
+      stored_index.set_state(index.state())
+    finally:
+      self.__indexes_lock.release()
+
+  def _Dynamic_DeleteIndex(self, index, void):
+    self.__ValidateAppId(index.app_id())
+    stored_index = self.__FindIndex(index)
+    if not stored_index:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             "Index doesn't exist.")
+
+    app = index.app_id()
+    self.__indexes_lock.acquire()
+    try:
+      self.__indexes[app].remove(stored_index)
+    finally:
+      self.__indexes_lock.release()
+
+  def __FindIndex(self, index):
+    """Finds an existing index by definition.
+
+    Args:
+      definition: entity_pb.CompositeIndex
+
+    Returns:
+      entity_pb.CompositeIndex, if it exists; otherwise None
+    """
+    app = index.app_id()
+    self.__ValidateAppId(app)
+    if app in self.__indexes:
+      for stored_index in self.__indexes[app]:
+        if index.definition() == stored_index.definition():
+          return stored_index
+
+    return None
@@ -24,11 +24,15 @@ required and higher performance is desired.
 
 
 
+import array
+import cPickle
 import cStringIO
 import math
 import pickle
+import random
 import types
 import sha
+import zlib
 
 from google.appengine.api import api_base_pb
 from google.appengine.api import apiproxy_stub_map
@@ -36,6 +40,7 @@ from google.appengine.api import capabilities
 from google.appengine.api import namespace_manager
 from google.appengine.api.memcache import memcache_service_pb
 from google.appengine.runtime import apiproxy_errors
+from google.net.proto import ProtocolBuffer
 
 MemcacheSetResponse = memcache_service_pb.MemcacheSetResponse
 MemcacheSetRequest = memcache_service_pb.MemcacheSetRequest
@@ -49,6 +54,11 @@ MemcacheDeleteRequest = memcache_service_pb.MemcacheDeleteRequest
 MemcacheIncrementResponse = memcache_service_pb.MemcacheIncrementResponse
 MemcacheIncrementRequest = memcache_service_pb.MemcacheIncrementRequest
 
+MemcacheBatchIncrementResponse = (
+    memcache_service_pb.MemcacheBatchIncrementResponse)
+MemcacheBatchIncrementRequest = (
+    memcache_service_pb.MemcacheBatchIncrementRequest)
+
 MemcacheFlushResponse = memcache_service_pb.MemcacheFlushResponse
 MemcacheFlushRequest = memcache_service_pb.MemcacheFlushRequest
 
@@ -62,15 +72,21 @@ DELETE_SUCCESSFUL = 2
 MAX_KEY_SIZE = 250
 MAX_VALUE_SIZE = 10 ** 6
 
+MAX_CHUNKS = 32
+
 STAT_HITS = 'hits'
 STAT_MISSES = 'misses'
 STAT_BYTE_HITS = 'byte_hits'
 STAT_ITEMS = 'items'
 STAT_BYTES = 'bytes'
 STAT_OLDEST_ITEM_AGES = 'oldest_item_age'
+STAT_EVICTIONS = 'evictions'
 
 FLAG_TYPE_MASK = 7
 FLAG_COMPRESSED = 1 << 3
+FLAG_CHUNKED = 1 << 4
+FLAG_CODEC_SHIFT = 8
+FLAG_CODEC_MASK = 0xff << FLAG_CODEC_SHIFT
 
 TYPE_STR = 0
 TYPE_UNICODE = 1
@@ -78,9 +94,86 @@ TYPE_PICKLED = 2
 TYPE_INT = 3
 TYPE_LONG = 4
 TYPE_BOOL = 5
+TYPE_CODEC = 6
+
+CODEC_ENTITY_LIST = 1
 
 CAPABILITY = capabilities.CapabilitySet('memcache')
 
+_CODECS = {}
+
+
+def register_codec(codec_id, matches, encode, decode):
+  """Registers a serializer for some kind of values, to use instead of pickle.
+
+  Values that a codec matches are stored as it encodes them, with the codec's
+  ID in their flags, so that any client can decode them again.  Codecs are
+  tried in the order of their IDs, and the first that matches a value wins.
+
+  Args:
+    codec_id: Integer from 1 to 255 which identifies the codec.  Every client
+      sharing the cache must register the same codec under the same ID.
+    matches: Callable that takes a value and returns True if the codec can
+      encode it.
+    encode: Callable that takes a matching value and returns a non-unicode
+      string.
+    decode: Callable that takes a string returned by encode and returns the
+      value.
+
+  Raises:
+    ValueError: If the ID is out of range.
+  """
+  if not 0 < codec_id <= FLAG_CODEC_MASK >> FLAG_CODEC_SHIFT:
+    raise ValueError('Codec ID must be from 1 to %d; received %r' %
+                     (FLAG_CODEC_MASK >> FLAG_CODEC_SHIFT, codec_id))
+  _CODECS[codec_id] = (matches, encode, decode)
+
+
+def _is_entity_list(value):
+  """Returns True if a value is a non-empty list of datastore.Entity."""
+  if type(value) is not list or not value:
+    return False
+  from google.appengine.api import datastore
+  for entity in value:
+    if not isinstance(entity, datastore.Entity):
+      return False
+  return True
+
+
+def _encode_entity_list(entities):
+  """Encodes a list of datastore.Entity as their length-prefixed protocol
+  buffers."""
+  encoder = ProtocolBuffer.Encoder()
+  for entity in entities:
+    encoder.putPrefixedString(entity.ToPb().Encode())
+  return encoder.buffer().tostring()
+
+
+def _decode_entity_list(stored_value):
+  """Decodes a list of datastore.Entity encoded by _encode_entity_list()."""
+  from google.appengine.api import datastore
+  buf = array.array('B')
+  buf.fromstring(stored_value)
+  decoder = ProtocolBuffer.Decoder(buf, 0, len(buf))
+  entities = []
+  while decoder.avail() > 0:
+    entities.append(datastore.Entity.FromPb(decoder.getPrefixedString()))
+  return entities
+
+
+def register_entity_list_codec():
+  """Stores lists of datastore.Entity as their protocol buffers from now on,
+  instead of pickling them.
+
+  The protocol buffers are smaller than the pickles, and compress to about
+  half the size, so large lists are stored in fewer chunks.  Encoding and
+  decoding them takes longer than cPickle does, though, so this is only
+  worth it for lists which would otherwise be too large.  Every process that
+  reads such lists must register the codec too.
+  """
+  register_codec(CODEC_ENTITY_LIST, _is_entity_list, _encode_entity_list,
+                 _decode_entity_list)
+
 
 def _key_string(key, key_prefix='', server_to_user_dict=None):
   """Utility function to handle different ways of requesting keys.
@@ -128,28 +221,33 @@ def _key_string(key, key_prefix='', server_to_user_dict=None):
   return server_key
 
 
-def _validate_encode_value(value, do_pickle):
+def _validate_encode_value(value, do_pickle, min_compress_len=0):
   """Utility function to validate and encode server keys and values.
 
   Args:
     value: Value to store in memcache. If it's a string, it will get passed
       along as-is. If it's a unicode string, it will be marked appropriately,
-      such that retrievals will yield a unicode value. If it's any other data
-      type, this function will attempt to pickle the data and then store the
+      such that retrievals will yield a unicode value. If a registered codec
+      matches it, it is encoded by that codec. If it's any other data type,
+      this function will attempt to pickle the data and then store the
       serialized result, unpickling it upon retrieval.
     do_pickle: Callable that takes an object and returns a non-unicode
       string containing the pickled object.
+    min_compress_len: If nonzero, encoded values at least this long are
+      compressed with zlib, if that makes them shorter.
 
   Returns:
     Tuple (stored_value, flags) where:
       stored_value: The value as a non-unicode string that should be stored
-        in memcache.
+        in memcache. If it is longer than MAX_VALUE_SIZE, it has to be
+        stored in chunks.
       flags: An integer with bits set from the FLAG_* constants in this file
         to indicate the encoding of the key and value.
 
   Raises:
-    ValueError: If the encoded value is too large.
-    pickle.PicklingError: If the value is not a string and could not be pickled.
+    ValueError: If the encoded value is too large, even for MAX_CHUNKS chunks.
+    pickle.PicklingError: If the value is not a string and could not be pickled
+      (cPickle.PicklingError with the default pickler).
     RuntimeError: If a complicated data structure could not be pickled due to
       too many levels of recursion in its composition.
   """
@@ -171,13 +269,26 @@ def _validate_encode_value(value, do_pickle):
     stored_value = str(value)
     flags |= TYPE_LONG
   else:
-    stored_value = do_pickle(value)
-    flags |= TYPE_PICKLED
+    for codec_id in sorted(_CODECS):
+      matches, encode, decode = _CODECS[codec_id]
+      if matches(value):
+        stored_value = encode(value)
+        flags |= TYPE_CODEC | (codec_id << FLAG_CODEC_SHIFT)
+        break
+    else:
+      stored_value = do_pickle(value)
+      flags |= TYPE_PICKLED
 
+  if min_compress_len and len(stored_value) >= min_compress_len:
+    compressed = zlib.compress(stored_value)
+    if len(compressed) < len(stored_value):
+      stored_value = compressed
+      flags |= FLAG_COMPRESSED
 
-  if len(stored_value) > MAX_VALUE_SIZE:
+  if len(stored_value) > MAX_VALUE_SIZE * MAX_CHUNKS:
     raise ValueError('Values may not be more than %d bytes in length; '
-                     'received %d bytes' % (MAX_VALUE_SIZE, len(stored_value)))
+                     'received %d bytes' % (MAX_VALUE_SIZE * MAX_CHUNKS,
+                                            len(stored_value)))
 
   return (stored_value, flags)
 
@@ -194,16 +305,21 @@ def _decode_value(stored_value, flags, do_unpickle):
 
   Returns:
     The original object that was stored, be it a normal string, a unicode
-    string, int, long, or a Python object that was pickled.
+    string, int, long, or a Python object that was pickled or encoded by a
+    registered codec.
 
   Raises:
-    pickle.UnpicklingError: If the value could not be unpickled.
+    pickle.UnpicklingError: If the value could not be unpickled
+      (cPickle.UnpicklingError with the default unpickler).
+    ValueError: If the value was encoded by a codec that is not registered.
   """
   assert isinstance(stored_value, str)
   assert isinstance(flags, (int, long))
 
   type_number = flags & FLAG_TYPE_MASK
   value = stored_value
+  if flags & FLAG_COMPRESSED:
+    value = zlib.decompress(value)
 
 
   if type_number == TYPE_STR:
@@ -218,10 +334,77 @@ def _decode_value(stored_value, flags, do_unpickle):
     return int(value)
   elif type_number == TYPE_LONG:
     return long(value)
+  elif type_number == TYPE_CODEC:
+    codec_id = (flags & FLAG_CODEC_MASK) >> FLAG_CODEC_SHIFT
+    if codec_id not in _CODECS:
+      raise ValueError('No codec registered with ID %d' % codec_id)
+    return _CODECS[codec_id][2](value)
   else:
     assert False, "Unknown stored type"
   assert False, "Shouldn't get here."
 
+
+def _chunk_keys(server_key, chunk_header):
+  """Returns the server keys of the chunks of a value stored in chunks.
+
+  Args:
+    server_key: The server key of the value.
+    chunk_header: The value stored under server_key, which names the chunks.
+
+  Returns:
+    List of server keys, in the order of the chunks.
+  """
+  generation, count = chunk_header.split(':')
+  return [_key_string('%s:%d' % (generation, i),
+                      key_prefix=server_key + ':chunk:')
+          for i in xrange(int(count))]
+
+
+def _chunk_header_key(server_key):
+  """Returns the server key which records the chunk header of a value.
+
+  While a value is stored in chunks, its chunk header is also kept under this
+  key, so that its chunks can be found and deleted once the value is replaced
+  or deleted, without fetching the value itself.
+
+  Args:
+    server_key: The server key of the value.
+
+  Returns:
+    The server key of the record.
+  """
+  return _key_string('header', key_prefix=server_key + ':chunk:')
+
+
+def _stored_keys(response, server_keys):
+  """Returns the server keys which a Set call stored.
+
+  Args:
+    response: The MemcacheSetResponse.
+    server_keys: The server keys of the request's items, in order.
+
+  Returns:
+    Dictionary whose keys are the stored server keys.
+  """
+  return dict([(server_key, True) for server_key, set_status
+               in zip(server_keys, response.set_status_list())
+               if set_status == MemcacheSetResponse.STORED])
+
+
+def create_rpc(deadline=None, callback=None):
+  """Creates an RPC object for use with the memcache API.
+
+  Args:
+    deadline: Optional deadline in seconds for the operation; the default
+      is a system-specific deadline (typically 5 seconds).
+    callback: Optional callable to invoke on completion.
+
+  Returns:
+    An apiproxy_stub_map.UserRPC object specialized for this service.
+  """
+  return apiproxy_stub_map.UserRPC('memcache', deadline, callback)
+
+
 class Client(object):
   """Memcache client object, through which one invokes all memcache operations.
 
@@ -238,13 +421,31 @@ class Client(object):
   Any method that takes a 'value' argument will accept as that value any
   string (unicode or not), int, long, or pickle-able Python object, including
   all native types.  You'll get back from the cache the same type that you
-  originally put in.
+  originally put in.  Once register_entity_list_codec() has been called,
+  lists of datastore.Entity are stored as their protocol buffers rather than
+  pickled, and register_codec() adds encodings for other types.  Values whose
+  encodings are larger than MAX_VALUE_SIZE are stored in chunks, under keys
+  of their own; such a value is lost if any of its chunks is evicted.  The
+  chunks are deleted again when the value is replaced or deleted, or could
+  not be stored.  To find them, every set and delete also looks up the keys'
+  chunk headers alongside, which memcache counts as misses in its stats.
+
+  The client remembers the compare-and-set ID of each value fetched with
+  gets() or get_multi(for_cas=True), for cas() and cas_multi() to send back.
+  Those IDs are shared by everything using the client, so give each thread
+  its own Client when using compare-and-set, and call cas_reset() to forget
+  them.
+
+  The *_async methods start an operation and return a UserRPC straight
+  away, so that other calls can be made while memcache works on it; the
+  rpc's get_result() returns what the method without _async would have.
+  Pass an rpc from create_rpc() to set a deadline or a callback.
   """
 
   def __init__(self, servers=None, debug=0,
-               pickleProtocol=pickle.HIGHEST_PROTOCOL,
-               pickler=pickle.Pickler,
-               unpickler=pickle.Unpickler,
+               pickleProtocol=cPickle.HIGHEST_PROTOCOL,
+               pickler=cPickle.Pickler,
+               unpickler=cPickle.Unpickler,
                pload=None,
                pid=None,
                make_sync_call=apiproxy_stub_map.MakeSyncCall):
@@ -256,8 +457,10 @@ class Client(object):
       servers: Ignored; only for compatibility.
       debug: Ignored; only for compatibility.
       pickleProtocol: Pickle protocol to use for pickling the object.
-      pickler: pickle.Pickler sub-class to use for pickling.
-      unpickler: pickle.Unpickler sub-class to use for unpickling.
+      pickler: pickle.Pickler sub-class, or cPickle.Pickler, to use for
+        pickling.
+      unpickler: pickle.Unpickler sub-class, or cPickle.Unpickler, to use for
+        unpickling.
       pload: Callable to use for retrieving objects by persistent id.
       pid: Callable to use for determine the persistent id for objects, if any.
       make_sync_call: Function to use to make an App Engine service call.
@@ -288,6 +491,32 @@ class Client(object):
     self._do_unpickle = DoUnpickle
 
     self._make_sync_call = make_sync_call
+    self._cas_ids = {}
+
+  def cas_reset(self):
+    """Forgets all the compare-and-set IDs remembered by gets() so far."""
+    self._cas_ids.clear()
+
+  def _make_async_call(self, rpc, method, request, response,
+                       get_result_hook, user_data):
+    """Starts an asynchronous memcache call.
+
+    Args:
+      rpc: A UserRPC from create_rpc(), or None to create one.
+      method: The method name, e.g. 'Get'.
+      request: The request protocol buffer.
+      response: The response protocol buffer.
+      get_result_hook: Function of the rpc which returns its result.
+      user_data: Data for the get-result hook, as rpc.user_data.
+
+    Returns:
+      The UserRPC.
+    """
+    if rpc is None:
+      rpc = create_rpc()
+    assert rpc.service == 'memcache', repr(rpc.service)
+    rpc.make_call(method, request, response, get_result_hook, user_data)
+    return rpc
 
   def set_servers(self, servers):
     """Sets the pool of memcache servers used by the client.
@@ -338,6 +567,8 @@ class Client(object):
           item will survive in the cache without being accessed. This is
           _not_ the amount of time that has elapsed since the item was
           created.
+        evictions: Number of items evicted to make room for others. Only
+          reported by the development server; zero in production.
 
       On error, returns None.
     """
@@ -356,6 +587,7 @@ class Client(object):
         STAT_ITEMS: 0,
         STAT_BYTES: 0,
         STAT_OLDEST_ITEM_AGES: 0,
+        STAT_EVICTIONS: 0,
       }
 
     stats = response.stats()
@@ -366,6 +598,7 @@ class Client(object):
       STAT_ITEMS: stats.items(),
       STAT_BYTES: stats.bytes(),
       STAT_OLDEST_ITEM_AGES: stats.oldest_item_age(),
+      STAT_EVICTIONS: stats.evictions(),
     }
 
   def flush_all(self):
@@ -411,11 +644,28 @@ class Client(object):
     if not response.item_size():
       return None
 
-    return _decode_value(response.item(0).value(),
-                         response.item(0).flags(),
-                         self._do_unpickle)
+    return self._decode_items(response.item_list(), namespace).get(
+        response.item(0).key())
 
-  def get_multi(self, keys, key_prefix='', namespace=None):
+  def gets(self, key, namespace=None):
+    """Looks up a single key in memcache, to be changed with cas() later.
+
+    Like get(), but the client also remembers the value's compare-and-set ID.
+    A following cas() of the key then only stores a new value if nobody else
+    has changed the key in between.
+
+    Args:
+      key: The key in memcache to look up.  See docs on Client
+        for details of format.
+      namespace: a string specifying an optional namespace to use in
+        the request.
+
+    Returns:
+      The value of the key, if found in memcache, else None.
+    """
+    return self.get_multi([key], namespace=namespace, for_cas=True).get(key)
+
+  def get_multi(self, keys, key_prefix='', namespace=None, for_cas=False):
     """Looks up multiple keys from memcache in one operation.
 
     This is the recommended way to do bulk loads.
@@ -430,29 +680,264 @@ class Client(object):
         not included in the returned dictionary.
       namespace: a string specifying an optional namespace to use in
         the request.
+      for_cas: If True, remember the compare-and-set IDs of the values, for
+        cas() or cas_multi() to use.
 
     Returns:
       A dictionary of the keys and values that were present in memcache.
       Even if the key_prefix was specified, that key_prefix won't be on
       the keys in the returned dictionary.
     """
+    request, user_key = self._get_multi_request(keys, key_prefix, namespace,
+                                                for_cas)
+    response = MemcacheGetResponse()
+    try:
+      self._make_sync_call('memcache', 'Get', request, response)
+    except apiproxy_errors.Error:
+      return {}
+    return self._get_multi_result(response, user_key, namespace, for_cas)
+
+  def get_multi_async(self, keys, key_prefix='', namespace=None,
+                      for_cas=False, rpc=None):
+    """Starts looking up multiple keys from memcache in one operation.
+
+    The chunks of values stored in chunks are fetched by get_result(), with
+    a further synchronous call.
+
+    Args:
+      keys, key_prefix, namespace, for_cas: As for get_multi().
+      rpc: Optional UserRPC from create_rpc().
+
+    Returns:
+      A UserRPC, whose get_result() returns what get_multi() would.
+    """
+    request, user_key = self._get_multi_request(keys, key_prefix, namespace,
+                                                for_cas)
+    return self._make_async_call(rpc, 'Get', request, MemcacheGetResponse(),
+                                 self._get_multi_hook,
+                                 (user_key, namespace, for_cas))
+
+  def _get_multi_hook(self, rpc):
+    """Returns the result of a get_multi_async() rpc."""
+    try:
+      rpc.check_success()
+    except apiproxy_errors.Error:
+      return {}
+    user_key, namespace, for_cas = rpc.user_data
+    return self._get_multi_result(rpc.response, user_key, namespace, for_cas)
+
+  def _get_multi_request(self, keys, key_prefix, namespace, for_cas):
+    """Builds the request for get_multi() and get_multi_async().
+
+    Returns:
+      Tuple of the MemcacheGetRequest and a dictionary of its server keys to
+      the user's keys.
+    """
     request = MemcacheGetRequest()
     namespace_manager._add_name_space(request, namespace)
-    response = MemcacheGetResponse()
+    if for_cas:
+      request.set_for_cas(True)
     user_key = {}
     for key in keys:
       request.add_key(_key_string(key, key_prefix, user_key))
+    return request, user_key
+
+  def _get_multi_result(self, response, user_key, namespace, for_cas):
+    """Converts the response of a Get call to get_multi()'s result."""
+    return_value = {}
+    values = self._decode_items(response.item_list(), namespace,
+                                for_cas=for_cas)
+    for server_key, value in values.iteritems():
+      return_value[user_key[server_key]] = value
+    return return_value
+
+  def _decode_items(self, items, namespace, for_cas=False):
+    """Decodes the values returned by a Get call.
+
+    The chunks of values stored in chunks are fetched with one more Get call.
+    If any chunk of a value has been evicted, the value is treated as a miss.
+
+    Args:
+      items: List of MemcacheGetResponse_Item.
+      namespace: The namespace of the Get call.
+      for_cas: If True, remember the compare-and-set IDs of the items.
+
+    Returns:
+      Dictionary of the server keys of the items to their values.
+    """
+    values = {}
+    chunked = {}
+    for item in items:
+      if for_cas:
+        self._cas_ids[item.key()] = item.cas_id()
+      if item.flags() & FLAG_CHUNKED:
+        chunked[item.key()] = item
+      else:
+        values[item.key()] = _decode_value(item.value(), item.flags(),
+                                           self._do_unpickle)
+    if not chunked:
+      return values
+
+    request = MemcacheGetRequest()
+    namespace_manager._add_name_space(request, namespace)
+    chunk_keys = {}
+    for server_key, item in chunked.iteritems():
+      chunk_keys[server_key] = _chunk_keys(server_key, item.value())
+      for chunk_key in chunk_keys[server_key]:
+        request.add_key(chunk_key)
+    response = MemcacheGetResponse()
     try:
       self._make_sync_call('memcache', 'Get', request, response)
+    except apiproxy_errors.Error:
+      return values
+
+    chunks = {}
+    for item in response.item_list():
+      chunks[item.key()] = item.value()
+    for server_key, keys in chunk_keys.iteritems():
+      parts = [chunks.get(chunk_key) for chunk_key in keys]
+      if None not in parts:
+        values[server_key] = _decode_value(''.join(parts),
+                                           chunked[server_key].flags(),
+                                           self._do_unpickle)
+    return values
+
+  def _set_chunks(self, server_key, stored_value, time, namespace):
+    """Stores a value too large for a single item in chunks.
+
+    Each chunk is sent in a Set call of its own, to keep the calls under the
+    size limit for requests.  Every time a value is stored, its chunks get
+    new keys, so that readers never mix up the chunks of two values.
+
+    Args:
+      server_key: The server key of the value.
+      stored_value: The encoded value.
+      time: Expiration time for the chunks, as for the value itself.
+      namespace: a string specifying an optional namespace to use in
+        the requests.
+
+    Returns:
+      The string to store under server_key instead of the value, with
+      FLAG_CHUNKED set, or None if a chunk could not be stored.  The chunks
+      stored so far are then deleted again.
+    """
+    count = (len(stored_value) + MAX_VALUE_SIZE - 1) // MAX_VALUE_SIZE
+    chunk_header = '%x:%d' % (random.getrandbits(64), count)
+    chunk_keys = _chunk_keys(server_key, chunk_header)
+    for i, chunk_key in enumerate(chunk_keys):
+      request = MemcacheSetRequest()
+      item = request.add_item()
+      item.set_key(chunk_key)
+      item.set_value(stored_value[i * MAX_VALUE_SIZE:(i + 1) * MAX_VALUE_SIZE])
+      item.set_set_policy(MemcacheSetRequest.SET)
+      item.set_expiration_time(int(math.ceil(time)))
+      namespace_manager._add_name_space(request, namespace)
+      response = MemcacheSetResponse()
+      try:
+        self._make_sync_call('memcache', 'Set', request, response)
+        stored = response.set_status_list() == [MemcacheSetResponse.STORED]
+      except apiproxy_errors.Error:
+        stored = False
+      if not stored:
+        self._delete_server_keys(chunk_keys[:i + 1], namespace)
+        return None
+    return chunk_header
+
+  def _lookup_chunk_headers(self, server_keys, namespace):
+    """Starts fetching the recorded chunk headers of some server keys.
+
+    The lookup runs alongside the call which sets or deletes the keys.  Pass
+    its rpc to _discard_chunks() once that call has finished.
+
+    Args:
+      server_keys: The server keys which are about to be set or deleted.
+      namespace: The namespace of the keys.
+
+    Returns:
+      A UserRPC, whose get_result() returns a dictionary of those server keys
+      which hold values stored in chunks to their chunk headers.
+    """
+    request = MemcacheGetRequest()
+    namespace_manager._add_name_space(request, namespace)
+    header_keys = {}
+    for server_key in server_keys:
+      header_key = _chunk_header_key(server_key)
+      header_keys[header_key] = server_key
+      request.add_key(header_key)
+    return self._make_async_call(None, 'Get', request, MemcacheGetResponse(),
+                                 self._lookup_chunk_headers_hook, header_keys)
+
+  def _lookup_chunk_headers_hook(self, rpc):
+    """Returns the result of a _lookup_chunk_headers() rpc."""
+    try:
+      rpc.check_success()
     except apiproxy_errors.Error:
       return {}
+    header_keys = rpc.user_data
+    return dict([(header_keys[item.key()], item.value())
+                 for item in rpc.response.item_list()])
 
-    return_value = {}
-    for returned_item in response.item_list():
-      value = _decode_value(returned_item.value(), returned_item.flags(),
-                            self._do_unpickle)
-      return_value[user_key[returned_item.key()]] = value
-    return return_value
+  def _discard_chunks(self, lookup, chunk_headers, changed, time, namespace):
+    """Deletes the chunks which no stored value refers to any more.
+
+    Those are the chunks of values which were replaced or deleted, and the
+    chunks just written for values which could not be stored.  The chunk
+    headers of values which were stored in chunks are recorded.
+
+    Args:
+      lookup: The UserRPC from _lookup_chunk_headers(), started before the
+        keys were set or deleted.
+      chunk_headers: Dictionary of the server keys whose new values were
+        written in chunks to their chunk headers.
+      changed: Collection of the server keys which were stored or deleted.
+      time: Expiration time of the new values.
+      namespace: The namespace of the keys.
+    """
+    doomed = []
+    for server_key, chunk_header in chunk_headers.iteritems():
+      if server_key not in changed:
+        doomed.extend(_chunk_keys(server_key, chunk_header))
+    for server_key, chunk_header in lookup.get_result().iteritems():
+      if (server_key in changed and
+          chunk_header != chunk_headers.get(server_key)):
+        doomed.extend(_chunk_keys(server_key, chunk_header))
+        if server_key not in chunk_headers:
+          doomed.append(_chunk_header_key(server_key))
+
+    request = MemcacheSetRequest()
+    namespace_manager._add_name_space(request, namespace)
+    for server_key, chunk_header in chunk_headers.iteritems():
+      if server_key in changed:
+        item = request.add_item()
+        item.set_key(_chunk_header_key(server_key))
+        item.set_value(chunk_header)
+        item.set_set_policy(MemcacheSetRequest.SET)
+        item.set_expiration_time(int(math.ceil(time)))
+    if request.item_size():
+      try:
+        self._make_sync_call('memcache', 'Set', request, MemcacheSetResponse())
+      except apiproxy_errors.Error:
+        pass
+
+    if doomed:
+      self._delete_server_keys(doomed, namespace)
+
+  def _delete_server_keys(self, server_keys, namespace):
+    """Deletes some server keys, ignoring any errors.
+
+    Args:
+      server_keys: List of the server keys to delete.
+      namespace: The namespace of the keys.
+    """
+    request = MemcacheDeleteRequest()
+    namespace_manager._add_name_space(request, namespace)
+    for server_key in server_keys:
+      request.add_item().set_key(server_key)
+    try:
+      self._make_sync_call('memcache', 'Delete', request,
+                           MemcacheDeleteResponse())
+    except apiproxy_errors.Error:
+      pass
 
   def delete(self, key, seconds=0, namespace=None):
     """Deletes a key from memcache.
@@ -488,10 +973,12 @@ class Client(object):
     delete_item = request.add_item()
     delete_item.set_key(_key_string(key))
     delete_item.set_delete_time(int(math.ceil(seconds)))
+    lookup = self._lookup_chunk_headers([delete_item.key()], namespace)
     try:
       self._make_sync_call('memcache', 'Delete', request, response)
     except apiproxy_errors.Error:
       return DELETE_NETWORK_FAILURE
+    self._discard_chunks(lookup, {}, [delete_item.key()], 0, namespace)
     assert response.delete_status_size() == 1, 'Unexpected status size.'
 
     if response.delete_status(0) == MemcacheDeleteResponse.DELETED:
@@ -520,6 +1007,49 @@ class Client(object):
       True if all operations completed successfully.  False if one
       or more failed to complete.
     """
+    request = self._delete_multi_request(keys, seconds, key_prefix, namespace)
+    server_keys = [item.key() for item in request.item_list()]
+    lookup = self._lookup_chunk_headers(server_keys, namespace)
+    response = MemcacheDeleteResponse()
+    try:
+      self._make_sync_call('memcache', 'Delete', request, response)
+    except apiproxy_errors.Error:
+      return False
+    self._discard_chunks(lookup, {}, server_keys, 0, namespace)
+    return True
+
+  def delete_multi_async(self, keys, seconds=0, key_prefix='', namespace=None,
+                         rpc=None):
+    """Starts deleting multiple keys at once.
+
+    Args:
+      keys, seconds, key_prefix, namespace: As for delete_multi().
+      rpc: Optional UserRPC from create_rpc().
+
+    Returns:
+      A UserRPC, whose get_result() returns what delete_multi() would.
+    """
+    request = self._delete_multi_request(keys, seconds, key_prefix, namespace)
+    server_keys = [item.key() for item in request.item_list()]
+    lookup = self._lookup_chunk_headers(server_keys, namespace)
+    return self._make_async_call(rpc, 'Delete', request,
+                                 MemcacheDeleteResponse(),
+                                 self._delete_multi_hook,
+                                 (lookup, server_keys, namespace))
+
+  def _delete_multi_hook(self, rpc):
+    """Returns the result of a delete_multi_async() rpc."""
+    try:
+      rpc.check_success()
+    except apiproxy_errors.Error:
+      return False
+    lookup, server_keys, namespace = rpc.user_data
+    self._discard_chunks(lookup, {}, server_keys, 0, namespace)
+    return True
+
+  def _delete_multi_request(self, keys, seconds, key_prefix, namespace):
+    """Builds the MemcacheDeleteRequest for delete_multi() and
+    delete_multi_async()."""
     if not isinstance(seconds, (int, long, float)):
       raise TypeError('Delete timeout must be a number.')
     if seconds < 0:
@@ -527,17 +1057,11 @@ class Client(object):
 
     request = MemcacheDeleteRequest()
     namespace_manager._add_name_space(request, namespace)
-    response = MemcacheDeleteResponse()
-
     for key in keys:
       delete_item = request.add_item()
       delete_item.set_key(_key_string(key, key_prefix=key_prefix))
       delete_item.set_delete_time(int(math.ceil(seconds)))
-    try:
-      self._make_sync_call('memcache', 'Delete', request, response)
-    except apiproxy_errors.Error:
-      return False
-    return True
+    return request
 
   def set(self, key, value, time=0, min_compress_len=0, namespace=None):
     """Sets a key's value, regardless of previous contents in cache.
@@ -554,7 +1078,9 @@ class Client(object):
         By default, items never expire, though items may be evicted due to
         memory pressure.  Float values will be rounded up to the nearest
         whole second.
-      min_compress_len: Ignored option for compatibility.
+      min_compress_len: Compress the value with zlib if its encoding is at
+        least this many bytes long, and compression makes it shorter.  The
+        default, zero, never compresses.
       namespace: a string specifying an optional namespace to use in
         the request.
 
@@ -562,7 +1088,8 @@ class Client(object):
       True if set.  False on error.
     """
     return self._set_with_policy(MemcacheSetRequest.SET, key, value, time=time,
-                                 namespace=namespace)
+                                 namespace=namespace,
+                                 min_compress_len=min_compress_len)
 
   def add(self, key, value, time=0, min_compress_len=0, namespace=None):
     """Sets a key's value, iff item is not already in memcache.
@@ -575,7 +1102,9 @@ class Client(object):
         By default, items never expire, though items may be evicted due to
         memory pressure.  Float values will be rounded up to the nearest
         whole second.
-      min_compress_len: Ignored option for compatibility.
+      min_compress_len: Compress the value with zlib if its encoding is at
+        least this many bytes long, and compression makes it shorter.  The
+        default, zero, never compresses.
       namespace: a string specifying an optional namespace to use in
         the request.
 
@@ -583,7 +1112,8 @@ class Client(object):
       True if added.  False on error.
     """
     return self._set_with_policy(MemcacheSetRequest.ADD, key, value, time=time,
-                                 namespace=namespace)
+                                 namespace=namespace,
+                                 min_compress_len=min_compress_len)
 
   def replace(self, key, value, time=0, min_compress_len=0, namespace=None):
     """Replaces a key's value, failing if item isn't already in memcache.
@@ -596,7 +1126,9 @@ class Client(object):
         By default, items never expire, though items may be evicted due to
         memory pressure.  Float values will be rounded up to the nearest
         whole second.
-      min_compress_len: Ignored option for compatibility.
+      min_compress_len: Compress the value with zlib if its encoding is at
+        least this many bytes long, and compression makes it shorter.  The
+        default, zero, never compresses.
       namespace: a string specifying an optional namespace to use in
         the request.
 
@@ -604,20 +1136,49 @@ class Client(object):
       True if replaced.  False on RPC error or cache miss.
     """
     return self._set_with_policy(MemcacheSetRequest.REPLACE,
-                                 key, value, time=time, namespace=namespace)
+                                 key, value, time=time, namespace=namespace,
+                                 min_compress_len=min_compress_len)
+
+  def cas(self, key, value, time=0, min_compress_len=0, namespace=None):
+    """Compare-and-set: sets a key's value, iff nobody has changed it since
+    this client last fetched it with gets().
 
-  def _set_with_policy(self, policy, key, value, time=0, namespace=None):
+    Args:
+      key: Key to set.  See docs on Client for details.
+      value: The new value.  Any type.  If complex, will be pickled.
+      time: Optional expiration time, either relative number of seconds
+        from current time (up to 1 month), or an absolute Unix epoch time.
+        By default, items never expire, though items may be evicted due to
+        memory pressure.  Float values will be rounded up to the nearest
+        whole second.
+      min_compress_len: Compress the value with zlib if its encoding is at
+        least this many bytes long, and compression makes it shorter.  The
+        default, zero, never compresses.
+      namespace: a string specifying an optional namespace to use in
+        the request.
+
+    Returns:
+      True if updated.  False on RPC error, if the key was not fetched with
+      gets() first, or if it has since been changed, evicted or deleted.
+    """
+    return self._set_with_policy(MemcacheSetRequest.CAS, key, value,
+                                 time=time, namespace=namespace,
+                                 min_compress_len=min_compress_len)
+
+  def _set_with_policy(self, policy, key, value, time=0, namespace=None,
+                       min_compress_len=0):
     """Sets a single key with a specified policy.
 
-    Helper function for set(), add(), and replace().
+    Helper function for set(), add(), replace() and cas().
 
     Args:
-      policy:  One of MemcacheSetRequest.SET, .ADD, or .REPLACE.
+      policy:  One of MemcacheSetRequest.SET, .ADD, .REPLACE or .CAS.
       key: Key to add, set, or replace.  See docs on Client for details.
       value: Value to set.
       time: Expiration time, defaulting to 0 (never expiring).
       namespace: a string specifying an optional namespace to use in
         the request.
+      min_compress_len: Compress the value if it is at least this long.
 
     Returns:
       True if stored, False on RPC error or policy error, e.g. a replace
@@ -632,30 +1193,46 @@ class Client(object):
     request = MemcacheSetRequest()
     item = request.add_item()
     item.set_key(_key_string(key))
-    stored_value, flags = _validate_encode_value(value, self._do_pickle)
+    if policy == MemcacheSetRequest.CAS:
+      if item.key() not in self._cas_ids:
+        return False
+      item.set_cas_id(self._cas_ids[item.key()])
+    stored_value, flags = _validate_encode_value(value, self._do_pickle,
+                                                 min_compress_len)
+    chunk_headers = {}
+    if len(stored_value) > MAX_VALUE_SIZE:
+      stored_value = self._set_chunks(item.key(), stored_value, time,
+                                      namespace)
+      if stored_value is None:
+        return False
+      flags |= FLAG_CHUNKED
+      chunk_headers[item.key()] = stored_value
     item.set_value(stored_value)
     item.set_flags(flags)
     item.set_set_policy(policy)
     item.set_expiration_time(int(math.ceil(time)))
     namespace_manager._add_name_space(request, namespace)
+    lookup = self._lookup_chunk_headers([item.key()], namespace)
     response = MemcacheSetResponse()
     try:
       self._make_sync_call('memcache', 'Set', request, response)
     except apiproxy_errors.Error:
+      self._discard_chunks(lookup, chunk_headers, (), time, namespace)
       return False
-    if response.set_status_size() != 1:
-      return False
-    return response.set_status(0) == MemcacheSetResponse.STORED
+    stored = _stored_keys(response, [item.key()])
+    self._discard_chunks(lookup, chunk_headers, stored, time, namespace)
+    return bool(stored)
 
   def _set_multi_with_policy(self, policy, mapping, time=0, key_prefix='',
-                             namespace=None):
+                             namespace=None, min_compress_len=0):
     """Set multiple keys with a specified policy.
 
-    Helper function for set_multi(), add_multi(), and replace_multi(). This
-    reduces the network latency of doing many requests in serial.
+    Helper function for set_multi(), add_multi(), replace_multi() and
+    cas_multi(). This reduces the network latency of doing many requests in
+    serial.
 
     Args:
-      policy:  One of MemcacheSetRequest.SET, ADD, or REPLACE.
+      policy:  One of MemcacheSetRequest.SET, ADD, REPLACE or CAS.
       mapping: Dictionary of keys to values.
       time: Optional expiration time, either relative number of seconds
         from current time (up to 1 month), or an absolute Unix epoch time.
@@ -665,6 +1242,7 @@ class Client(object):
       key_prefix: Prefix for to prepend to all keys.
       namespace: a string specifying an optional namespace to use in
         the request.
+      min_compress_len: Compress values that are at least this long.
 
     Returns:
       A list of keys whose values were NOT set.  On total success,
@@ -672,6 +1250,77 @@ class Client(object):
       a list of all input keys is returned; in this case the keys
       may or may not have been updated.
     """
+    request, server_keys, user_key, unset_list, chunk_headers = (
+        self._set_multi_request(policy, mapping, time, key_prefix, namespace,
+                                min_compress_len))
+    if not server_keys:
+      return unset_list
+
+    lookup = self._lookup_chunk_headers(server_keys, namespace)
+    response = MemcacheSetResponse()
+    try:
+      self._make_sync_call('memcache', 'Set', request, response)
+    except apiproxy_errors.Error:
+      self._discard_chunks(lookup, chunk_headers, (), time, namespace)
+      return user_key.values()
+    self._discard_chunks(lookup, chunk_headers,
+                         _stored_keys(response, server_keys), time, namespace)
+    return self._set_multi_result(response, server_keys, user_key,
+                                  unset_list)
+
+  def _set_multi_async_with_policy(self, policy, mapping, time=0,
+                                   key_prefix='', namespace=None,
+                                   min_compress_len=0, rpc=None):
+    """Starts setting multiple keys with a specified policy.
+
+    Helper function for set_multi_async(), add_multi_async(),
+    replace_multi_async() and cas_multi_async().  Values stored in chunks
+    have their chunks stored synchronously, before the rpc is started.
+
+    Args:
+      policy, mapping, time, key_prefix, namespace, min_compress_len: As for
+        _set_multi_with_policy().
+      rpc: Optional UserRPC from create_rpc().
+
+    Returns:
+      A UserRPC, whose get_result() returns what _set_multi_with_policy()
+      would.
+    """
+    request, server_keys, user_key, unset_list, chunk_headers = (
+        self._set_multi_request(policy, mapping, time, key_prefix, namespace,
+                                min_compress_len))
+    lookup = self._lookup_chunk_headers(server_keys, namespace)
+    return self._make_async_call(rpc, 'Set', request, MemcacheSetResponse(),
+                                 self._set_multi_hook,
+                                 (server_keys, user_key, unset_list, lookup,
+                                  chunk_headers, time, namespace))
+
+  def _set_multi_hook(self, rpc):
+    """Returns the result of a _set_multi_async_with_policy() rpc."""
+    (server_keys, user_key, unset_list, lookup, chunk_headers, time,
+     namespace) = rpc.user_data
+    try:
+      rpc.check_success()
+    except apiproxy_errors.Error:
+      self._discard_chunks(lookup, chunk_headers, (), time, namespace)
+      return user_key.values()
+    self._discard_chunks(lookup, chunk_headers,
+                         _stored_keys(rpc.response, server_keys), time,
+                         namespace)
+    return self._set_multi_result(rpc.response, server_keys, user_key,
+                                  unset_list)
+
+  def _set_multi_request(self, policy, mapping, time, key_prefix, namespace,
+                         min_compress_len):
+    """Builds the request for setting multiple keys with a specified policy.
+
+    Returns:
+      Tuple of the MemcacheSetRequest, the server keys of its items in
+      order, a dictionary of all the server keys to the user's keys, a list
+      of the user's keys which could not be put in the request, and a
+      dictionary of the server keys of values written in chunks to their
+      chunk headers.
+    """
     if not isinstance(time, (int, long, float)):
       raise TypeError('Expiration must be a number.')
     if time < 0.0:
@@ -680,28 +1329,41 @@ class Client(object):
     request = MemcacheSetRequest()
     user_key = {}
     server_keys = []
+    unset_list = []
+    chunk_headers = {}
     for key, value in mapping.iteritems():
       server_key = _key_string(key, key_prefix, user_key)
-      stored_value, flags = _validate_encode_value(value, self._do_pickle)
+      if (policy == MemcacheSetRequest.CAS and
+          server_key not in self._cas_ids):
+        unset_list.append(key)
+        continue
+      stored_value, flags = _validate_encode_value(value, self._do_pickle,
+                                                   min_compress_len)
+      if len(stored_value) > MAX_VALUE_SIZE:
+        stored_value = self._set_chunks(server_key, stored_value, time,
+                                        namespace)
+        if stored_value is None:
+          unset_list.append(key)
+          continue
+        flags |= FLAG_CHUNKED
+        chunk_headers[server_key] = stored_value
       server_keys.append(server_key)
 
       item = request.add_item()
       item.set_key(server_key)
+      if policy == MemcacheSetRequest.CAS:
+        item.set_cas_id(self._cas_ids[server_key])
       item.set_value(stored_value)
       item.set_flags(flags)
       item.set_set_policy(policy)
       item.set_expiration_time(int(math.ceil(time)))
     namespace_manager._add_name_space(request, namespace)
+    return request, server_keys, user_key, unset_list, chunk_headers
 
-    response = MemcacheSetResponse()
-    try:
-      self._make_sync_call('memcache', 'Set', request, response)
-    except apiproxy_errors.Error:
-      return user_key.values()
-
+  def _set_multi_result(self, response, server_keys, user_key, unset_list):
+    """Converts the response of a Set call to the list of keys not set."""
     assert response.set_status_size() == len(server_keys)
 
-    unset_list = []
     for server_key, set_status in zip(server_keys, response.set_status_list()):
       if set_status != MemcacheSetResponse.STORED:
         unset_list.append(user_key[server_key])
@@ -720,7 +1382,9 @@ class Client(object):
         memory pressure.  Float values will be rounded up to the nearest
         whole second.
       key_prefix: Prefix for to prepend to all keys.
-      min_compress_len: Unimplemented compatibility option.
+      min_compress_len: Compress values with zlib if their encodings are at
+        least this many bytes long, and compression makes them shorter.  The
+        default, zero, never compresses.
       namespace: a string specifying an optional namespace to use in
         the request.
 
@@ -730,7 +1394,8 @@ class Client(object):
     """
     return self._set_multi_with_policy(MemcacheSetRequest.SET, mapping,
                                        time=time, key_prefix=key_prefix,
-                                       namespace=namespace)
+                                       namespace=namespace,
+                                       min_compress_len=min_compress_len)
 
   def add_multi(self, mapping, time=0, key_prefix='', min_compress_len=0,
                 namespace=None):
@@ -744,7 +1409,9 @@ class Client(object):
         memory pressure.  Float values will be rounded up to the nearest
         whole second.
       key_prefix: Prefix for to prepend to all keys.
-      min_compress_len: Unimplemented compatibility option.
+      min_compress_len: Compress values with zlib if their encodings are at
+        least this many bytes long, and compression makes them shorter.  The
+        default, zero, never compresses.
       namespace: a string specifying an optional namespace to use in
         the request.
 
@@ -754,7 +1421,8 @@ class Client(object):
     """
     return self._set_multi_with_policy(MemcacheSetRequest.ADD, mapping,
                                        time=time, key_prefix=key_prefix,
-                                       namespace=namespace)
+                                       namespace=namespace,
+                                       min_compress_len=min_compress_len)
 
   def replace_multi(self, mapping, time=0, key_prefix='', min_compress_len=0,
                     namespace=None):
@@ -768,7 +1436,9 @@ class Client(object):
         memory pressure.  Float values will be rounded up to the nearest
         whole second.
       key_prefix: Prefix for to prepend to all keys.
-      min_compress_len: Unimplemented compatibility option.
+      min_compress_len: Compress values with zlib if their encodings are at
+        least this many bytes long, and compression makes them shorter.  The
+        default, zero, never compresses.
       namespace: a string specifying an optional namespace to use in
         the request.
 
@@ -778,7 +1448,102 @@ class Client(object):
     """
     return self._set_multi_with_policy(MemcacheSetRequest.REPLACE, mapping,
                                        time=time, key_prefix=key_prefix,
-                                       namespace=namespace)
+                                       namespace=namespace,
+                                       min_compress_len=min_compress_len)
+
+  def cas_multi(self, mapping, time=0, key_prefix='', min_compress_len=0,
+                namespace=None):
+    """Compare-and-set multiple keys' values at once.  Each is only set if
+    nobody has changed it since this client last fetched it, with gets() or
+    get_multi(for_cas=True).
+
+    Args:
+      mapping: Dictionary of keys to values.
+      time: Optional expiration time, either relative number of seconds
+        from current time (up to 1 month), or an absolute Unix epoch time.
+        By default, items never expire, though items may be evicted due to
+        memory pressure.  Float values will be rounded up to the nearest
+        whole second.
+      key_prefix: Prefix for to prepend to all keys.
+      min_compress_len: Compress values with zlib if their encodings are at
+        least this many bytes long, and compression makes them shorter.  The
+        default, zero, never compresses.
+      namespace: a string specifying an optional namespace to use in
+        the request.
+
+    Returns:
+      A list of keys whose values were NOT set, because they were not
+      fetched for compare-and-set first, or have been changed since.  On
+      total success, this list should be empty.
+    """
+    return self._set_multi_with_policy(MemcacheSetRequest.CAS, mapping,
+                                       time=time, key_prefix=key_prefix,
+                                       namespace=namespace,
+                                       min_compress_len=min_compress_len)
+
+  def set_multi_async(self, mapping, time=0, key_prefix='',
+                      min_compress_len=0, namespace=None, rpc=None):
+    """Starts setting multiple keys' values, regardless of previous contents.
+
+    Args:
+      mapping, time, key_prefix, min_compress_len, namespace: As for
+        set_multi().
+      rpc: Optional UserRPC from create_rpc().
+
+    Returns:
+      A UserRPC, whose get_result() returns what set_multi() would.
+    """
+    return self._set_multi_async_with_policy(
+        MemcacheSetRequest.SET, mapping, time=time, key_prefix=key_prefix,
+        namespace=namespace, min_compress_len=min_compress_len, rpc=rpc)
+
+  def add_multi_async(self, mapping, time=0, key_prefix='',
+                      min_compress_len=0, namespace=None, rpc=None):
+    """Starts setting multiple keys' values iff not already in memcache.
+
+    Args:
+      mapping, time, key_prefix, min_compress_len, namespace: As for
+        add_multi().
+      rpc: Optional UserRPC from create_rpc().
+
+    Returns:
+      A UserRPC, whose get_result() returns what add_multi() would.
+    """
+    return self._set_multi_async_with_policy(
+        MemcacheSetRequest.ADD, mapping, time=time, key_prefix=key_prefix,
+        namespace=namespace, min_compress_len=min_compress_len, rpc=rpc)
+
+  def replace_multi_async(self, mapping, time=0, key_prefix='',
+                          min_compress_len=0, namespace=None, rpc=None):
+    """Starts replacing multiple keys' values, failing if not in memcache.
+
+    Args:
+      mapping, time, key_prefix, min_compress_len, namespace: As for
+        replace_multi().
+      rpc: Optional UserRPC from create_rpc().
+
+    Returns:
+      A UserRPC, whose get_result() returns what replace_multi() would.
+    """
+    return self._set_multi_async_with_policy(
+        MemcacheSetRequest.REPLACE, mapping, time=time, key_prefix=key_prefix,
+        namespace=namespace, min_compress_len=min_compress_len, rpc=rpc)
+
+  def cas_multi_async(self, mapping, time=0, key_prefix='',
+                      min_compress_len=0, namespace=None, rpc=None):
+    """Starts compare-and-setting multiple keys' values at once.
+
+    Args:
+      mapping, time, key_prefix, min_compress_len, namespace: As for
+        cas_multi().
+      rpc: Optional UserRPC from create_rpc().
+
+    Returns:
+      A UserRPC, whose get_result() returns what cas_multi() would.
+    """
+    return self._set_multi_async_with_policy(
+        MemcacheSetRequest.CAS, mapping, time=time, key_prefix=key_prefix,
+        namespace=namespace, min_compress_len=min_compress_len, rpc=rpc)
 
   def incr(self, key, delta=1, namespace=None, initial_value=None):
     """Atomically increments a key's value.
@@ -868,6 +1633,69 @@ class Client(object):
       ValueError: If delta is negative.
       TypeError: If delta isn't an int or long.
     """
+    request = self._incrdecr_request(key, is_negative, delta, namespace,
+                                     initial_value)
+    response = MemcacheIncrementResponse()
+    try:
+      self._make_sync_call('memcache', 'Increment', request, response)
+    except apiproxy_errors.Error:
+      return None
+
+    if response.has_new_value():
+      return response.new_value()
+    return None
+
+  def incr_async(self, key, delta=1, namespace=None, initial_value=None,
+                 rpc=None):
+    """Starts atomically incrementing a key's value.
+
+    Args:
+      key, delta, namespace, initial_value: As for incr().
+      rpc: Optional UserRPC from create_rpc().
+
+    Returns:
+      A UserRPC, whose get_result() returns what incr() would.
+    """
+    return self._incrdecr_async(key, False, delta, namespace, initial_value,
+                                rpc)
+
+  def decr_async(self, key, delta=1, namespace=None, initial_value=None,
+                 rpc=None):
+    """Starts atomically decrementing a key's value.
+
+    Args:
+      key, delta, namespace, initial_value: As for decr().
+      rpc: Optional UserRPC from create_rpc().
+
+    Returns:
+      A UserRPC, whose get_result() returns what decr() would.
+    """
+    return self._incrdecr_async(key, True, delta, namespace, initial_value,
+                                rpc)
+
+  def _incrdecr_async(self, key, is_negative, delta, namespace, initial_value,
+                      rpc):
+    """Starts incrementing or decrementing a key by a provided delta."""
+    request = self._incrdecr_request(key, is_negative, delta, namespace,
+                                     initial_value)
+    return self._make_async_call(rpc, 'Increment', request,
+                                 MemcacheIncrementResponse(),
+                                 self._incrdecr_hook, None)
+
+  def _incrdecr_hook(self, rpc):
+    """Returns the result of an incr_async() or decr_async() rpc."""
+    try:
+      rpc.check_success()
+    except apiproxy_errors.Error:
+      return None
+    if rpc.response.has_new_value():
+      return rpc.response.new_value()
+    return None
+
+  def _incrdecr_request(self, key, is_negative, delta, namespace,
+                        initial_value):
+    """Builds the MemcacheIncrementRequest for incrementing or decrementing
+    a key."""
     if not isinstance(delta, (int, long)):
       raise TypeError('Delta must be an integer or long, received %r' % delta)
     if delta < 0:
@@ -875,7 +1703,6 @@ class Client(object):
 
     request = MemcacheIncrementRequest()
     namespace_manager._add_name_space(request, namespace)
-    response = MemcacheIncrementResponse()
     request.set_key(_key_string(key))
     request.set_delta(delta)
     if is_negative:
@@ -884,15 +1711,109 @@ class Client(object):
       request.set_direction(MemcacheIncrementRequest.INCREMENT)
     if initial_value is not None:
       request.set_initial_value(long(initial_value))
+    return request
+
+  def offset_multi(self, mapping, key_prefix='', namespace=None,
+                   initial_value=None):
+    """Atomically offsets the values of multiple keys in one operation.
+
+    Each key is incremented or decremented on its own, as by incr() or
+    decr(), but all of them are sent to memcache at once.
+
+    Args:
+      mapping: Dictionary of keys to offsets.  An offset is an int or long,
+        which is added to the key's value if positive and subtracted from it
+        if negative.
+      key_prefix: Prefix for to prepend to all keys.
+      namespace: a string specifying an optional namespace to use in
+        the request.
+      initial_value: initial value to put in the cache for keys which don't
+        already exist.  The default value, None, will not create cache
+        entries for them.
+
+    Returns:
+      Dictionary of the keys to their new long integer values, or to None if
+      they could not be offset.  On network/RPC/server errors, all of the
+      keys map to None.
+
+    Raises:
+      TypeError: If an offset isn't an int or long.
+    """
+    request, keys = self._offset_multi_request(mapping, key_prefix, namespace,
+                                               initial_value)
+    response = MemcacheBatchIncrementResponse()
+    try:
+      self._make_sync_call('memcache', 'BatchIncrement', request, response)
+    except apiproxy_errors.Error:
+      return dict.fromkeys(keys)
+    return self._offset_multi_result(response, keys)
 
+  def offset_multi_async(self, mapping, key_prefix='', namespace=None,
+                         initial_value=None, rpc=None):
+    """Starts atomically offsetting the values of multiple keys.
+
+    Args:
+      mapping, key_prefix, namespace, initial_value: As for offset_multi().
+      rpc: Optional UserRPC from create_rpc().
+
+    Returns:
+      A UserRPC, whose get_result() returns what offset_multi() would.
+    """
+    request, keys = self._offset_multi_request(mapping, key_prefix, namespace,
+                                               initial_value)
+    return self._make_async_call(rpc, 'BatchIncrement', request,
+                                 MemcacheBatchIncrementResponse(),
+                                 self._offset_multi_hook, keys)
+
+  def _offset_multi_hook(self, rpc):
+    """Returns the result of an offset_multi_async() rpc."""
+    keys = rpc.user_data
     try:
-      self._make_sync_call('memcache', 'Increment', request, response)
+      rpc.check_success()
     except apiproxy_errors.Error:
-      return None
+      return dict.fromkeys(keys)
+    return self._offset_multi_result(rpc.response, keys)
 
-    if response.has_new_value():
-      return response.new_value()
-    return None
+  def _offset_multi_request(self, mapping, key_prefix, namespace,
+                            initial_value):
+    """Builds the request for offset_multi() and offset_multi_async().
+
+    Returns:
+      Tuple of the MemcacheBatchIncrementRequest and the user's keys, in the
+      order of its items.
+    """
+    request = MemcacheBatchIncrementRequest()
+    namespace_manager._add_name_space(request, namespace)
+    keys = []
+    for key, delta in mapping.iteritems():
+      if not isinstance(delta, (int, long)):
+        raise TypeError('Delta must be an integer or long, received %r' %
+                        delta)
+      keys.append(key)
+      item = request.add_item()
+      item.set_key(_key_string(key, key_prefix))
+      if delta < 0:
+        item.set_direction(MemcacheIncrementRequest.DECREMENT)
+        item.set_delta(-delta)
+      else:
+        item.set_direction(MemcacheIncrementRequest.INCREMENT)
+        item.set_delta(delta)
+      if initial_value is not None:
+        item.set_initial_value(long(initial_value))
+    return request, keys
+
+  def _offset_multi_result(self, response, keys):
+    """Converts the response of a BatchIncrement call to offset_multi()'s
+    result."""
+    assert response.item_size() == len(keys)
+
+    new_values = {}
+    for key, item in zip(keys, response.item_list()):
+      if item.has_new_value():
+        new_values[key] = item.new_value()
+      else:
+        new_values[key] = None
+    return new_values
 
 
 _CLIENT = None
@@ -917,16 +1838,30 @@ def setup_client(client_obj):
   var_dict['debuglog'] = _CLIENT.debuglog
   var_dict['get'] = _CLIENT.get
   var_dict['get_multi'] = _CLIENT.get_multi
+  var_dict['get_multi_async'] = _CLIENT.get_multi_async
+  var_dict['gets'] = _CLIENT.gets
   var_dict['set'] = _CLIENT.set
   var_dict['set_multi'] = _CLIENT.set_multi
+  var_dict['set_multi_async'] = _CLIENT.set_multi_async
   var_dict['add'] = _CLIENT.add
   var_dict['add_multi'] = _CLIENT.add_multi
+  var_dict['add_multi_async'] = _CLIENT.add_multi_async
   var_dict['replace'] = _CLIENT.replace
   var_dict['replace_multi'] = _CLIENT.replace_multi
+  var_dict['replace_multi_async'] = _CLIENT.replace_multi_async
+  var_dict['cas'] = _CLIENT.cas
+  var_dict['cas_multi'] = _CLIENT.cas_multi
+  var_dict['cas_multi_async'] = _CLIENT.cas_multi_async
+  var_dict['cas_reset'] = _CLIENT.cas_reset
   var_dict['delete'] = _CLIENT.delete
   var_dict['delete_multi'] = _CLIENT.delete_multi
+  var_dict['delete_multi_async'] = _CLIENT.delete_multi_async
   var_dict['incr'] = _CLIENT.incr
+  var_dict['incr_async'] = _CLIENT.incr_async
   var_dict['decr'] = _CLIENT.decr
+  var_dict['decr_async'] = _CLIENT.decr_async
+  var_dict['offset_multi'] = _CLIENT.offset_multi
+  var_dict['offset_multi_async'] = _CLIENT.offset_multi_async
   var_dict['flush_all'] = _CLIENT.flush_all
   var_dict['get_stats'] = _CLIENT.get_stats
 
@@ -91,6 +91,8 @@ class MemcacheServiceError(ProtocolBuffer.ProtocolMessage):
 class MemcacheGetRequest(ProtocolBuffer.ProtocolMessage):
   has_name_space_ = 0
   name_space_ = ""
+  has_for_cas_ = 0
+  for_cas_ = 0
 
   def __init__(self, contents=None):
     self.key_ = []
@@ -124,11 +126,25 @@ class MemcacheGetRequest(ProtocolBuffer.ProtocolMessage):
 
   def has_name_space(self): return self.has_name_space_
 
+  def for_cas(self): return self.for_cas_
+
+  def set_for_cas(self, x):
+    self.has_for_cas_ = 1
+    self.for_cas_ = x
+
+  def clear_for_cas(self):
+    if self.has_for_cas_:
+      self.has_for_cas_ = 0
+      self.for_cas_ = 0
+
+  def has_for_cas(self): return self.has_for_cas_
+
 
   def MergeFrom(self, x):
     assert x is not self
     for i in xrange(x.key_size()): self.add_key(x.key(i))
     if (x.has_name_space()): self.set_name_space(x.name_space())
+    if (x.has_for_cas()): self.set_for_cas(x.for_cas())
 
   def Equals(self, x):
     if x is self: return 1
@@ -137,6 +153,8 @@ class MemcacheGetRequest(ProtocolBuffer.ProtocolMessage):
       if e1 != e2: return 0
     if self.has_name_space_ != x.has_name_space_: return 0
     if self.has_name_space_ and self.name_space_ != x.name_space_: return 0
+    if self.has_for_cas_ != x.has_for_cas_: return 0
+    if self.has_for_cas_ and self.for_cas_ != x.for_cas_: return 0
     return 1
 
   def IsInitialized(self, debug_strs=None):
@@ -148,11 +166,13 @@ class MemcacheGetRequest(ProtocolBuffer.ProtocolMessage):
     n += 1 * len(self.key_)
     for i in xrange(len(self.key_)): n += self.lengthString(len(self.key_[i]))
     if (self.has_name_space_): n += 1 + self.lengthString(len(self.name_space_))
+    if (self.has_for_cas_): n += 2
     return n + 0
 
   def Clear(self):
     self.clear_key()
     self.clear_name_space()
+    self.clear_for_cas()
 
   def OutputUnchecked(self, out):
     for i in xrange(len(self.key_)):
@@ -161,6 +181,9 @@ class MemcacheGetRequest(ProtocolBuffer.ProtocolMessage):
     if (self.has_name_space_):
       out.putVarInt32(18)
       out.putPrefixedString(self.name_space_)
+    if (self.has_for_cas_):
+      out.putVarInt32(32)
+      out.putBoolean(self.for_cas_)
 
   def TryMerge(self, d):
     while d.avail() > 0:
@@ -171,6 +194,9 @@ class MemcacheGetRequest(ProtocolBuffer.ProtocolMessage):
       if tt == 18:
         self.set_name_space(d.getPrefixedString())
         continue
+      if tt == 32:
+        self.set_for_cas(d.getBoolean())
+        continue
       if (tt == 0): raise ProtocolBuffer.ProtocolBufferDecodeError
       d.skipData(tt)
 
@@ -184,6 +210,7 @@ class MemcacheGetRequest(ProtocolBuffer.ProtocolMessage):
       res+=prefix+("key%s: %s\n" % (elm, self.DebugFormatString(e)))
       cnt+=1
     if self.has_name_space_: res+=prefix+("name_space: %s\n" % self.DebugFormatString(self.name_space_))
+    if self.has_for_cas_: res+=prefix+("for_cas: %s\n" % self.DebugFormatBool(self.for_cas_))
     return res
 
 
@@ -192,18 +219,21 @@ class MemcacheGetRequest(ProtocolBuffer.ProtocolMessage):
 
   kkey = 1
   kname_space = 2
+  kfor_cas = 4
 
   _TEXT = _BuildTagLookupTable({
     0: "ErrorCode",
     1: "key",
     2: "name_space",
-  }, 2)
+    4: "for_cas",
+  }, 4)
 
   _TYPES = _BuildTagLookupTable({
     0: ProtocolBuffer.Encoder.NUMERIC,
     1: ProtocolBuffer.Encoder.STRING,
     2: ProtocolBuffer.Encoder.STRING,
-  }, 2, ProtocolBuffer.Encoder.MAX_TYPE)
+    4: ProtocolBuffer.Encoder.NUMERIC,
+  }, 4, ProtocolBuffer.Encoder.MAX_TYPE)
 
   _STYLE = """"""
   _STYLE_CONTENT_TYPE = """"""
@@ -214,6 +244,8 @@ class MemcacheGetResponse_Item(ProtocolBuffer.ProtocolMessage):
   value_ = ""
   has_flags_ = 0
   flags_ = 0
+  has_cas_id_ = 0
+  cas_id_ = 0
 
   def __init__(self, contents=None):
     if contents is not None: self.MergeFromString(contents)
@@ -257,12 +289,26 @@ class MemcacheGetResponse_Item(ProtocolBuffer.ProtocolMessage):
 
   def has_flags(self): return self.has_flags_
 
+  def cas_id(self): return self.cas_id_
+
+  def set_cas_id(self, x):
+    self.has_cas_id_ = 1
+    self.cas_id_ = x
+
+  def clear_cas_id(self):
+    if self.has_cas_id_:
+      self.has_cas_id_ = 0
+      self.cas_id_ = 0
+
+  def has_cas_id(self): return self.has_cas_id_
+
 
   def MergeFrom(self, x):
     assert x is not self
     if (x.has_key()): self.set_key(x.key())
     if (x.has_value()): self.set_value(x.value())
     if (x.has_flags()): self.set_flags(x.flags())
+    if (x.has_cas_id()): self.set_cas_id(x.cas_id())
 
   def Equals(self, x):
     if x is self: return 1
@@ -272,6 +318,8 @@ class MemcacheGetResponse_Item(ProtocolBuffer.ProtocolMessage):
     if self.has_value_ and self.value_ != x.value_: return 0
     if self.has_flags_ != x.has_flags_: return 0
     if self.has_flags_ and self.flags_ != x.flags_: return 0
+    if self.has_cas_id_ != x.has_cas_id_: return 0
+    if self.has_cas_id_ and self.cas_id_ != x.cas_id_: return 0
     return 1
 
   def IsInitialized(self, debug_strs=None):
@@ -291,12 +339,14 @@ class MemcacheGetResponse_Item(ProtocolBuffer.ProtocolMessage):
     n += self.lengthString(len(self.key_))
     n += self.lengthString(len(self.value_))
     if (self.has_flags_): n += 5
+    if (self.has_cas_id_): n += 9
     return n + 2
 
   def Clear(self):
     self.clear_key()
     self.clear_value()
     self.clear_flags()
+    self.clear_cas_id()
 
   def OutputUnchecked(self, out):
     out.putVarInt32(18)
@@ -306,6 +356,9 @@ class MemcacheGetResponse_Item(ProtocolBuffer.ProtocolMessage):
     if (self.has_flags_):
       out.putVarInt32(37)
       out.put32(self.flags_)
+    if (self.has_cas_id_):
+      out.putVarInt32(41)
+      out.put64(self.cas_id_)
 
   def TryMerge(self, d):
     while 1:
@@ -320,6 +373,9 @@ class MemcacheGetResponse_Item(ProtocolBuffer.ProtocolMessage):
       if tt == 37:
         self.set_flags(d.get32())
         continue
+      if tt == 41:
+        self.set_cas_id(d.get64())
+        continue
       if (tt == 0): raise ProtocolBuffer.ProtocolBufferDecodeError
       d.skipData(tt)
 
@@ -329,6 +385,7 @@ class MemcacheGetResponse_Item(ProtocolBuffer.ProtocolMessage):
     if self.has_key_: res+=prefix+("key: %s\n" % self.DebugFormatString(self.key_))
     if self.has_value_: res+=prefix+("value: %s\n" % self.DebugFormatString(self.value_))
     if self.has_flags_: res+=prefix+("flags: %s\n" % self.DebugFormatFixed32(self.flags_))
+    if self.has_cas_id_: res+=prefix+("cas_id: %s\n" % self.DebugFormatFixed64(self.cas_id_))
     return res
 
 class MemcacheGetResponse(ProtocolBuffer.ProtocolMessage):
@@ -416,6 +473,7 @@ class MemcacheGetResponse(ProtocolBuffer.ProtocolMessage):
   kItemkey = 2
   kItemvalue = 3
   kItemflags = 4
+  kItemcas_id = 5
 
   _TEXT = _BuildTagLookupTable({
     0: "ErrorCode",
@@ -423,7 +481,8 @@ class MemcacheGetResponse(ProtocolBuffer.ProtocolMessage):
     2: "key",
     3: "value",
     4: "flags",
-  }, 4)
+    5: "cas_id",
+  }, 5)
 
   _TYPES = _BuildTagLookupTable({
     0: ProtocolBuffer.Encoder.NUMERIC,
@@ -431,7 +490,8 @@ class MemcacheGetResponse(ProtocolBuffer.ProtocolMessage):
     2: ProtocolBuffer.Encoder.STRING,
     3: ProtocolBuffer.Encoder.STRING,
     4: ProtocolBuffer.Encoder.FLOAT,
-  }, 4, ProtocolBuffer.Encoder.MAX_TYPE)
+    5: ProtocolBuffer.Encoder.DOUBLE,
+  }, 5, ProtocolBuffer.Encoder.MAX_TYPE)
 
   _STYLE = """"""
   _STYLE_CONTENT_TYPE = """"""
@@ -446,6 +506,8 @@ class MemcacheSetRequest_Item(ProtocolBuffer.ProtocolMessage):
   set_policy_ = 1
   has_expiration_time_ = 0
   expiration_time_ = 0
+  has_cas_id_ = 0
+  cas_id_ = 0
 
   def __init__(self, contents=None):
     if contents is not None: self.MergeFromString(contents)
@@ -515,6 +577,19 @@ class MemcacheSetRequest_Item(ProtocolBuffer.ProtocolMessage):
 
   def has_expiration_time(self): return self.has_expiration_time_
 
+  def cas_id(self): return self.cas_id_
+
+  def set_cas_id(self, x):
+    self.has_cas_id_ = 1
+    self.cas_id_ = x
+
+  def clear_cas_id(self):
+    if self.has_cas_id_:
+      self.has_cas_id_ = 0
+      self.cas_id_ = 0
+
+  def has_cas_id(self): return self.has_cas_id_
+
 
   def MergeFrom(self, x):
     assert x is not self
@@ -523,6 +598,7 @@ class MemcacheSetRequest_Item(ProtocolBuffer.ProtocolMessage):
     if (x.has_flags()): self.set_flags(x.flags())
     if (x.has_set_policy()): self.set_set_policy(x.set_policy())
     if (x.has_expiration_time()): self.set_expiration_time(x.expiration_time())
+    if (x.has_cas_id()): self.set_cas_id(x.cas_id())
 
   def Equals(self, x):
     if x is self: return 1
@@ -536,6 +612,8 @@ class MemcacheSetRequest_Item(ProtocolBuffer.ProtocolMessage):
     if self.has_set_policy_ and self.set_policy_ != x.set_policy_: return 0
     if self.has_expiration_time_ != x.has_expiration_time_: return 0
     if self.has_expiration_time_ and self.expiration_time_ != x.expiration_time_: return 0
+    if self.has_cas_id_ != x.has_cas_id_: return 0
+    if self.has_cas_id_ and self.cas_id_ != x.cas_id_: return 0
     return 1
 
   def IsInitialized(self, debug_strs=None):
@@ -557,6 +635,7 @@ class MemcacheSetRequest_Item(ProtocolBuffer.ProtocolMessage):
     if (self.has_flags_): n += 5
     if (self.has_set_policy_): n += 1 + self.lengthVarInt64(self.set_policy_)
     if (self.has_expiration_time_): n += 5
+    if (self.has_cas_id_): n += 9
     return n + 2
 
   def Clear(self):
@@ -565,6 +644,7 @@ class MemcacheSetRequest_Item(ProtocolBuffer.ProtocolMessage):
     self.clear_flags()
     self.clear_set_policy()
     self.clear_expiration_time()
+    self.clear_cas_id()
 
   def OutputUnchecked(self, out):
     out.putVarInt32(18)
@@ -580,6 +660,9 @@ class MemcacheSetRequest_Item(ProtocolBuffer.ProtocolMessage):
     if (self.has_expiration_time_):
       out.putVarInt32(53)
       out.put32(self.expiration_time_)
+    if (self.has_cas_id_):
+      out.putVarInt32(65)
+      out.put64(self.cas_id_)
 
   def TryMerge(self, d):
     while 1:
@@ -600,6 +683,9 @@ class MemcacheSetRequest_Item(ProtocolBuffer.ProtocolMessage):
       if tt == 53:
         self.set_expiration_time(d.get32())
         continue
+      if tt == 65:
+        self.set_cas_id(d.get64())
+        continue
       if (tt == 0): raise ProtocolBuffer.ProtocolBufferDecodeError
       d.skipData(tt)
 
@@ -611,6 +697,7 @@ class MemcacheSetRequest_Item(ProtocolBuffer.ProtocolMessage):
     if self.has_flags_: res+=prefix+("flags: %s\n" % self.DebugFormatFixed32(self.flags_))
     if self.has_set_policy_: res+=prefix+("set_policy: %s\n" % self.DebugFormatInt32(self.set_policy_))
     if self.has_expiration_time_: res+=prefix+("expiration_time: %s\n" % self.DebugFormatFixed32(self.expiration_time_))
+    if self.has_cas_id_: res+=prefix+("cas_id: %s\n" % self.DebugFormatFixed64(self.cas_id_))
     return res
 
 class MemcacheSetRequest(ProtocolBuffer.ProtocolMessage):
@@ -618,11 +705,13 @@ class MemcacheSetRequest(ProtocolBuffer.ProtocolMessage):
   SET          =    1
   ADD          =    2
   REPLACE      =    3
+  CAS          =    4
 
   _SetPolicy_NAMES = {
     1: "SET",
     2: "ADD",
     3: "REPLACE",
+    4: "CAS",
   }
 
   def SetPolicy_Name(cls, x): return cls._SetPolicy_NAMES.get(x, "")
@@ -742,6 +831,7 @@ class MemcacheSetRequest(ProtocolBuffer.ProtocolMessage):
   kItemset_policy = 5
   kItemexpiration_time = 6
   kname_space = 7
+  kItemcas_id = 8
 
   _TEXT = _BuildTagLookupTable({
     0: "ErrorCode",
@@ -752,7 +842,8 @@ class MemcacheSetRequest(ProtocolBuffer.ProtocolMessage):
     5: "set_policy",
     6: "expiration_time",
     7: "name_space",
-  }, 7)
+    8: "cas_id",
+  }, 8)
 
   _TYPES = _BuildTagLookupTable({
     0: ProtocolBuffer.Encoder.NUMERIC,
@@ -763,7 +854,8 @@ class MemcacheSetRequest(ProtocolBuffer.ProtocolMessage):
     5: ProtocolBuffer.Encoder.NUMERIC,
     6: ProtocolBuffer.Encoder.FLOAT,
     7: ProtocolBuffer.Encoder.STRING,
-  }, 7, ProtocolBuffer.Encoder.MAX_TYPE)
+    8: ProtocolBuffer.Encoder.DOUBLE,
+  }, 8, ProtocolBuffer.Encoder.MAX_TYPE)
 
   _STYLE = """"""
   _STYLE_CONTENT_TYPE = """"""
@@ -772,11 +864,13 @@ class MemcacheSetResponse(ProtocolBuffer.ProtocolMessage):
   STORED       =    1
   NOT_STORED   =    2
   ERROR        =    3
+  EXISTS       =    4
 
   _SetStatusCode_NAMES = {
     1: "STORED",
     2: "NOT_STORED",
     3: "ERROR",
+    4: "EXISTS",
   }
 
   def SetStatusCode_Name(cls, x): return cls._SetStatusCode_NAMES.get(x, "")
@@ -1491,6 +1585,232 @@ class MemcacheIncrementResponse(ProtocolBuffer.ProtocolMessage):
     1: ProtocolBuffer.Encoder.NUMERIC,
   }, 1, ProtocolBuffer.Encoder.MAX_TYPE)
 
+  _STYLE = """"""
+  _STYLE_CONTENT_TYPE = """"""
+class MemcacheBatchIncrementRequest(ProtocolBuffer.ProtocolMessage):
+  has_name_space_ = 0
+  name_space_ = ""
+
+  def __init__(self, contents=None):
+    self.item_ = []
+    if contents is not None: self.MergeFromString(contents)
+
+  def name_space(self): return self.name_space_
+
+  def set_name_space(self, x):
+    self.has_name_space_ = 1
+    self.name_space_ = x
+
+  def clear_name_space(self):
+    if self.has_name_space_:
+      self.has_name_space_ = 0
+      self.name_space_ = ""
+
+  def has_name_space(self): return self.has_name_space_
+
+  def item_size(self): return len(self.item_)
+  def item_list(self): return self.item_
+
+  def item(self, i):
+    return self.item_[i]
+
+  def mutable_item(self, i):
+    return self.item_[i]
+
+  def add_item(self):
+    x = MemcacheIncrementRequest()
+    self.item_.append(x)
+    return x
+
+  def clear_item(self):
+    self.item_ = []
+
+  def MergeFrom(self, x):
+    assert x is not self
+    if (x.has_name_space()): self.set_name_space(x.name_space())
+    for i in xrange(x.item_size()): self.add_item().CopyFrom(x.item(i))
+
+  def Equals(self, x):
+    if x is self: return 1
+    if self.has_name_space_ != x.has_name_space_: return 0
+    if self.has_name_space_ and self.name_space_ != x.name_space_: return 0
+    if len(self.item_) != len(x.item_): return 0
+    for e1, e2 in zip(self.item_, x.item_):
+      if e1 != e2: return 0
+    return 1
+
+  def IsInitialized(self, debug_strs=None):
+    initialized = 1
+    for p in self.item_:
+      if not p.IsInitialized(debug_strs): initialized=0
+    return initialized
+
+  def ByteSize(self):
+    n = 0
+    if (self.has_name_space_): n += 1 + self.lengthString(len(self.name_space_))
+    n += 1 * len(self.item_)
+    for i in xrange(len(self.item_)): n += self.lengthString(self.item_[i].ByteSize())
+    return n + 0
+
+  def Clear(self):
+    self.clear_name_space()
+    self.clear_item()
+
+  def OutputUnchecked(self, out):
+    if (self.has_name_space_):
+      out.putVarInt32(10)
+      out.putPrefixedString(self.name_space_)
+    for i in xrange(len(self.item_)):
+      out.putVarInt32(18)
+      out.putVarInt32(self.item_[i].ByteSize())
+      self.item_[i].OutputUnchecked(out)
+
+  def TryMerge(self, d):
+    while d.avail() > 0:
+      tt = d.getVarInt32()
+      if tt == 10:
+        self.set_name_space(d.getPrefixedString())
+        continue
+      if tt == 18:
+        length = d.getVarInt32()
+        tmp = ProtocolBuffer.Decoder(d.buffer(), d.pos(), d.pos() + length)
+        d.skip(length)
+        self.add_item().TryMerge(tmp)
+        continue
+      if (tt == 0): raise ProtocolBuffer.ProtocolBufferDecodeError
+      d.skipData(tt)
+
+
+  def __str__(self, prefix="", printElemNumber=0):
+    res=""
+    if self.has_name_space_: res+=prefix+("name_space: %s\n" % self.DebugFormatString(self.name_space_))
+    cnt=0
+    for e in self.item_:
+      elm=""
+      if printElemNumber: elm="(%d)" % cnt
+      res+=prefix+("item%s <\n" % elm)
+      res+=e.__str__(prefix + "  ", printElemNumber)
+      res+=prefix+">\n"
+      cnt+=1
+    return res
+
+
+  def _BuildTagLookupTable(sparse, maxtag, default=None):
+    return tuple([sparse.get(i, default) for i in xrange(0, 1+maxtag)])
+
+  kname_space = 1
+  kitem = 2
+
+  _TEXT = _BuildTagLookupTable({
+    0: "ErrorCode",
+    1: "name_space",
+    2: "item",
+  }, 2)
+
+  _TYPES = _BuildTagLookupTable({
+    0: ProtocolBuffer.Encoder.NUMERIC,
+    1: ProtocolBuffer.Encoder.STRING,
+    2: ProtocolBuffer.Encoder.STRING,
+  }, 2, ProtocolBuffer.Encoder.MAX_TYPE)
+
+  _STYLE = """"""
+  _STYLE_CONTENT_TYPE = """"""
+class MemcacheBatchIncrementResponse(ProtocolBuffer.ProtocolMessage):
+
+  def __init__(self, contents=None):
+    self.item_ = []
+    if contents is not None: self.MergeFromString(contents)
+
+  def item_size(self): return len(self.item_)
+  def item_list(self): return self.item_
+
+  def item(self, i):
+    return self.item_[i]
+
+  def mutable_item(self, i):
+    return self.item_[i]
+
+  def add_item(self):
+    x = MemcacheIncrementResponse()
+    self.item_.append(x)
+    return x
+
+  def clear_item(self):
+    self.item_ = []
+
+  def MergeFrom(self, x):
+    assert x is not self
+    for i in xrange(x.item_size()): self.add_item().CopyFrom(x.item(i))
+
+  def Equals(self, x):
+    if x is self: return 1
+    if len(self.item_) != len(x.item_): return 0
+    for e1, e2 in zip(self.item_, x.item_):
+      if e1 != e2: return 0
+    return 1
+
+  def IsInitialized(self, debug_strs=None):
+    initialized = 1
+    for p in self.item_:
+      if not p.IsInitialized(debug_strs): initialized=0
+    return initialized
+
+  def ByteSize(self):
+    n = 0
+    n += 1 * len(self.item_)
+    for i in xrange(len(self.item_)): n += self.lengthString(self.item_[i].ByteSize())
+    return n + 0
+
+  def Clear(self):
+    self.clear_item()
+
+  def OutputUnchecked(self, out):
+    for i in xrange(len(self.item_)):
+      out.putVarInt32(10)
+      out.putVarInt32(self.item_[i].ByteSize())
+      self.item_[i].OutputUnchecked(out)
+
+  def TryMerge(self, d):
+    while d.avail() > 0:
+      tt = d.getVarInt32()
+      if tt == 10:
+        length = d.getVarInt32()
+        tmp = ProtocolBuffer.Decoder(d.buffer(), d.pos(), d.pos() + length)
+        d.skip(length)
+        self.add_item().TryMerge(tmp)
+        continue
+      if (tt == 0): raise ProtocolBuffer.ProtocolBufferDecodeError
+      d.skipData(tt)
+
+
+  def __str__(self, prefix="", printElemNumber=0):
+    res=""
+    cnt=0
+    for e in self.item_:
+      elm=""
+      if printElemNumber: elm="(%d)" % cnt
+      res+=prefix+("item%s <\n" % elm)
+      res+=e.__str__(prefix + "  ", printElemNumber)
+      res+=prefix+">\n"
+      cnt+=1
+    return res
+
+
+  def _BuildTagLookupTable(sparse, maxtag, default=None):
+    return tuple([sparse.get(i, default) for i in xrange(0, 1+maxtag)])
+
+  kitem = 1
+
+  _TEXT = _BuildTagLookupTable({
+    0: "ErrorCode",
+    1: "item",
+  }, 1)
+
+  _TYPES = _BuildTagLookupTable({
+    0: ProtocolBuffer.Encoder.NUMERIC,
+    1: ProtocolBuffer.Encoder.STRING,
+  }, 1, ProtocolBuffer.Encoder.MAX_TYPE)
+
   _STYLE = """"""
   _STYLE_CONTENT_TYPE = """"""
 class MemcacheFlushRequest(ProtocolBuffer.ProtocolMessage):
@@ -1668,6 +1988,8 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
   bytes_ = 0
   has_oldest_item_age_ = 0
   oldest_item_age_ = 0
+  has_evictions_ = 0
+  evictions_ = 0
 
   def __init__(self, contents=None):
     if contents is not None: self.MergeFromString(contents)
@@ -1750,6 +2072,19 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
 
   def has_oldest_item_age(self): return self.has_oldest_item_age_
 
+  def evictions(self): return self.evictions_
+
+  def set_evictions(self, x):
+    self.has_evictions_ = 1
+    self.evictions_ = x
+
+  def clear_evictions(self):
+    if self.has_evictions_:
+      self.has_evictions_ = 0
+      self.evictions_ = 0
+
+  def has_evictions(self): return self.has_evictions_
+
 
   def MergeFrom(self, x):
     assert x is not self
@@ -1759,6 +2094,7 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     if (x.has_items()): self.set_items(x.items())
     if (x.has_bytes()): self.set_bytes(x.bytes())
     if (x.has_oldest_item_age()): self.set_oldest_item_age(x.oldest_item_age())
+    if (x.has_evictions()): self.set_evictions(x.evictions())
 
   def Equals(self, x):
     if x is self: return 1
@@ -1774,6 +2110,8 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     if self.has_bytes_ and self.bytes_ != x.bytes_: return 0
     if self.has_oldest_item_age_ != x.has_oldest_item_age_: return 0
     if self.has_oldest_item_age_ and self.oldest_item_age_ != x.oldest_item_age_: return 0
+    if self.has_evictions_ != x.has_evictions_: return 0
+    if self.has_evictions_ and self.evictions_ != x.evictions_: return 0
     return 1
 
   def IsInitialized(self, debug_strs=None):
@@ -1811,6 +2149,7 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     n += self.lengthVarInt64(self.byte_hits_)
     n += self.lengthVarInt64(self.items_)
     n += self.lengthVarInt64(self.bytes_)
+    if (self.has_evictions_): n += 1 + self.lengthVarInt64(self.evictions_)
     return n + 10
 
   def Clear(self):
@@ -1820,6 +2159,7 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     self.clear_items()
     self.clear_bytes()
     self.clear_oldest_item_age()
+    self.clear_evictions()
 
   def OutputUnchecked(self, out):
     out.putVarInt32(8)
@@ -1834,6 +2174,9 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     out.putVarUint64(self.bytes_)
     out.putVarInt32(53)
     out.put32(self.oldest_item_age_)
+    if (self.has_evictions_):
+      out.putVarInt32(56)
+      out.putVarUint64(self.evictions_)
 
   def TryMerge(self, d):
     while d.avail() > 0:
@@ -1856,6 +2199,9 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
       if tt == 53:
         self.set_oldest_item_age(d.get32())
         continue
+      if tt == 56:
+        self.set_evictions(d.getVarUint64())
+        continue
       if (tt == 0): raise ProtocolBuffer.ProtocolBufferDecodeError
       d.skipData(tt)
 
@@ -1868,6 +2214,7 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     if self.has_items_: res+=prefix+("items: %s\n" % self.DebugFormatInt64(self.items_))
     if self.has_bytes_: res+=prefix+("bytes: %s\n" % self.DebugFormatInt64(self.bytes_))
     if self.has_oldest_item_age_: res+=prefix+("oldest_item_age: %s\n" % self.DebugFormatFixed32(self.oldest_item_age_))
+    if self.has_evictions_: res+=prefix+("evictions: %s\n" % self.DebugFormatInt64(self.evictions_))
     return res
 
 
@@ -1880,6 +2227,7 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
   kitems = 4
   kbytes = 5
   koldest_item_age = 6
+  kevictions = 7
 
   _TEXT = _BuildTagLookupTable({
     0: "ErrorCode",
@@ -1889,7 +2237,8 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     4: "items",
     5: "bytes",
     6: "oldest_item_age",
-  }, 6)
+    7: "evictions",
+  }, 7)
 
   _TYPES = _BuildTagLookupTable({
     0: ProtocolBuffer.Encoder.NUMERIC,
@@ -1899,7 +2248,8 @@ class MergedNamespaceStats(ProtocolBuffer.ProtocolMessage):
     4: ProtocolBuffer.Encoder.NUMERIC,
     5: ProtocolBuffer.Encoder.NUMERIC,
     6: ProtocolBuffer.Encoder.FLOAT,
-  }, 6, ProtocolBuffer.Encoder.MAX_TYPE)
+    7: ProtocolBuffer.Encoder.NUMERIC,
+  }, 7, ProtocolBuffer.Encoder.MAX_TYPE)
 
   _STYLE = """"""
   _STYLE_CONTENT_TYPE = """"""
@@ -1999,4 +2349,4 @@ class MemcacheStatsResponse(ProtocolBuffer.ProtocolMessage):
   _STYLE = """"""
   _STYLE_CONTENT_TYPE = """"""
 
-__all__ = ['MemcacheServiceError','MemcacheGetRequest','MemcacheGetResponse','MemcacheGetResponse_Item','MemcacheSetRequest','MemcacheSetRequest_Item','MemcacheSetResponse','MemcacheDeleteRequest','MemcacheDeleteRequest_Item','MemcacheDeleteResponse','MemcacheIncrementRequest','MemcacheIncrementResponse','MemcacheFlushRequest','MemcacheFlushResponse','MemcacheStatsRequest','MergedNamespaceStats','MemcacheStatsResponse']
+__all__ = ['MemcacheServiceError','MemcacheGetRequest','MemcacheGetResponse','MemcacheGetResponse_Item','MemcacheSetRequest','MemcacheSetRequest_Item','MemcacheSetResponse','MemcacheDeleteRequest','MemcacheDeleteRequest_Item','MemcacheDeleteResponse','MemcacheIncrementRequest','MemcacheIncrementResponse','MemcacheBatchIncrementRequest','MemcacheBatchIncrementResponse','MemcacheFlushRequest','MemcacheFlushResponse','MemcacheStatsRequest','MergedNamespaceStats','MemcacheStatsResponse']
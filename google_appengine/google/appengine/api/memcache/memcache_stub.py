@@ -15,12 +15,26 @@
 # limitations under the License.
 #
 
-"""Stub version of the memcache API, keeping all data in process memory."""
+"""Stub version of the memcache API, keeping all data in process memory.
 
+Like the real service, the stub holds a bounded number of bytes. Once a new
+value would not fit, the least recently used entries are evicted to make room.
+Expired entries are dropped by a background pass every so often, as well as
+whenever they are looked up.
 
+The keys are spread over a number of stripes, each of them a separate cache
+with its own lock and its own share of the capacity. Each operation on a key
+holds the lock of that key's stripe, so that increments and conditional sets
+are atomic, while threads working on keys in other stripes go ahead.
+"""
 
+
+
+import heapq
 import logging
+import threading
 import time
+import weakref
 
 from google.appengine.api import apiproxy_stub
 from google.appengine.api import memcache
@@ -31,6 +45,12 @@ MemcacheSetRequest = memcache_service_pb.MemcacheSetRequest
 MemcacheIncrementRequest = memcache_service_pb.MemcacheIncrementRequest
 MemcacheDeleteResponse = memcache_service_pb.MemcacheDeleteResponse
 
+DEFAULT_CAPACITY = 64 * 1024 * 1024
+
+DEFAULT_SWEEP_INTERVAL = 60
+
+DEFAULT_STRIPES = 16
+
 
 class CacheEntry(object):
   """An entry in the cache."""
@@ -53,10 +73,16 @@ class CacheEntry(object):
     self.value = value
     self.flags = flags
     self.created_time = self._gettime()
+    self.last_access_time = self.created_time
     self.will_expire = expiration != 0
     self.locked = False
     self._SetExpiration(expiration)
 
+    self.cas_id = 0
+    self.cache_key = None
+    self.newer = None
+    self.older = None
+
   def _SetExpiration(self, expiration):
     """Sets the expiration for this entry.
 
@@ -92,6 +118,199 @@ class CacheEntry(object):
     return self.locked and not self.CheckExpired()
 
 
+class _LRUCache(object):
+  """Cache entries by (namespace, key), holding at most a number of bytes.
+
+  The entries form a doubly linked list, from the most recently used to the
+  least recently used, so that the one to evict is always at hand. Entries
+  that will expire are also kept in a heap by expiration time, so that the
+  expired ones can be swept without looking at all the others. The heap is
+  only cleaned up lazily, so it can hold entries that have since been
+  replaced, removed, or given a new expiration time.
+
+  The size of an entry is the length of its value, as for the bytes statistic.
+  The cache also counts the hits and misses on its keys. It is not
+  thread-safe by itself; callers hold its lock while they use it.
+
+  Every value stored or changed gets a new compare-and-set ID. The IDs of
+  the caches of a stub are interleaved, so that no two entries ever share
+  one, even across a flush.
+  """
+
+  def __init__(self, capacity, first_cas_id=1, cas_id_step=1):
+    """Initializer.
+
+    Args:
+      capacity: The number of bytes the values may take up between them.
+      first_cas_id: The compare-and-set ID of the first value stored.
+      cas_id_step: The difference between successive compare-and-set IDs.
+    """
+    self.capacity = capacity
+    self.lock = threading.Lock()
+    self._next_cas_id = first_cas_id
+    self._cas_id_step = cas_id_step
+    self.Clear()
+
+  def Clear(self):
+    """Removes all entries, and resets the statistics."""
+    self.hits = 0
+    self.misses = 0
+    self.byte_hits = 0
+    self.bytes = 0
+    self.evictions = 0
+    self._entries = {}
+    self._expirations = []
+    self._head = CacheEntry('', 0, 0, lambda: 0)
+    self._head.newer = self._head.older = self._head
+
+  def __len__(self):
+    return len(self._entries)
+
+  def Get(self, cache_key):
+    """Returns an entry and marks it as the most recently used.
+
+    Args:
+      cache_key: (namespace, key) tuple.
+
+    Returns:
+      The CacheEntry, or None if there is no such entry.
+    """
+    entry = self._entries.get(cache_key)
+    if entry is not None:
+      entry.last_access_time = entry._gettime()
+      self._Unlink(entry)
+      self._Link(entry)
+    return entry
+
+  def Put(self, cache_key, entry):
+    """Stores an entry, replacing any other with the same key, and evicts the
+    least recently used entries if they no longer all fit.
+
+    Args:
+      cache_key: (namespace, key) tuple.
+      entry: CacheEntry
+
+    Returns:
+      True if the entry was stored; False if it is larger than the cache.
+    """
+    if len(entry.value) > self.capacity:
+      return False
+    self.Remove(cache_key)
+
+    entry.cache_key = cache_key
+    entry.cas_id = self._NextCasId()
+    self._entries[cache_key] = entry
+    self._Link(entry)
+    self.bytes += len(entry.value)
+    self.Expires(entry)
+
+    while self.bytes > self.capacity:
+      self.Remove(self._head.older.cache_key)
+      self.evictions += 1
+    return True
+
+  def Update(self, entry, value):
+    """Changes the value of an entry in place.
+
+    Args:
+      entry: CacheEntry in this cache.
+      value: String, the new value.
+    """
+    self.bytes += len(value) - len(entry.value)
+    entry.value = value
+    entry.cas_id = self._NextCasId()
+    while self.bytes > self.capacity and self._head.older is not entry:
+      self.Remove(self._head.older.cache_key)
+      self.evictions += 1
+
+  def Expires(self, entry):
+    """Notes the expiration time of an entry, after it has been set or
+    changed.
+
+    Args:
+      entry: CacheEntry in this cache.
+    """
+    if entry.will_expire:
+      heapq.heappush(self._expirations, (entry.expiration_time, entry))
+      if len(self._expirations) > 2 * len(self._entries) + 100:
+        self._expirations = [(e.expiration_time, e)
+                             for e in self._entries.itervalues()
+                             if e.will_expire]
+        heapq.heapify(self._expirations)
+
+  def Remove(self, cache_key):
+    """Removes an entry, if there is one.
+
+    Args:
+      cache_key: (namespace, key) tuple.
+    """
+    entry = self._entries.pop(cache_key, None)
+    if entry is not None:
+      self._Unlink(entry)
+      self.bytes -= len(entry.value)
+
+  def Sweep(self, now):
+    """Removes the entries that have expired.
+
+    Args:
+      now: The current time.
+
+    Returns:
+      The number of entries removed.
+    """
+    removed = 0
+    expirations = self._expirations
+    while expirations and expirations[0][0] <= now:
+      expiration_time, entry = heapq.heappop(expirations)
+      if (self._entries.get(entry.cache_key) is entry and
+          entry.expiration_time == expiration_time):
+        self.Remove(entry.cache_key)
+        removed += 1
+    return removed
+
+  def OldestAccessTime(self):
+    """Returns the time the least recently used entry was last used, or None
+    if the cache is empty."""
+    if self._head.older is self._head:
+      return None
+    return self._head.older.last_access_time
+
+  def _NextCasId(self):
+    """Returns a new compare-and-set ID."""
+    cas_id = self._next_cas_id
+    self._next_cas_id += self._cas_id_step
+    return cas_id
+
+  def _Link(self, entry):
+    """Puts an entry at the most recently used end of the list."""
+    entry.older = self._head
+    entry.newer = self._head.newer
+    self._head.newer.older = entry
+    self._head.newer = entry
+
+  def _Unlink(self, entry):
+    """Takes an entry out of the list."""
+    entry.newer.older = entry.older
+    entry.older.newer = entry.newer
+    entry.newer = entry.older = None
+
+
+def _SweepPeriodically(stub_ref, interval):
+  """Sweeps expired entries from a stub's cache until the stub goes away.
+
+  Args:
+    stub_ref: weakref to a MemcacheServiceStub.
+    interval: Number of seconds between sweeps.
+  """
+  while True:
+    time.sleep(interval)
+    stub = stub_ref()
+    if stub is None:
+      return
+    stub._SweepExpired()
+    del stub
+
+
 class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
   """Python only memcache service stub.
 
@@ -99,32 +318,63 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
   external servers.
   """
 
-  def __init__(self, gettime=time.time, service_name='memcache'):
+  def __init__(self, gettime=time.time, service_name='memcache',
+               capacity=DEFAULT_CAPACITY,
+               sweep_interval=DEFAULT_SWEEP_INTERVAL,
+               stripes=DEFAULT_STRIPES):
     """Initializer.
 
     Args:
       gettime: time.time()-like function used for testing.
       service_name: Service name expected for all calls.
+      capacity: The number of bytes of values to hold before evicting. Each
+        stripe gets an equal share, so a value larger than that share is
+        never stored.
+      sweep_interval: Number of seconds between background sweeps of expired
+        entries, or None to only sweep when _SweepExpired() is called.
+      stripes: The number of separately locked parts to split the cache into.
     """
     super(MemcacheServiceStub, self).__init__(service_name)
     self._gettime = gettime
-    self._ResetStats()
+    self._stripes = [_LRUCache(capacity // stripes, first_cas_id=i + 1,
+                               cas_id_step=stripes)
+                     for i in xrange(stripes)]
+
+    if sweep_interval:
+      sweeper = threading.Thread(target=_SweepPeriodically,
+                                 args=(weakref.ref(self), sweep_interval))
+      sweeper.setDaemon(True)
+      sweeper.start()
+
+  def _SweepExpired(self):
+    """Removes all expired entries from the cache."""
+    for cache in self._stripes:
+      cache.lock.acquire()
+      try:
+        cache.Sweep(self._gettime())
+      finally:
+        cache.lock.release()
+
+  def _Stripe(self, namespace, key):
+    """Returns the stripe of the cache that holds a key.
 
-    self._the_cache = {}
+    Args:
+      namespace: The namespace that keys are stored under.
+      key: The key.
 
-  def _ResetStats(self):
-    """Resets statistics information."""
-    self._hits = 0
-    self._misses = 0
-    self._byte_hits = 0
-    self._cache_creation_time = self._gettime()
+    Returns:
+      _LRUCache
+    """
+    return self._stripes[hash((namespace, key)) % len(self._stripes)]
 
-  def _GetKey(self, namespace, key):
+  def _GetKey(self, cache, namespace, key):
     """Retrieves a CacheEntry from the cache if it hasn't expired.
 
-    Does not take deletion timeout into account.
+    Does not take deletion timeout into account. The caller must hold the
+    lock of the key's stripe.
 
     Args:
+      cache: The stripe of the cache that holds the key.
       namespace: The namespace that keys are stored under.
       key: The key to retrieve from the cache.
 
@@ -132,14 +382,11 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
       The corresponding CacheEntry instance, or None if it was not found or
       has already expired.
     """
-    namespace_dict = self._the_cache.get(namespace, None)
-    if namespace_dict is None:
-      return None
-    entry = namespace_dict.get(key, None)
+    entry = cache.Get((namespace, key))
     if entry is None:
       return None
     elif entry.CheckExpired():
-      del namespace_dict[key]
+      cache.Remove((namespace, key))
       return None
     else:
       return entry
@@ -153,17 +400,25 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
     """
     namespace = request.name_space()
     keys = set(request.key_list())
+    for_cas = request.for_cas()
     for key in keys:
-      entry = self._GetKey(namespace, key)
-      if entry is None or entry.CheckLocked():
-        self._misses += 1
-        continue
-      self._hits += 1
-      self._byte_hits += len(entry.value)
-      item = response.add_item()
-      item.set_key(key)
-      item.set_value(entry.value)
-      item.set_flags(entry.flags)
+      cache = self._Stripe(namespace, key)
+      cache.lock.acquire()
+      try:
+        entry = self._GetKey(cache, namespace, key)
+        if entry is None or entry.CheckLocked():
+          cache.misses += 1
+          continue
+        cache.hits += 1
+        cache.byte_hits += len(entry.value)
+        item = response.add_item()
+        item.set_key(key)
+        item.set_value(entry.value)
+        item.set_flags(entry.flags)
+        if for_cas:
+          item.set_cas_id(entry.cas_id)
+      finally:
+        cache.lock.release()
 
   def _Dynamic_Set(self, request, response):
     """Implementation of MemcacheService::Set().
@@ -176,23 +431,31 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
     for item in request.item_list():
       key = item.key()
       set_policy = item.set_policy()
-      old_entry = self._GetKey(namespace, key)
-
-      set_status = MemcacheSetResponse.NOT_STORED
-      if ((set_policy == MemcacheSetRequest.SET) or
-          (set_policy == MemcacheSetRequest.ADD and old_entry is None) or
-          (set_policy == MemcacheSetRequest.REPLACE and old_entry is not None)):
-
-        if (old_entry is None or
-            set_policy == MemcacheSetRequest.SET
-            or not old_entry.CheckLocked()):
-          if namespace not in self._the_cache:
-            self._the_cache[namespace] = {}
-          self._the_cache[namespace][key] = CacheEntry(item.value(),
-                                                       item.expiration_time(),
-                                                       item.flags(),
-                                                       gettime=self._gettime)
-          set_status = MemcacheSetResponse.STORED
+      cache = self._Stripe(namespace, key)
+      cache.lock.acquire()
+      try:
+        old_entry = self._GetKey(cache, namespace, key)
+
+        set_status = MemcacheSetResponse.NOT_STORED
+        if (set_policy == MemcacheSetRequest.CAS and old_entry is not None and
+            not old_entry.CheckLocked() and
+            old_entry.cas_id != item.cas_id()):
+          set_status = MemcacheSetResponse.EXISTS
+        elif ((set_policy == MemcacheSetRequest.SET) or
+              (set_policy == MemcacheSetRequest.ADD and old_entry is None) or
+              (set_policy in (MemcacheSetRequest.REPLACE,
+                              MemcacheSetRequest.CAS) and
+               old_entry is not None)):
+
+          if (old_entry is None or
+              set_policy == MemcacheSetRequest.SET
+              or not old_entry.CheckLocked()):
+            entry = CacheEntry(item.value(), item.expiration_time(),
+                               item.flags(), gettime=self._gettime)
+            if cache.Put((namespace, key), entry):
+              set_status = MemcacheSetResponse.STORED
+      finally:
+        cache.lock.release()
 
       response.add_set_status(set_status)
 
@@ -206,18 +469,72 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
     namespace = request.name_space()
     for item in request.item_list():
       key = item.key()
-      entry = self._GetKey(namespace, key)
-
-      delete_status = MemcacheDeleteResponse.DELETED
-      if entry is None:
-        delete_status = MemcacheDeleteResponse.NOT_FOUND
-      elif item.delete_time() == 0:
-        del self._the_cache[namespace][key]
-      else:
-        entry.ExpireAndLock(item.delete_time())
+      cache = self._Stripe(namespace, key)
+      cache.lock.acquire()
+      try:
+        entry = self._GetKey(cache, namespace, key)
+
+        delete_status = MemcacheDeleteResponse.DELETED
+        if entry is None:
+          delete_status = MemcacheDeleteResponse.NOT_FOUND
+        elif item.delete_time() == 0:
+          cache.Remove((namespace, key))
+        else:
+          entry.ExpireAndLock(item.delete_time())
+          cache.Expires(entry)
+      finally:
+        cache.lock.release()
 
       response.add_delete_status(delete_status)
 
+  def _Increment(self, namespace, request):
+    """Increments or decrements a key, holding the lock of its stripe.
+
+    Args:
+      namespace: The namespace that keys are stored under.
+      request: A MemcacheIncrementRequest.
+
+    Returns:
+      The new value of the key, or None if it was not there and there is no
+      initial value, or it does not hold an unsigned integer.
+    """
+    key = request.key()
+    cache = self._Stripe(namespace, key)
+    cache.lock.acquire()
+    try:
+      entry = self._GetKey(cache, namespace, key)
+      if entry is None:
+        if not request.has_initial_value():
+          return None
+        entry = CacheEntry(str(request.initial_value()),
+                           expiration=0,
+                           flags=0,
+                           gettime=self._gettime)
+        if not cache.Put((namespace, key), entry):
+          return None
+
+      try:
+        old_value = long(entry.value)
+        if old_value < 0:
+          raise ValueError
+      except ValueError:
+        logging.error('Increment/decrement failed: Could not interpret '
+                      'value for key = "%s" as an unsigned integer.', key)
+        return None
+
+      delta = request.delta()
+      if request.direction() == MemcacheIncrementRequest.DECREMENT:
+        delta = -delta
+
+      new_value = old_value + delta
+      if not (0 <= new_value < 2**64):
+        new_value = 0
+
+      cache.Update(entry, str(new_value))
+      return new_value
+    finally:
+      cache.lock.release()
+
   def _Dynamic_Increment(self, request, response):
     """Implementation of MemcacheService::Increment().
 
@@ -225,40 +542,25 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
       request: A MemcacheIncrementRequest.
       response: A MemcacheIncrementResponse.
     """
-    namespace = request.name_space()
-    key = request.key()
-    entry = self._GetKey(namespace, key)
-    if entry is None:
-      if not request.has_initial_value():
-        return
-      if namespace not in self._the_cache:
-        self._the_cache[namespace] = {}
-      self._the_cache[namespace][key] = CacheEntry(str(request.initial_value()),
-                                                   expiration=0,
-                                                   flags=0,
-                                                   gettime=self._gettime)
-      entry = self._GetKey(namespace, key)
-      assert entry is not None
-
-    try:
-      old_value = long(entry.value)
-      if old_value < 0:
-        raise ValueError
-    except ValueError:
-      logging.error('Increment/decrement failed: Could not interpret '
-                    'value for key = "%s" as an unsigned integer.', key)
-      return
+    new_value = self._Increment(request.name_space(), request)
+    if new_value is not None:
+      response.set_new_value(new_value)
 
-    delta = request.delta()
-    if request.direction() == MemcacheIncrementRequest.DECREMENT:
-      delta = -delta
+  def _Dynamic_BatchIncrement(self, request, response):
+    """Implementation of MemcacheService::BatchIncrement().
 
-    new_value = old_value + delta
-    if not (0 <= new_value < 2**64):
-      new_value = 0
+    Each key is incremented atomically, but not the batch as a whole.
 
-    entry.value = str(new_value)
-    response.set_new_value(new_value)
+    Args:
+      request: A MemcacheBatchIncrementRequest.
+      response: A MemcacheBatchIncrementResponse.
+    """
+    namespace = request.name_space()
+    for item in request.item_list():
+      new_value = self._Increment(namespace, item)
+      item_response = response.add_item()
+      if new_value is not None:
+        item_response.set_new_value(new_value)
 
   def _Dynamic_FlushAll(self, request, response):
     """Implementation of MemcacheService::FlushAll().
@@ -267,27 +569,50 @@ class MemcacheServiceStub(apiproxy_stub.APIProxyStub):
       request: A MemcacheFlushRequest.
       response: A MemcacheFlushResponse.
     """
-    self._the_cache.clear()
-    self._ResetStats()
+    for cache in self._stripes:
+      cache.lock.acquire()
+      try:
+        cache.Clear()
+      finally:
+        cache.lock.release()
 
   def _Dynamic_Stats(self, request, response):
     """Implementation of MemcacheService::Stats().
 
+    The stripes are added up one at a time, so the totals are not a snapshot
+    of the whole cache at one moment.
+
     Args:
       request: A MemcacheStatsRequest.
       response: A MemcacheStatsResponse.
     """
+    now = self._gettime()
+    hits = misses = byte_hits = items = total_bytes = evictions = 0
+    oldest = None
+    for cache in self._stripes:
+      cache.lock.acquire()
+      try:
+        cache.Sweep(now)
+        hits += cache.hits
+        misses += cache.misses
+        byte_hits += cache.byte_hits
+        items += len(cache)
+        total_bytes += cache.bytes
+        evictions += cache.evictions
+        access_time = cache.OldestAccessTime()
+        if access_time is not None and (oldest is None or access_time < oldest):
+          oldest = access_time
+      finally:
+        cache.lock.release()
+
     stats = response.mutable_stats()
-    stats.set_hits(self._hits)
-    stats.set_misses(self._misses)
-    stats.set_byte_hits(self._byte_hits)
-    items = 0
-    total_bytes = 0
-    for namespace in self._the_cache.itervalues():
-      items += len(namespace)
-      for entry in namespace.itervalues():
-        total_bytes += len(entry.value)
+    stats.set_hits(hits)
+    stats.set_misses(misses)
+    stats.set_byte_hits(byte_hits)
     stats.set_items(items)
     stats.set_bytes(total_bytes)
-
-    stats.set_oldest_item_age(self._gettime() - self._cache_creation_time)
+    stats.set_evictions(evictions)
+    if oldest is None:
+      stats.set_oldest_item_age(0)
+    else:
+      stats.set_oldest_item_age(int(now - oldest))
@@ -85,6 +85,7 @@ from google.appengine.api import appinfo
 from google.appengine.api import croninfo
 from google.appengine.api import datastore_admin
 from google.appengine.api import datastore_file_stub
+from google.appengine.api import datastore_sqlite_stub
 from google.appengine.api import mail_stub
 from google.appengine.api import urlfetch_stub
 from google.appengine.api import user_service_stub
@@ -3274,6 +3275,12 @@ def SetupStubs(app_id, **config):
         contain the app.yaml, indexes.yaml, and queues.yaml files.
     login_url: Relative URL which should be used for handling user login/logout.
     datastore_path: Path to the file to store Datastore file stub data in.
+    datastore_journal: If the Datastore file stub should append changes to a
+      journal instead of rewriting its whole file on every write.
+    datastore_entity_cache: The number of entities the Datastore file stub
+      keeps decoded in memory, or None for its default.
+    use_sqlite: If the Datastore should be stored in a SQLite database at
+      datastore_path, instead of by the file stub.
     history_path: DEPRECATED, No-op.
     clear_datastore: If the datastore should be cleared on startup.
     smtp_host: SMTP host used for sending test mail.
@@ -3291,6 +3298,11 @@ def SetupStubs(app_id, **config):
   login_url = config['login_url']
   datastore_path = config['datastore_path']
   clear_datastore = config['clear_datastore']
+  datastore_journal = config.get('datastore_journal', False)
+  datastore_entity_cache = config.get('datastore_entity_cache', None)
+  if datastore_entity_cache is None:
+    datastore_entity_cache = datastore_file_stub._ENTITY_CACHE_SIZE
+  use_sqlite = config.get('use_sqlite', False)
   require_indexes = config.get('require_indexes', False)
   smtp_host = config.get('smtp_host', None)
   smtp_port = config.get('smtp_port', 25)
@@ -3304,19 +3316,28 @@ def SetupStubs(app_id, **config):
   os.environ['APPLICATION_ID'] = app_id
 
   if clear_datastore:
-    path = datastore_path
-    if os.path.lexists(path):
-      logging.info('Attempting to remove file at %s', path)
-      try:
-        remove(path)
-      except OSError, e:
-        logging.warning('Removing file failed: %s', e)
+    journal_paths = datastore_file_stub.JournalFiles(datastore_path)
+    if use_sqlite:
+      journal_paths.append(datastore_path + '-journal')
+    for path in [datastore_path] + journal_paths:
+      if os.path.lexists(path):
+        logging.info('Attempting to remove file at %s', path)
+        try:
+          remove(path)
+        except OSError, e:
+          logging.warning('Removing file failed: %s', e)
 
   apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
 
-  datastore = datastore_file_stub.DatastoreFileStub(
-      app_id, datastore_path, require_indexes=require_indexes,
-      trusted=trusted)
+  if use_sqlite:
+    datastore = datastore_sqlite_stub.DatastoreSqliteStub(
+        app_id, datastore_path, require_indexes=require_indexes,
+        trusted=trusted)
+  else:
+    datastore = datastore_file_stub.DatastoreFileStub(
+        app_id, datastore_path, require_indexes=require_indexes,
+        trusted=trusted, use_journal=datastore_journal,
+        entity_cache_size=datastore_entity_cache)
   apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', datastore)
 
   fixed_login_url = '%s?%s=%%s' % (login_url,
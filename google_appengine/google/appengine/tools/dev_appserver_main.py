@@ -33,6 +33,16 @@ Options:
                              (Default %(datastore_path)s)
   --history_path=PATH        Path to use for storing Datastore history.
                              (Default %(history_path)s)
+  --datastore_journal        Append each change to a journal next to the
+                             Datastore file, instead of rewriting the whole
+                             file on every write. (Default false)
+  --datastore_entity_cache=COUNT
+                             Number of entities the Datastore file stub keeps
+                             decoded in memory. 0 decodes them every time.
+                             (Default 5000)
+  --use_sqlite               Store the Datastore in a SQLite database at the
+                             datastore path, which is queried with SQL instead
+                             of being loaded into memory. (Default false)
   --require_indexes          Disallows queries that require composite indexes
                              not defined in index.yaml.
   --smtp_host=HOSTNAME       SMTP host to send test mail to.  Leaving this
@@ -101,6 +111,8 @@ ARG_ADMIN_CONSOLE_HOST = 'admin_console_host'
 ARG_AUTH_DOMAIN = 'auth_domain'
 ARG_CLEAR_DATASTORE = 'clear_datastore'
 ARG_DATASTORE_PATH = 'datastore_path'
+ARG_DATASTORE_JOURNAL = 'datastore_journal'
+ARG_DATASTORE_ENTITY_CACHE = 'datastore_entity_cache'
 ARG_DEBUG_IMPORTS = 'debug_imports'
 ARG_ENABLE_SENDMAIL = 'enable_sendmail'
 ARG_SHOW_MAIL_BODY = 'show_mail_body'
@@ -117,6 +129,7 @@ ARG_SMTP_USER = 'smtp_user'
 ARG_STATIC_CACHING = 'static_caching'
 ARG_TEMPLATE_DIR = 'template_dir'
 ARG_TRUSTED = 'trusted'
+ARG_USE_SQLITE = 'use_sqlite'
 
 SDK_PATH = os.path.dirname(
              os.path.dirname(
@@ -135,6 +148,9 @@ DEFAULT_ARGS = {
                                  'dev_appserver.datastore.history'),
   ARG_LOGIN_URL: '/_ah/login',
   ARG_CLEAR_DATASTORE: False,
+  ARG_DATASTORE_JOURNAL: False,
+  ARG_DATASTORE_ENTITY_CACHE: None,
+  ARG_USE_SQLITE: False,
   ARG_REQUIRE_INDEXES: False,
   ARG_TEMPLATE_DIR: os.path.join(SDK_PATH, 'templates'),
   ARG_SMTP_HOST: '',
@@ -261,6 +277,8 @@ def ParseArguments(argv):
         'auth_domain=',
         'clear_datastore',
         'datastore_path=',
+        'datastore_journal',
+        'datastore_entity_cache=',
         'debug',
         'debug_imports',
         'enable_sendmail',
@@ -276,6 +294,7 @@ def ParseArguments(argv):
         'smtp_user=',
         'template_dir=',
         'trusted',
+        'use_sqlite',
       ])
   except getopt.GetoptError, e:
     print >>sys.stderr, 'Error: %s' % e
@@ -306,6 +325,21 @@ def ParseArguments(argv):
     if option == '--history_path':
       option_dict[ARG_HISTORY_PATH] = os.path.abspath(value)
 
+    if option == '--datastore_journal':
+      option_dict[ARG_DATASTORE_JOURNAL] = True
+
+    if option == '--datastore_entity_cache':
+      try:
+        option_dict[ARG_DATASTORE_ENTITY_CACHE] = int(value)
+        if option_dict[ARG_DATASTORE_ENTITY_CACHE] < 0:
+          raise ValueError
+      except ValueError:
+        print >>sys.stderr, 'Invalid value supplied for datastore_entity_cache'
+        PrintUsageExit(1)
+
+    if option == '--use_sqlite':
+      option_dict[ARG_USE_SQLITE] = True
+
     if option in ('-c', '--clear_datastore'):
       option_dict[ARG_CLEAR_DATASTORE] = True
 
@@ -22,6 +22,8 @@ source version.sh
 thisFile=`readlink -f "$BASH_SOURCE"`
 thisDir=`dirname "$thisFile"`
 
-testSuite="$thisDir/console/console/test/console.py"
+testDir="$thisDir/console/console/test"
 
-python "$testSuite"
+for testSuite in console.py controller.py datastore.py memcache.py; do
+    python "$testDir/$testSuite" || exit 1
+done